@@ -0,0 +1,34 @@
+"""Access control for the support endpoints under /admin/.
+
+They are switched off (404) unless ``ADMIN_TOKEN`` is set. Callers send
+the token as a bearer token:
+
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" https://delus.co/admin/orders?email=...
+"""
+import hmac
+import os
+from functools import wraps
+
+from flask import abort, current_app, request
+
+
+def token_matches(given):
+    """Whether ``given`` is the admin token; always False while none is set."""
+    token = current_app.config['ADMIN_TOKEN']
+    return bool(token and given) and hmac.compare_digest(given.encode(), token.encode())
+
+
+def require_token(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_app.config['ADMIN_TOKEN']:
+            abort(404)
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token_matches(given):
+            abort(401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_app(app):
+    app.config.setdefault('ADMIN_TOKEN', os.environ.get('ADMIN_TOKEN'))
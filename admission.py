@@ -0,0 +1,223 @@
+"""Admission control for the cart and checkout endpoints, and /healthz.
+
+During a drop, a burst of add-to-carts and checkouts (each checkout waits
+on Stripe) can take every gunicorn thread, and then the cheap pages time
+out too. So the routes in ``ADMISSION_GROUPS`` are held to two budgets,
+shared by every worker process:
+
+- concurrency: at most a share of ``SERVER_CAPACITY`` (the requests the
+  server runs at once; gunicorn_config.py sets it) run at the same time.
+  The rest get an immediate 503. The shares add up to less than 1, so
+  with every group full some threads are still free for everything else.
+- rate: each client has a token bucket per group. Requests beyond it get
+  a 429.
+
+Both answers carry ``Retry-After`` and a JSON ``error``, as the cart's other
+errors do. Every other route, static files and /healthz included, is never
+held back. Clients are told apart by address. Behind a router that appends
+to X-Forwarded-For, set ``ADMISSION_PROXIES`` to the number of such hops;
+on Heroku (``DYNO`` is set) it defaults to 1, the Heroku router.
+
+The shared state is one small file, ``ADMISSION_STATE_FILE``. A running
+request holds a one-byte fcntl lock in its group's range of the file, so
+the kernel frees the slot even if the worker is killed mid-request. The
+token buckets are a fixed table mmapped from the rest of the file and
+keyed by a hash of client and group. A client whose hash lands on another
+client's slot starts with a full bucket, so a collision can let a few
+extra requests through but never blocks anyone.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from flask import Blueprint, current_app, g, jsonify, request
+from sqlalchemy import text
+
+from models import db
+import metrics
+
+# endpoints, share of SERVER_CAPACITY that may run at once, tokens per
+# second per client, bucket size. Keep the shares' sum under 1.
+Group = namedtuple('Group', 'endpoints share rate burst')
+
+DEFAULT_GROUPS = {
+    'cart': Group(('add_to_cart', 'remove_from_cart'), 0.5, 2.0, 20),
+    'checkout': Group(('create_checkout_session',), 0.25, 0.2, 5),
+}
+
+SLOT_RANGE = 256  # lock bytes per group, so the most a group can be allowed
+BUCKETS = 16384
+BUCKET = struct.Struct('=Qdd')  # client hash, tokens, last refill (unix time)
+
+bp = Blueprint('admission', __name__)
+
+
+class SharedState:
+    """The admission file of this process: lock ranges, then the bucket table."""
+
+    def __init__(self, path, groups):
+        self.path = path
+        self.groups = sorted(groups)
+        self.table_offset = (len(self.groups) + 1) * SLOT_RANGE
+        self.size = self.table_offset + BUCKETS * BUCKET.size
+        self._pid = None
+
+    def _open(self):
+        # POSIX locks belong to a process and go when it closes any handle on
+        # the file, so each process opens the file once and keeps it
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._held = set()
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, self.size)
+            self._fd = fd
+            self._map = mmap.mmap(fd, self.size)
+            self._pid = os.getpid()
+
+    def acquire(self, group, limit):
+        """A concurrency slot of ``group``, or None if all ``limit`` are taken."""
+        self._open()
+        base = self.groups.index(group) * SLOT_RANGE
+        with self._lock:
+            # Locks don't exclude other threads of this process, so skip the
+            # bytes they hold
+            for offset in range(base, base + min(limit, SLOT_RANGE)):
+                if offset in self._held:
+                    continue
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                except OSError:
+                    continue
+                self._held.add(offset)
+                return offset
+        return None
+
+    def release(self, offset):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+            self._held.discard(offset)
+
+    def take_token(self, key, rate, burst):
+        """Seconds until ``key`` may retry, or 0 after taking one of its tokens."""
+        self._open()
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+        position = self.table_offset + (digest % BUCKETS) * BUCKET.size
+        with self._lock:
+            # The last byte before the table guards it
+            mutex = self.table_offset - 1
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, mutex)
+            try:
+                owner, tokens, updated = BUCKET.unpack_from(self._map, position)
+                now = time.time()
+                if owner != digest:
+                    tokens = burst
+                else:
+                    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                BUCKET.pack_into(self._map, position, digest, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, mutex)
+        return wait
+
+
+def client_address():
+    """The client's address, after ``ADMISSION_PROXIES`` X-Forwarded-For hops."""
+    hops = current_app.config['ADMISSION_PROXIES']
+    if hops:
+        forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',')]
+        if len(forwarded) >= hops and forwarded[-hops]:
+            return forwarded[-hops]
+    return request.remote_addr or 'unknown'
+
+
+def limit(group):
+    """How many requests of ``group`` may run at once, or None for no limit."""
+    capacity = current_app.config['SERVER_CAPACITY']
+    if not capacity:
+        return None
+    return max(1, int(capacity * current_app.config['ADMISSION_GROUPS'][group].share))
+
+
+def check_groups(groups):
+    """Raise ValueError unless the groups leave part of the server to the other routes."""
+    total = sum(group.share for group in groups.values())
+    if total >= 1:
+        raise ValueError('ADMISSION_GROUPS shares add up to %.2f; they must stay under 1' % total)
+
+
+def _reject(status, group, reason, retry_after, message):
+    metrics.inc('admission_rejected_total', group=group, reason=reason)
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def _admit():
+    config = current_app.config
+    group = config['ADMISSION_ENDPOINTS'].get(request.endpoint)
+    if group is None or not config['ADMISSION_ENABLED']:
+        return None
+    state = current_app.extensions['admission']
+    spec = config['ADMISSION_GROUPS'][group]
+
+    # The slot first, so a request turned away for load costs the client no token
+    slots = limit(group)
+    if slots is not None:
+        slot = state.acquire(group, slots)
+        if slot is None:
+            return _reject(503, group, 'concurrency', config['ADMISSION_RETRY_AFTER'],
+                           'The shop is very busy right now. Please try again in a moment.')
+        g.admission_slot = slot
+    wait = state.take_token('%s %s' % (group, client_address()), spec.rate, spec.burst)
+    if wait:
+        # teardown_request hands back the slot
+        return _reject(429, group, 'rate', wait, 'Too many requests. Please try again in a moment.')
+    return None
+
+
+def _release(exc):
+    slot = g.pop('admission_slot', None)
+    if slot is not None:
+        current_app.extensions['admission'].release(slot)
+
+
+@bp.route('/healthz')
+def health():
+    try:
+        db.session.execute(text('SELECT 1'))
+    except Exception:
+        current_app.logger.exception('Health check failed')
+        return jsonify({'status': 'unavailable'}), 503
+    return jsonify({'status': 'ok'})
+
+
+def init_app(app):
+    app.config.setdefault('ADMISSION_ENABLED', os.environ.get('ADMISSION_ENABLED', '1') != '0')
+    app.config.setdefault('ADMISSION_GROUPS', DEFAULT_GROUPS)
+    check_groups(app.config['ADMISSION_GROUPS'])
+    capacity = os.environ.get('SERVER_CAPACITY')
+    app.config.setdefault('SERVER_CAPACITY', int(capacity) if capacity else None)
+    app.config.setdefault('ADMISSION_PROXIES', int(os.environ.get('ADMISSION_PROXIES',
+                                                                  1 if 'DYNO' in os.environ else 0)))
+    app.config.setdefault('ADMISSION_RETRY_AFTER', 2)
+    app.config.setdefault('ADMISSION_STATE_FILE', os.environ.get('ADMISSION_STATE_FILE')
+                          or os.path.join(app.instance_path, 'admission.state'))
+    app.config['ADMISSION_ENDPOINTS'] = {endpoint: name for name, group in app.config['ADMISSION_GROUPS'].items()
+                                         for endpoint in group.endpoints}
+    app.extensions['admission'] = SharedState(app.config['ADMISSION_STATE_FILE'], app.config['ADMISSION_GROUPS'])
+    app.register_blueprint(bp)
+    app.before_request(_admit)
+    app.teardown_request(_release)
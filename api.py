@@ -0,0 +1,189 @@
+"""Catalog JSON API: /api/products and /api/playlist.
+
+Both endpoints answer conditional GETs from the catalog version (see
+cache.py), so a client polling an unchanged catalog gets a bodiless 304
+without the catalog being queried; checking the version is a cached
+single-row read. The version doesn't move for every sale (see
+inventory.py), so products carry ``in_stock`` rather than a unit count.
+Lists are paged by id: a page holds at most ``limit`` rows after
+``after``, and a ``Link: <...>; rel="next"`` header points at the next page
+while there is one. ``fields`` picks the attributes to return and a few
+filters narrow the rows:
+
+    /api/playlist?is_release=true&fields=id,title,url&limit=50&after=1200
+"""
+import json
+
+import sqlalchemy as sa
+from flask import Blueprint, current_app, jsonify, request, url_for
+
+from models import db, Product, Track
+from cache import response_cache
+from database import reads_from_replica
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib encoder gives the same output, slower
+    orjson = None
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+# Public field name -> column. The first four/five are the default fields,
+# matching what these endpoints have always returned.
+PRODUCT_FIELDS = {
+    'id': Product.id,
+    'name': Product.name,
+    'price': Product.price,
+    'image': Product.image_url,
+    'description': Product.description,
+    'category': Product.category,
+    # The catalog version tracks sell-outs and restocks, not every sale
+    'in_stock': sa.type_coerce(sa.func.coalesce(Product.stock, 0) > 0, sa.Boolean),
+}
+PRODUCT_DEFAULT_FIELDS = ('id', 'name', 'price', 'image')
+
+TRACK_FIELDS = {
+    'id': Track.id,
+    'title': Track.title,
+    'artist': Track.artist,
+    'cover': Track.cover_url,
+    'url': Track.audio_url,
+    'source_type': Track.source_type,
+    'featured': Track.featured,
+    'is_release': Track.is_release,
+}
+TRACK_DEFAULT_FIELDS = ('id', 'title', 'artist', 'cover', 'url')
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+
+class BadQuery(ValueError):
+    pass
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def json_response(value):
+    return current_app.response_class(dumps(value), mimetype='application/json')
+
+
+@bp.errorhandler(BadQuery)
+def bad_query(error):
+    return jsonify({'error': str(error)}), 400
+
+
+def int_arg(name, default, minimum=0, maximum=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise BadQuery('%s must be an integer' % name)
+    if value < minimum or (maximum is not None and value > maximum):
+        raise BadQuery('%s must be between %d and %s' % (name, minimum, maximum or 'any'))
+    return value
+
+
+def float_arg(name, minimum=0):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        value = float(value)
+    except ValueError:
+        raise BadQuery('%s must be a number' % name)
+    # Also rejects nan
+    if not minimum <= value < float('inf'):
+        raise BadQuery('%s must be at least %s' % (name, minimum))
+    return value
+
+
+def bool_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise BadQuery('%s must be true or false' % name)
+
+
+def field_arg(available, default):
+    value = request.args.get('fields')
+    if not value:
+        return list(default)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        raise BadQuery('unknown fields: %s (available: %s)' % (', '.join(unknown), ', '.join(available)))
+    return list(dict.fromkeys(fields))
+
+
+def keyset_page(model, available, default_fields, criteria):
+    """One page of ``model`` rows as dicts, plus the Link header for the next page."""
+    fields = field_arg(available, default_fields)
+    after = int_arg('after', 0)
+    limit = int_arg('limit', DEFAULT_LIMIT, minimum=1, maximum=MAX_LIMIT)
+
+    # Only the selected columns are loaded, as plain tuples; the id always
+    # comes along for the cursor
+    rows = (db.session.query(model.id, *[available[field] for field in fields])
+            .filter(model.id > after, *criteria)
+            .order_by(model.id)
+            .limit(limit + 1)
+            .all())
+    items = [dict(zip(fields, row[1:])) for row in rows[:limit]]
+
+    link = None
+    if len(rows) > limit:
+        args = request.args.to_dict()
+        args['after'] = rows[limit - 1][0]
+        link = '<%s>; rel="next"' % url_for(request.endpoint, _external=True, **args)
+    return items, link
+
+
+def page_response(items, link):
+    response = json_response(items)
+    if link:
+        response.headers['Link'] = link
+    return response
+
+
+@bp.route('/products')
+@response_cache.conditional
+@response_cache.cached()
+@reads_from_replica
+def products():
+    criteria = []
+    if request.args.get('category'):
+        criteria.append(Product.category == request.args['category'])
+    in_stock = bool_arg('in_stock')
+    if in_stock is not None:
+        criteria.append(Product.stock > 0 if in_stock else Product.stock <= 0)
+    return page_response(*keyset_page(Product, PRODUCT_FIELDS, PRODUCT_DEFAULT_FIELDS, criteria))
+
+
+@bp.route('/playlist')
+@response_cache.conditional
+@response_cache.cached()
+@reads_from_replica
+def playlist():
+    criteria = []
+    for name in ('featured', 'is_release'):
+        value = bool_arg(name)
+        if value is not None:
+            criteria.append(getattr(Track, name) == value)
+    if request.args.get('artist'):
+        criteria.append(Track.artist == request.args['artist'])
+    return page_response(*keyset_page(Track, TRACK_FIELDS, TRACK_DEFAULT_FIELDS, criteria))
+
+
+def init_app(app):
+    app.register_blueprint(bp)
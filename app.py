@@ -1,8 +1,30 @@
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for, send_from_directory
+from flask import Flask, abort, render_template, jsonify, request, session, redirect, url_for, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
-from models import db, Product, Track
+from sqlalchemy.orm import selectinload
+from models import db, Product, ProductImage, Track
+import admission
+import api
+import audio
+import admin
+import carts
+import catalog
+import database
+import jobs
+import inventory
+import metrics
+import orders
+import pages
+import profiler
+import search
+import webhooks
+import stripe_client
+import stripe_catalog
+from cache import response_cache
+from pricing import catalog_snapshot, price_cart
+import images
+from assets import asset_manifest
 import os
-from werkzeug.utils import secure_filename
+import time
 import stripe
 from dotenv import load_dotenv
 
@@ -17,20 +39,30 @@ app.config['STRIPE_PUBLISHABLE_KEY'] = os.environ.get('STRIPE_PUBLISHABLE_KEY')
 # Make sure instance path exists
 os.makedirs(app.instance_path, exist_ok=True)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(app.instance_path, 'delus.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = database.database_url(
+    os.environ.get('DATABASE_URL'), 'sqlite:///' + os.path.join(app.instance_path, 'delus.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-UPLOAD_FOLDER = 'static/music'
-ALLOWED_EXTENSIONS = {'wav', 'mp3'}
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
 # Initialize database
 db.init_app(app)
-
-# Create tables
-with app.app_context():
-    db.create_all()
+database.init_app(app)
+metrics.init_app(app)
+admission.init_app(app)
+carts.init_app(app)
+pages.init_app(app)
+response_cache.init_app(app)
+images.init_app(app)
+api.init_app(app)
+search.init_app(app)
+audio.init_app(app)
+asset_manifest.init_app(app)
+jobs.init_app(app)
+stripe_client.init_app(app)
+stripe_catalog.init_app(app)
+admin.init_app(app)
+orders.init_app(app)
+profiler.init_app(app)
+catalog.init_app(app)
 
 def create_sample_data():
     # Check if we already have products
@@ -86,6 +118,38 @@ def create_sample_data():
                 stock=20
             )
         ]
+        # Carousel photos, in order; the first is the product's main image
+        carousels = [
+            [('images/hats/DSC09089.jpg', 'Delus Trucker Hat - Front'),
+             ('images/hats/DSC09093.jpg', 'Delus Trucker Hat - Side'),
+             ('images/hats/DSC09098.jpg', 'Delus Trucker Hat - Back'),
+             ('images/hats/DSC09102.jpg', 'Delus Trucker Hat - Detail')],
+            [('images/hats/DSC09203.JPG', 'Delus Trucker II - Front'),
+             ('images/hats/DSC09205.JPG', 'Delus Trucker II - Side'),
+             ('images/hats/DSC09215.JPG', 'Delus Trucker II - Back'),
+             ('images/hats/DSC09221.JPG', 'Delus Trucker II - Detail')],
+            [('images/hats/DSC09114.JPG', 'Product 3'),
+             ('images/hats/DSC09118.JPG', 'Product 3 - View 2'),
+             ('images/hats/DSC09122.JPG', 'Product 3 - View 3'),
+             ('images/hats/DSC09128.JPG', 'Product 3 - View 4')],
+            [('images/hats/DSC09155.JPG', 'Product 4'),
+             ('images/hats/DSC09160.JPG', 'Product 4 - View 2'),
+             ('images/hats/DSC09165.JPG', 'Product 4 - View 3'),
+             ('images/hats/DSC09170.JPG', 'Product 4 - View 4')],
+            [('images/hats/DSC09180.JPG', 'Product 5'),
+             ('images/hats/DSC09183.JPG', 'Product 5 - View 2'),
+             ('images/hats/DSC09190.JPG', 'Product 5 - View 3'),
+             ('images/hats/DSC09195.JPG', 'Product 5 - View 4')],
+            [('images/hats/DSC09135.jpg', 'Product 6'),
+             ('images/hats/DSC09136.jpg', 'Product 6 - View 2'),
+             ('images/hats/DSC09139.JPG', 'Product 6 - View 3'),
+             ('images/hats/DSC09147.jpg', 'Product 6 - View 4')],
+        ]
+        for product, photos in zip(products, carousels):
+            product.images = [ProductImage(filename=filename, alt=alt, position=position, is_primary=position == 0)
+                              for position, (filename, alt) in enumerate(photos)]
+            for image in product.images:
+                images.describe(image)
         for product in products:
             db.session.add(product)
         
@@ -142,124 +206,104 @@ def reset_db():
         db.drop_all()
         # Create all tables
         db.create_all()
+        # drop_all bypasses the session events, so clear cached pages here
+        response_cache.invalidate()
         # Add sample data
         create_sample_data()
 
-# Call create_sample_data after db.create_all()
-with app.app_context():
-    db.create_all()
+# Nothing touches the database at import: the schema comes from
+# `flask db upgrade` and the sample catalog from `flask seed`
+@app.cli.command('seed')
+def seed_command():
+    """Add the sample products and tracks to an empty database."""
     create_sample_data()
 
-# Initialize session-based cart
-@app.before_request
-def initialize_cart():
-    if 'cart' not in session:
-        session['cart'] = []
-    # Clear any old cart format data to ensure consistency
-    elif session['cart'] and isinstance(session['cart'][0], dict) and 'name' in session['cart'][0]:
-        # This is old format cart data, clear it
-        session['cart'] = []
+@app.cli.command('reset-db')
+def reset_db_command():
+    """Drop every table, recreate the schema and reseed it."""
+    reset_db()
+
+def warm_up():
+    """Fill this process's caches before it takes traffic."""
+    try:
+        with app.app_context():
+            for name in app.jinja_env.list_templates(extensions=['html']):
+                app.jinja_env.get_template(name)
+            catalog_snapshot.get_many([product_id for (product_id,) in db.session.query(Product.id)])
+            db.session.remove()
+        # Pre-renders the policy pages. The home page has absolute URLs in
+        # it, so it is only cached ahead of time for the public host
+        # (SITE_URL); rendering it also loads the image metadata behind its
+        # srcset attributes.
+        client = app.test_client()
+        for path in ('/shipping', '/returns', '/contact'):
+            client.get(path)
+        if app.config.get('SITE_URL'):
+            client.get('/', base_url=app.config['SITE_URL'])
+    except Exception:
+        app.logger.exception('Warm-up failed; serving cold')
+
+def create_app(warm=None):
+    """WSGI entry point for gunicorn.
+
+    With preload_app the warm-up runs once in the gunicorn master, so every
+    forked worker, including ones recycled by max_requests, starts warm.
+    Set WARM_UP=0 to skip it.
+    """
+    if warm is None:
+        warm = os.environ.get('WARM_UP', '1') != '0'
+    if warm:
+        warm_up()
+    # Fork with empty pools; each worker opens its own connections
+    database.dispose_engines(app)
+    return app
 
 @app.route('/')
+@response_cache.cached(vary=carts.count)
+@database.reads_from_replica
 def home():
-    featured_products = Product.query.limit(4).all()
+    # The collection grid, photos included, in two queries; /products lists the rest
+    featured_products = (Product.query.options(selectinload(Product.images))
+                         .order_by(Product.id).limit(6).all())
     featured_track = Track.query.filter_by(featured=True).first()
     releases = Track.query.filter_by(is_release=True).all()
+    uploads = (Track.query.filter_by(source_type='local', processing_status='ready')
+               .order_by(Track.id.desc()).limit(6).all())
     return render_template('index.html', 
                          products=featured_products, 
                          featured_track=featured_track,
-                         releases=releases)
-
-@app.route('/api/products')
-def get_products():
-    products = Product.query.all()
-    return jsonify([{
-        'id': p.id,
-        'name': p.name,
-        'price': p.price,
-        'image': p.image_url
-    } for p in products])
-
-@app.route('/api/playlist')
-def get_playlist():
-    tracks = Track.query.all()
-    return jsonify([{
-        'id': t.id,
-        'title': t.title,
-        'artist': t.artist,
-        'cover': t.cover_url,
-        'url': t.audio_url
-    } for t in tracks])
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-@app.route('/upload-track', methods=['POST'])
-def upload_track():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
-    
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        
-        new_track = Track(
-            title=request.form.get('title', 'Untitled'),
-            artist=request.form.get('artist', 'Unknown'),
-            cover_url=request.form.get('cover_url', 'default-cover.jpg'),
-            source_type='local',
-            source_url=f'music/{filename}'
-        )
-        db.session.add(new_track)
-        db.session.commit()
-        
-        return jsonify({'message': 'Track uploaded successfully'})
-    
-    return jsonify({'error': 'File type not allowed'}), 400
+                         releases=releases,
+                         uploads=uploads)
+
+@app.route('/api/cache-stats')
+def cache_stats():
+    return jsonify(response_cache.stats())
 
 @app.route('/add-to-cart/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
-    product = Product.query.get_or_404(product_id)
+    row = catalog_snapshot.get_many([product_id]).get(product_id)
+    if row is None:
+        abort(404)
     quantity = int(request.form.get('quantity', 1))
     
-    # Check stock availability
-    if product.stock < quantity:
+    if quantity < 1:
+        return jsonify({'error': 'Quantity must be at least 1'}), 400
+    
+    # Take the units out of stock atomically; this can't oversell even with
+    # several workers handling the same drop
+    if not inventory.reserve(product_id, carts.cart_id(create=True), quantity):
+        available_stock = db.session.query(Product.stock).filter_by(id=product_id).scalar()
         return jsonify({
             'error': 'Not enough stock available',
-            'available_stock': product.stock
+            'available_stock': available_stock
         }), 400
     
-    if 'cart' not in session:
-        session['cart'] = []
-    
-    # Map product ID to correct image URL (the first image from carousel)
-    product_images = {
-        1: 'images/hats/DSC09089.jpg',
-        2: 'images/hats/DSC09203.JPG',
-        3: 'images/hats/DSC09114.JPG',
-        4: 'images/hats/DSC09155.JPG',
-        5: 'images/hats/DSC09180.JPG',
-        6: 'images/hats/DSC09135.jpg'
-    }
-    
     # Check if product already in cart
-    cart = session['cart']
+    cart = [dict(item) for item in carts.items()]
     item_found = False
-    current_cart_quantity = 0
     
     for item in cart:
         if item['product_id'] == product_id:
-            current_cart_quantity = item['quantity']
-            # Check if adding more would exceed stock
-            if current_cart_quantity + quantity > product.stock:
-                return jsonify({
-                    'error': f'Only {product.stock - current_cart_quantity} more items available',
-                    'available_stock': product.stock - current_cart_quantity
-                }), 400
             item['quantity'] += quantity
             item_found = True
             break
@@ -270,64 +314,36 @@ def add_to_cart(product_id):
             'quantity': quantity
         })
     
-    session['cart'] = cart
+    carts.save(cart)
     return jsonify({
         'success': True,
         'message': 'Product added to cart',
         'cart_total': len(cart),
         'product': {
-            'name': product.name,
-            'price': float(product.price),
-            'image_url': product_images.get(product_id, product.image_url)
+            'name': row.name,
+            'price': row.unit_amount / 100,
+            'image_url': row.image_url,
+            'thumbnail_url': (images.product_image_url(row.image, 160) if row.image
+                              else images.image_url(row.image_url, 160) if row.image_url else None)
         }
     })
 
 @app.route('/cart')
 def cart():
-    cart_items = session.get('cart', [])
-    cart_products = []
-    total = 0
-    
-    # Map product ID to correct image URL (the first image from carousel)
-    product_images = {
-        1: 'images/hats/DSC09089.jpg',
-        2: 'images/hats/DSC09203.JPG',
-        3: 'images/hats/DSC09114.JPG',
-        4: 'images/hats/DSC09155.JPG',
-        5: 'images/hats/DSC09180.JPG',
-        6: 'images/hats/DSC09135.jpg'
-    }
-    
-    if cart_items:
-        for cart_item in cart_items:
-            # Fetch current product data from database
-            product = Product.query.get(cart_item['product_id'])
-            if product:
-                item_total = product.price * cart_item['quantity']
-                total += item_total
-                
-                cart_products.append({
-                    'id': product.id,
-                    'name': product.name,
-                    'price': product.price,
-                    'quantity': cart_item['quantity'],
-                    'image_url': product_images.get(product.id, product.image_url),
-                    'item_total': item_total
-                })
-    
-    return render_template('cart.html', cart=cart_products, total=total)
+    quote = price_cart(carts.items())
+    return render_template('cart.html', cart=quote.lines, total=quote.total)
 
 @app.route('/shipping')
 def shipping():
-    return render_template('shipping.html')
+    return pages.serve('shipping.html')
 
 @app.route('/returns')
 def returns():
-    return render_template('returns.html')
+    return pages.serve('returns.html')
 
 @app.route('/contact')
 def contact():
-    return render_template('contact.html')
+    return pages.serve('contact.html')
 
 @app.route('/sitemap.xml')
 def sitemap():
@@ -343,61 +359,50 @@ def favicon():
 
 @app.route('/clear-cart')
 def clear_cart():
-    session['cart'] = []
+    if carts.cart_id():
+        inventory.release_cart(carts.cart_id())
+    carts.clear()
     return redirect(url_for('home'))
 
 @app.route('/reset-db')
 def reset_database():
     reset_db()
-    session['cart'] = []
+    session.pop('cart_id', None)
     return "Database reset and cart cleared!"
 
 @app.route('/remove-from-cart/<int:product_id>', methods=['POST'])
 def remove_from_cart(product_id):
-    if 'cart' in session:
-        cart = session['cart']
-        session['cart'] = [item for item in cart if item['product_id'] != product_id]
+    if carts.cart_id():
+        carts.save([item for item in carts.items() if item['product_id'] != product_id])
+        inventory.release_cart(carts.cart_id(), product_id)
     return redirect(url_for('cart'))
 
 @app.route('/create-checkout-session', methods=['POST'])
 def create_checkout_session():
     try:
-        cart = session.get('cart', [])
+        cart = carts.items()
         
         if not cart:
             return jsonify({'error': 'Your cart is empty'}), 400
         
-        # Map product ID to correct image URL
-        product_images = {
-            1: 'images/hats/DSC09089.jpg',
-            2: 'images/hats/DSC09203.JPG',
-            3: 'images/hats/DSC09114.JPG',
-            4: 'images/hats/DSC09155.JPG',
-            5: 'images/hats/DSC09180.JPG',
-            6: 'images/hats/DSC09135.jpg'
-        }
+        # Carts from before reservations, or whose holds lapsed, are re-held here
+        short = inventory.ensure_held(carts.cart_id(create=True), cart)
+        if short:
+            return jsonify({
+                'error': 'Some items in your cart are no longer available',
+                'unavailable_product_ids': short
+            }), 409
         
-        line_items = []
-        for cart_item in cart:
-            # Fetch current product data from database
-            product = Product.query.get(cart_item['product_id'])
-            if product:
-                line_items.append({
-                    'price_data': {
-                        'currency': 'usd',
-                        'product_data': {
-                            'name': product.name,
-                            'images': [request.host_url + 'static/' + product_images.get(product.id, product.image_url)] if product_images.get(product.id) else [],
-                        },
-                        'unit_amount': int(product.price * 100),  # Stripe expects amounts in cents
-                    },
-                    'quantity': cart_item['quantity'],
-                })
+        quote = price_cart(cart)
+        line_items = stripe_catalog.checkout_line_items(quote.lines, request.host_url)
 
         checkout_session = stripe.checkout.Session.create(
             payment_method_types=['card'],
             line_items=line_items,
             mode='payment',
+            expires_at=int(time.time() + inventory.CHECKOUT_SESSION_TTL.total_seconds()),
+            # Lets the webhook map the order back to products without extra Stripe calls
+            metadata={'cart': webhooks.encode_cart_metadata(quote.lines) or ''},
             success_url=request.host_url + 'success?session_id={CHECKOUT_SESSION_ID}',
             cancel_url=request.host_url + 'cart',
             shipping_address_collection={
@@ -418,9 +423,11 @@ def create_checkout_session():
             ]
         )
         
-        # Clear the cart after successful checkout session creation
+        # Clear the cart after successful checkout session creation; its
+        # holds now belong to the Stripe session
         if checkout_session.id:
-            session['cart'] = []
+            inventory.attach_checkout(carts.cart_id(), checkout_session.id)
+            carts.clear()
             
         return jsonify({'id': checkout_session.id})
     except Exception as e:
@@ -431,16 +438,13 @@ def success():
     session_id = request.args.get('session_id')
     if session_id:
         try:
-            # Retrieve the checkout session to verify payment
-            checkout_session = stripe.checkout.Session.retrieve(session_id)
-            
-            # You could save order details to your database here
-            # customer_email = checkout_session.customer_details.email
-            # shipping_details = checkout_session.shipping
-            
-            return render_template('success.html', 
+            # The order recorded by the webhook, or Stripe's view of the
+            # session if the webhook hasn't been processed yet
+            receipt = orders.receipt(session_id)
+            return render_template('success.html',
                                   session_id=session_id,
-                                  customer_email=checkout_session.customer_details.email if hasattr(checkout_session, 'customer_details') else None)
+                                  customer_email=receipt.email,
+                                  receipt=receipt)
         except Exception as e:
             # Handle any errors
             return render_template('success.html', error=str(e))
@@ -464,38 +468,20 @@ def stripe_webhook():
         # Invalid signature
         return jsonify({'error': str(e)}), 400
 
-    # Handle the event
-    if event['type'] == 'checkout.session.completed':
-        checkout_session = event['data']['object']
-        
-        # Process the order and reduce inventory
-        try:
-            # Get line items from the checkout session
-            line_items = stripe.checkout.Session.list_line_items(checkout_session.id)
-            
-            for item in line_items['data']:
-                # You'll need to match Stripe line items to your products
-                # This is a simplified version - you might want to store product IDs in metadata
-                product_name = item['description']
-                quantity_purchased = item['quantity']
-                
-                # Find product by name (you might want to use a better matching method)
-                product = Product.query.filter_by(name=product_name).first()
-                if product:
-                    # Reduce stock
-                    product.stock = max(0, product.stock - quantity_purchased)
-                    db.session.commit()
-                    print(f"Reduced stock for {product.name}: {quantity_purchased} items. New stock: {product.stock}")
-            
-            print(f"Order completed for session: {checkout_session.id}")
-            
-        except Exception as e:
-            print(f"Error processing inventory: {str(e)}")
+    # Acknowledge fast; stock is updated by the job worker. The event id
+    # makes Stripe's retries of the same event a no-op.
+    if event['type'] in webhooks.HANDLED_EVENTS:
+        jobs.enqueue('stripe.event', event['id'], event.to_dict_recursive())
     
     return jsonify({'status': 'success'})
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    # Convenience for local runs; deploys use `flask db upgrade` and `flask seed`
+    with app.app_context():
+        db.create_all()
+        create_sample_data()
+    jobs.start_worker(app)
     app.run(debug=True, port=port)
 
 # reset_db()
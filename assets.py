@@ -0,0 +1,530 @@
+"""Fingerprinted static assets.
+
+``flask assets build`` copies every file under ``static/`` to
+``<name>.<hash>.<ext>`` in the asset build folder, with precompressed
+``.gz``/``.br`` siblings for text assets, and writes a manifest. Once the
+manifest exists, ``url_for('static', filename=...)`` emits the hashed names
+and the static endpoint serves them as immutable, picking the precompressed
+sibling from ``Accept-Encoding`` so no worker compresses per request.
+Files that are not in the manifest are served as before.
+
+The build also writes the per-page bundles in ``BUNDLES``: each page gets
+one minified stylesheet and one script instead of a file per section.
+Templates link them with ``stylesheets(name)`` and ``scripts(name)``, which
+fall back to the separate source files until a build exists. A template
+can mark the end of its first screen with ``{# fold #}``. Rules from its
+stylesheet bundle that match the markup above the marker are inlined as
+critical CSS, and the bundle itself loads without blocking rendering.
+HTML responses carry ``Link: rel=preload`` headers for the page's bundles
+and fonts, which a CDN can turn into 103 Early Hints.
+
+``flask assets icons`` writes css/icons.css and the fonts/ subsets of Font
+Awesome with only the icons the templates, scripts and stylesheets use.
+It needs the fonttools package; the generated files are committed, so the
+build and the app don't.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+import click
+from flask import current_app, g, request, send_file, url_for
+from flask.cli import AppGroup
+from markupsafe import Markup
+
+try:
+    import brotli
+except ImportError:  # .br siblings are skipped without the brotli package
+    brotli = None
+
+try:
+    from fontTools import subset as font_subset
+except ImportError:  # only `flask assets icons` needs it
+    font_subset = None
+
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.txt', '.xml', '.html', '.ico', '.map', '.webmanifest'}
+ONE_YEAR = 31536000
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)(?!data:|https?:|//|#|%23)([^'")]+)\1\s*\)''')
+
+# Bundle name -> source files under static/, in cascade order
+BUNDLES = {
+    'site.css': ['styles.css', 'css/icons.css'],
+    'home.css': ['styles.css', 'css/icons.css', 'css/hero.css', 'css/music.css',
+                 'css/record_label.css', 'css/carousel.css'],
+    'about.css': ['styles.css', 'css/icons.css', 'css/about.css'],
+    'music.css': ['styles.css', 'css/icons.css', 'css/music.css'],
+    'record_label.css': ['styles.css', 'css/icons.css', 'css/record_label.css'],
+    'home.js': ['js/music.js', 'js/smooth-scroll.js'],
+}
+FOLD_MARKER = '{# fold #}'
+STYLESHEETS_RE = re.compile(r'''stylesheets\(\s*['"]([^'"]+)['"]\s*\)''')
+ICON_RE = re.compile(r'\bfa-[a-z0-9-]+')
+
+assets_cli = AppGroup('assets', help='Fingerprinted static assets.')
+
+
+class AssetManifest:
+    def __init__(self, app=None):
+        self.assets = {}
+        self.hashed = {}
+        self.critical = {}
+        self.fonts = {}
+        self.build_dir = None
+        # endpoint -> Link header, for responses served without a render
+        self._links = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSET_BUILD_DIR', os.path.join(app.instance_path, 'assets'))
+        self.build_dir = app.config['ASSET_BUILD_DIR']
+        self.load()
+
+        app.url_defaults(self._rewrite_static_url)
+        self._send_static_file = app.view_functions['static']
+        app.view_functions['static'] = self.serve
+        app.after_request(self._add_preload_links)
+        app.jinja_env.globals.update(stylesheets=self.stylesheets, scripts=self.scripts)
+        app.extensions['asset_manifest'] = self
+        app.cli.add_command(assets_cli)
+
+    def load(self):
+        try:
+            with open(os.path.join(self.build_dir, 'manifest.json')) as f:
+                manifest = json.load(f)
+            self.assets = manifest['assets']
+        except (OSError, ValueError, KeyError):
+            manifest, self.assets = {}, {}
+        self.critical = manifest.get('critical', {})
+        self.fonts = manifest.get('fonts', {})
+        self.hashed = {hashed: name for name, hashed in self.assets.items()}
+        self._links = {}
+
+    def _bundle_urls(self, name, kind):
+        bundle = 'bundles/' + name
+        if bundle not in self.assets:
+            return [url_for('static', filename=filename) for filename in BUNDLES[name]]
+        url = url_for('static', filename=bundle)
+        self._preload(url, kind)
+        for font in self.fonts.get(name, ()):
+            self._preload(url_for('static', filename=font), 'font')
+        return [url]
+
+    def _preload(self, url, kind):
+        g.setdefault('preload_links', []).append('<%s>; rel=preload; as=%s%s'
+                                                 % (url, kind, '; crossorigin' if kind == 'font' else ''))
+
+    def stylesheets(self, name):
+        """<link>s for a stylesheet bundle, with its critical CSS inlined if the build made any."""
+        urls = self._bundle_urls(name, 'style')
+        if name in self.critical:
+            url = urls[0]
+            return Markup('<style>%s</style>'
+                          '<link rel="preload" href="%s" as="style" onload="this.onload=null;this.rel=\'stylesheet\'">'
+                          '<noscript><link rel="stylesheet" href="%s"></noscript>') % (
+                              Markup(self.critical[name]), url, url)
+        return Markup('').join(Markup('<link rel="stylesheet" href="%s">') % url for url in urls)
+
+    def scripts(self, name):
+        """<script>s for a script bundle."""
+        urls = self._bundle_urls(name, 'script')
+        return Markup('').join(Markup('<script src="%s"></script>') % url for url in urls)
+
+    def _add_preload_links(self, response):
+        if response.status_code != 200 or response.mimetype != 'text/html':
+            return response
+        links = g.get('preload_links')
+        if links:
+            self._links[request.endpoint] = ', '.join(links)
+        # Cached and pre-rendered pages skip the template, so reuse what
+        # the endpoint's last render linked
+        link = self._links.get(request.endpoint)
+        if link and 'Link' not in response.headers:
+            response.headers['Link'] = link
+        return response
+
+    def _rewrite_static_url(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = self.assets.get(values['filename'], values['filename'])
+
+    def serve(self, filename):
+        if filename not in self.hashed:
+            return self._send_static_file(filename=filename)
+
+        path = os.path.join(self.build_dir, filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[candidate] and os.path.exists(path + suffix):
+                encoding, path = candidate, path + suffix
+                break
+
+        response = send_file(path, mimetype=mimetype, conditional=True, max_age=ONE_YEAR)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        if encoding:
+            response.content_encoding = encoding
+        if os.path.splitext(filename)[1] in COMPRESSIBLE:
+            response.vary.add('Accept-Encoding')
+        return response
+
+
+asset_manifest = AssetManifest()
+
+
+def hashed_name(filename, data):
+    root, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (root, hashlib.sha256(data).hexdigest()[:12], ext)
+
+
+def _css_refs(filename, css):
+    """(match, static path, query/fragment) for each local url() in a stylesheet."""
+    base = os.path.dirname(filename)
+    for match in CSS_URL_RE.finditer(css):
+        ref = match.group(2)
+        path, sep, rest = ref.partition('?') if '?' in ref else ref.partition('#')
+        yield match, os.path.normpath(os.path.join(base, path)).replace(os.sep, '/'), sep + rest
+
+
+def _rewrite_css_urls(filename, css, assets, into=None):
+    """Point url()s at the hashed files, relative to ``into`` (default: the stylesheet's folder)."""
+    base = os.path.dirname(filename) if into is None else into
+    out = []
+    position = 0
+    for match, target, suffix in _css_refs(filename, css):
+        if target not in assets and into is None:
+            continue
+        new = os.path.relpath(assets.get(target, target), base or '.').replace(os.sep, '/')
+        quote = match.group(1)
+        out.append(css[position:match.start()])
+        out.append('url(%s%s%s%s)' % (quote, new, suffix, quote))
+        position = match.end()
+    out.append(css[position:])
+    return ''.join(out)
+
+
+_CSS_STRING = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''')
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_CSS_SPACE = re.compile(r'\s+')
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+_CSS_COLON = re.compile(r':\s+')
+
+
+def minify_css(css):
+    """Drop comments and the whitespace CSS doesn't need, leaving strings alone."""
+    parts = _CSS_STRING.split(_CSS_COMMENT.sub('', css))
+    for i in range(0, len(parts), 2):
+        text = _CSS_SPACE.sub(' ', parts[i])
+        text = _CSS_PUNCTUATION.sub(r'\1', text)
+        parts[i] = _CSS_COLON.sub(':', text)
+    return ''.join(parts).replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """Drop indentation, blank lines and whole-line // comments.
+
+    Only whitespace at line ends goes, so no statement can change meaning;
+    lines inside template literals are kept as they are.
+    """
+    out = []
+    in_template = False
+    for line in js.splitlines():
+        if in_template:
+            out.append(line)
+        else:
+            stripped = line.strip()
+            if stripped and not stripped.startswith('//'):
+                out.append(stripped)
+        if (line.count('`') - line.count('\\`')) % 2:
+            in_template = not in_template
+    return '\n'.join(out)
+
+
+def _css_blocks(css):
+    """Split minified CSS into top-level (prelude, body) pairs."""
+    blocks = []
+    depth = 0
+    start = 0
+    prelude = None
+    for i, char in enumerate(css):
+        if char == '{':
+            if depth == 0:
+                prelude, start = css[start:i], i + 1
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                blocks.append((prelude.strip(), css[start:i]))
+                start = i + 1
+    return blocks
+
+
+_PSEUDO = re.compile(r'::?[\w-]+(\([^)]*\))?|\[[^\]]*\]')
+_SIMPLE = re.compile(r'([.#]?)(-?[_a-zA-Z][\w-]*|\*)')
+
+
+def _selector_matches(selector, tags, classes, ids):
+    names = {'': tags, '.': classes, '#': ids}
+    for prefix, name in _SIMPLE.findall(_PSEUDO.sub(' ', selector)):
+        if name != '*' and name.lower() not in names[prefix]:
+            return False
+    return True
+
+
+def critical_css(css, markup):
+    """The rules of a minified stylesheet whose selectors match the given markup."""
+    tags = {tag.lower() for tag in re.findall(r'<([a-zA-Z][\w-]*)', markup)} | {'html', 'body', ':root'}
+    classes = set()
+    for value in re.findall(r'class="([^"]*)"', markup):
+        classes.update(word.lower() for word in re.findall(r'[\w-]+', value))
+    ids = {value.lower() for value in re.findall(r'id="([^"{]*)"', markup)}
+
+    out = []
+    for prelude, body in _css_blocks(css):
+        if prelude.startswith('@media') or prelude.startswith('@supports'):
+            inner = critical_css(body, markup)
+            if inner:
+                out.append('%s{%s}' % (prelude, inner))
+        elif prelude.startswith('@font-face'):
+            out.append('%s{%s}' % (prelude, body))
+        elif prelude.startswith('@'):
+            continue  # keyframes and the like arrive with the full bundle
+        else:
+            selectors = [selector for selector in prelude.split(',')
+                         if selector.startswith(':root') or _selector_matches(selector, tags, classes, ids)]
+            if selectors:
+                out.append('%s{%s}' % (','.join(selectors), body))
+    return ''.join(out)
+
+
+def _above_the_fold(template_folder):
+    """{stylesheet bundle: [markup above the fold]}, for bundles whose every page marks a fold."""
+    pages = {}
+    for root, dirs, files in os.walk(template_folder):
+        for name in sorted(files):
+            with open(os.path.join(root, name), encoding='utf-8') as f:
+                source = f.read()
+            for bundle in STYLESHEETS_RE.findall(source):
+                head, marker, _ = source.partition(FOLD_MARKER)
+                pages.setdefault(bundle, []).append(head if marker else None)
+    return {bundle: markups for bundle, markups in pages.items() if None not in markups}
+
+
+def _write_compressed(path, data):
+    gz = gzip.compress(data, 9, mtime=0)
+    if len(gz) < len(data) * 0.9:
+        with open(path + '.gz', 'wb') as f:
+            f.write(gz)
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data) * 0.9:
+            with open(path + '.br', 'wb') as f:
+                f.write(br)
+
+
+def _write_asset(build_dir, filename, data):
+    """Store a generated file under its hashed name and return that name."""
+    hashed = hashed_name(filename, data)
+    target = os.path.join(build_dir, hashed)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+        _write_compressed(target, data)
+    return hashed
+
+
+def build_bundles(static_folder, build_dir, assets, template_folder=None):
+    """Concatenate and minify BUNDLES into bundles/; return (assets, critical CSS, fonts)."""
+    folds = _above_the_fold(template_folder) if template_folder else {}
+    bundles = {}
+    critical = {}
+    fonts = {}
+    for name, sources in BUNDLES.items():
+        parts = []
+        for filename in sources:
+            with open(os.path.join(static_folder, filename), encoding='utf-8') as f:
+                text = f.read()
+            if name.endswith('.css'):
+                fonts.setdefault(name, []).extend(
+                    target for _, target, _ in _css_refs(filename, text)
+                    if target.endswith('.woff2') and target in assets and target not in fonts.get(name, ()))
+                parts.append(minify_css(_rewrite_css_urls(filename, text, assets, into='bundles')))
+            else:
+                parts.append(minify_js(text))
+        data = ('\n' if name.endswith('.css') else ';\n').join(parts)
+        bundles['bundles/' + name] = _write_asset(build_dir, 'bundles/' + name, data.encode('utf-8'))
+        if name in folds:
+            # The inlined rules sit in the page, so their url()s are made absolute
+            inline = critical_css(data, '\n'.join(folds[name]))
+            critical[name] = re.sub(r'''url\((['"]?)(\.\./[^'")]+)''',
+                                    lambda m: 'url(%s%s' % (m.group(1), posixpath.normpath(
+                                        posixpath.join('/static/bundles', m.group(2)))), inline)
+    return bundles, critical, {name: names for name, names in fonts.items() if names}
+
+
+def build(static_folder, build_dir, template_folder=None):
+    """Fingerprint everything under static_folder into build_dir; return the manifest."""
+    names = []
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        names.extend(os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+                     for name in sorted(files) if not name.startswith('.'))
+
+    assets = {}
+    # Stylesheets last, so their url() references can point at hashed names
+    for filename in sorted(names, key=lambda n: n.endswith('.css')):
+        source = os.path.join(static_folder, filename)
+        with open(source, 'rb') as f:
+            data = f.read()
+        if filename.endswith('.css'):
+            data = _rewrite_css_urls(filename, data.decode('utf-8'), assets).encode('utf-8')
+
+        hashed = hashed_name(filename, data)
+        target = os.path.join(build_dir, hashed)
+        assets[filename] = hashed
+        if os.path.exists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if filename.endswith('.css'):
+            with open(target, 'wb') as f:
+                f.write(data)
+        else:
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+        if os.path.splitext(filename)[1].lower() in COMPRESSIBLE:
+            _write_compressed(target, data)
+
+    bundles, critical, fonts = build_bundles(static_folder, build_dir, assets, template_folder)
+    assets.update(bundles)
+
+    # Old hashed files are kept so pages rendered by the previous release
+    # keep working during a rolling deploy; the manifest is swapped last
+    tmp = os.path.join(build_dir, 'manifest.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'assets': assets, 'critical': critical, 'fonts': fonts}, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(build_dir, 'manifest.json'))
+    return assets
+
+
+@assets_cli.command('build')
+def build_command():
+    """Hash, copy and precompress every file under static/, and build the bundles."""
+    template_folder = os.path.join(current_app.root_path, current_app.template_folder)
+    assets = build(current_app.static_folder, current_app.config['ASSET_BUILD_DIR'], template_folder)
+    asset_manifest.load()
+    click.echo('%d assets in %s' % (len(assets), current_app.config['ASSET_BUILD_DIR']))
+
+
+# (font file stem, family, weight, classes); subsets are cut from the .ttf sources
+ICON_FONTS = (('fa-solid-900', 'Font Awesome 6 Free', 900, ('fas', 'fa-solid')),
+              ('fa-brands-400', 'Font Awesome 6 Brands', 400, ('fab', 'fa-brands')))
+_ICON_GLYPH = re.compile(r'((?:\.fa-[\w-]+::?before,?\s*)+)\{\s*content:\s*"\\([0-9a-f]+)"')
+_FONT_RULE = re.compile(r'\{[^}]*Font Awesome[^}]*\}')
+_CSS_GLYPH = re.compile(r'''content:\s*['"]\\([0-9a-fA-F]{4,5})['"]''')
+
+
+def _default_icon_source():
+    try:
+        import fontawesomefree
+    except ImportError:
+        return None
+    return os.path.join(os.path.dirname(fontawesomefree.__file__), 'static', 'fontawesomefree')
+
+
+def _used_icons(template_folder, static_folder):
+    """(icon names, extra codepoints): fa-* names in templates and scripts, and
+    glyphs stylesheets set with ``content`` in Font Awesome rules."""
+    names = set()
+    codepoints = set()
+    for folder in (template_folder, static_folder):
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                if name == 'icons.css' or not name.endswith(('.html', '.js', '.css')):
+                    continue
+                with open(os.path.join(root, name), encoding='utf-8') as f:
+                    text = f.read()
+                if name.endswith('.css'):
+                    for rule in _FONT_RULE.findall(text):
+                        codepoints.update(int(code, 16) for code in _CSS_GLYPH.findall(rule))
+                else:
+                    names.update(ICON_RE.findall(text))
+    return names, codepoints
+
+
+@assets_cli.command('icons')
+@click.option('--source', default=_default_icon_source, type=click.Path(exists=True, file_okay=False),
+              help='Font Awesome Free 6 folder holding css/all.css and webfonts/ '
+                   '(default: the fontawesomefree package).')
+def icons_command(source):
+    """Subset Font Awesome to the icons in use, into static/fonts and css/icons.css."""
+    if font_subset is None:
+        raise click.ClickException('pip install fonttools brotli first.')
+    if source is None:
+        raise click.ClickException('Pass --source, or pip install fontawesomefree.')
+    with open(os.path.join(source, 'css', 'all.css'), encoding='utf-8') as f:
+        all_css = f.read()
+    glyphs = {}
+    for selectors, code in _ICON_GLYPH.findall(all_css):
+        for name in re.findall(r'\.(fa-[\w-]+)', selectors):
+            glyphs[name] = code
+
+    template_folder = os.path.join(current_app.root_path, current_app.template_folder)
+    names, codepoints = _used_icons(template_folder, current_app.static_folder)
+    icons = sorted(name for name in names if name in glyphs)
+    codepoints.update(int(glyphs[name], 16) for name in icons)
+    missing = sorted(name for name in names - set(glyphs)
+                     if not re.match(r'fa-(\d*x|\d*xs|sm|lg|xl|\d*xl|fw|solid|brands|regular)$', name))
+
+    fonts_dir = os.path.join(current_app.static_folder, 'fonts')
+    os.makedirs(fonts_dir, exist_ok=True)
+    css = ['''/*!
+ * Font Awesome Free 6 by @fontawesome - https://fontawesome.com
+ * License - https://fontawesome.com/license/free (Icons: CC BY 4.0, Fonts: SIL OFL 1.1, Code: MIT License)
+ * Subset by `flask assets icons`; edit the templates, not this file.
+ */
+.fas, .fa-solid, .fab, .fa-brands {
+  -moz-osx-font-smoothing: grayscale;
+  -webkit-font-smoothing: antialiased;
+  display: inline-block;
+  font-style: normal;
+  font-variant: normal;
+  line-height: 1;
+  text-rendering: auto;
+}
+''']
+    for stem, family, weight, classes in ICON_FONTS:
+        options = font_subset.Options()
+        options.flavor = 'woff2'
+        options.layout_features = []
+        font = font_subset.load_font(os.path.join(source, 'webfonts', stem + '.ttf'), options)
+        subsetter = font_subset.Subsetter(options)
+        subsetter.populate(unicodes=codepoints)
+        subsetter.subset(font)
+        font_subset.save_font(font, os.path.join(fonts_dir, stem + '.woff2'), options)
+        css.append('''@font-face {
+  font-family: '%s';
+  font-style: normal;
+  font-weight: %d;
+  font-display: block;
+  src: url("../fonts/%s.woff2") format("woff2");
+}
+%s {
+  font-family: '%s';
+  font-weight: %d;
+}
+''' % (family, weight, stem, ', '.join('.' + name for name in classes), family, weight))
+    css.extend('.%s::before { content: "\\%s"; }\n' % (name, glyphs[name]) for name in icons)
+    with open(os.path.join(current_app.static_folder, 'css', 'icons.css'), 'w', encoding='utf-8') as f:
+        f.write(''.join(css))
+
+    click.echo('%d icons, %d glyphs' % (len(icons), len(codepoints)))
+    for name in missing:
+        click.echo('not in Font Awesome Free: %s' % name, err=True)
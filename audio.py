@@ -0,0 +1,470 @@
+"""Track uploads and audio processing.
+
+``/upload-track`` streams the upload straight into a private master file
+under the instance folder, a chunk at a time and hashed on the way, and
+rejects it with 413 as soon as it passes ``AUDIO_MAX_UPLOAD`` bytes. It
+accepts the existing multipart form, or the raw file as the request body
+(``Content-Type: audio/*``, metadata in the query string), which clients
+can send without building a form.
+
+The request only records the Track and queues an ``audio.process`` job, on
+a queue of its own so a long transcode doesn't hold up webhook events. The
+job worker then uses ffmpeg to decode the master once for waveform peaks
+and the duration, transcode a low-bitrate AAC rendition for streaming, and
+cut a faded preview clip. The renditions go under static/music/<digest>/;
+the peaks are stored on the Track and served from
+``/audio/<id>/peaks.json`` for static/js/music.js.
+
+Players fetch ``/audio/<id>`` (and ``/audio/<id>/preview``), which serve
+byte ranges for seeking with sendfile(2) under gunicorn, or hand the file
+to nginx/Apache via X-Accel-Redirect/X-Sendfile (``AUDIO_DELIVERY``).
+
+ffmpeg comes from ``FFMPEG_BINARY``, the PATH, or the imageio-ffmpeg
+package, in that order.
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from array import array
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import Blueprint, abort, current_app, jsonify, request
+from flask.cli import AppGroup
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import safe_join, secure_filename
+from werkzeug.wsgi import wrap_file
+
+from models import db, Track
+import jobs
+
+try:
+    import imageio_ffmpeg
+except ImportError:  # optional; a system ffmpeg works just as well
+    imageio_ffmpeg = None
+
+AUDIO_EXTENSIONS = {'wav', 'mp3'}
+RAW_UPLOAD_TYPES = {'audio/wav', 'audio/x-wav', 'audio/wave', 'audio/mpeg', 'audio/mp3',
+                    'application/octet-stream'}
+CHUNK_SIZE = 1024 * 1024
+AUDIO_MIMETYPES = {'.m4a': 'audio/mp4', '.mp3': 'audio/mpeg', '.wav': 'audio/wav'}
+
+PEAK_RATE = 8000  # Hz; plenty for a waveform outline
+PEAK_BLOCK = PEAK_RATE // 100  # one maximum per 10 ms of audio
+PEAK_COUNT = 800
+
+bp = Blueprint('audio', __name__)
+audio_cli = AppGroup('audio', help='Track audio processing.')
+
+
+class MasterFile:
+    """A temporary file in the masters folder that hashes and caps what's written to it."""
+
+    def __init__(self, directory, limit):
+        self.file = tempfile.NamedTemporaryFile('wb+', dir=directory, prefix='upload-', delete=False)
+        self.name = self.file.name
+        self.limit = limit
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise RequestEntityTooLarge('Uploads are limited to %d MB' % (self.limit // (1024 * 1024)))
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.name):
+            os.unlink(self.name)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def extension_of(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def master_dir():
+    return current_app.config['AUDIO_MASTER_DIR']
+
+
+def receive_upload():
+    """Stream the request's audio into a MasterFile; returns (fields, MasterFile, filename)."""
+    limit = current_app.config['AUDIO_MAX_UPLOAD']
+    if request.content_length is not None and request.content_length > limit:
+        raise RequestEntityTooLarge()
+    os.makedirs(master_dir(), exist_ok=True)
+
+    if request.mimetype == 'multipart/form-data':
+        created = []
+
+        def stream_factory(total_content_length, content_type, filename, content_length=None):
+            created.append(MasterFile(master_dir(), limit))
+            return created[-1]
+
+        try:
+            _, form, files = parse_form_data(request.environ, stream_factory=stream_factory)
+        except Exception:
+            for master in created:
+                master.discard()
+            raise
+        upload = files.get('file')
+        for master in created:
+            if upload is None or master is not upload.stream:
+                master.discard()
+        if upload is None:
+            return form, None, ''
+        upload.stream.flush()
+        return form, upload.stream, upload.filename or ''
+
+    if request.mimetype not in RAW_UPLOAD_TYPES:
+        return request.args, None, ''
+    master = MasterFile(master_dir(), limit)
+    try:
+        while True:
+            chunk = request.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            master.write(chunk)
+        master.flush()
+    except Exception:
+        master.discard()
+        raise
+    return request.args, master, request.args.get('filename', '')
+
+
+def store_master(master, extension):
+    """Move a finished upload to its content-addressed name; returns that name."""
+    name = '%s.%s' % (master.sha256.hexdigest(), extension)
+    master.file.close()
+    # The same master uploaded twice ends up as one file
+    os.replace(master.name, os.path.join(master_dir(), name))
+    return name
+
+
+@bp.route('/upload-track', methods=['POST'])
+def upload_track():
+    fields, master, filename = receive_upload()
+    if master is None:
+        return jsonify({'error': 'No file part'}), 400
+    filename = secure_filename(filename)
+    if not filename or master.size == 0:
+        master.discard()
+        return jsonify({'error': 'No selected file'}), 400
+    if extension_of(filename) not in AUDIO_EXTENSIONS:
+        master.discard()
+        return jsonify({'error': 'File type not allowed'}), 400
+
+    track = Track(
+        title=fields.get('title', 'Untitled'),
+        artist=fields.get('artist', 'Unknown'),
+        cover_url=fields.get('cover_url', 'default-cover.jpg'),
+        source_type='local',
+        master_file=store_master(master, extension_of(filename)),
+        processing_status='pending',
+    )
+    db.session.add(track)
+    db.session.commit()
+    jobs.enqueue('audio.process', '%d@%s' % (track.id, track.master_file), {'track_id': track.id})
+
+    return jsonify({
+        'message': 'Track uploaded successfully; processing has started',
+        'track_id': track.id,
+        'status': track.processing_status,
+    }), 202
+
+
+@bp.route('/audio/<int:track_id>/peaks.json')
+def peaks(track_id):
+    track = db.session.get(Track, track_id)
+    if track is None or not track.waveform_peaks:
+        abort(404)
+    response = current_app.response_class(track.waveform_peaks, mimetype='application/json')
+    response.set_etag(hashlib.sha1(track.waveform_peaks.encode()).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request)
+
+
+def _audio_file(track_id, attribute):
+    track = db.session.get(Track, track_id)
+    relative = getattr(track, attribute, None) if track is not None and track.source_type == 'local' else None
+    if not relative:
+        abort(404)
+    path = safe_join(current_app.static_folder, relative)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return relative, path
+
+
+def _bounded(f, length, chunk_size=64 * 1024):
+    # For servers whose file_wrapper would read past the end of the range
+    try:
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def deliver(relative, path):
+    """Serve an audio file with conditional GET and single-range (206) support.
+
+    In the default 'sendfile' mode the body is the server's
+    ``wsgi.file_wrapper`` around a file already seeked to the range start,
+    with an exact Content-Length, so gunicorn hands the range to the kernel
+    with sendfile(2) instead of copying it through Python. 'x-accel' and
+    'x-sendfile' leave the bytes, and the Range handling, to a front proxy.
+    """
+    mode = current_app.config['AUDIO_DELIVERY']
+    mimetype = AUDIO_MIMETYPES.get(os.path.splitext(path)[1], 'application/octet-stream')
+    if mode in ('x-accel', 'x-sendfile'):
+        response = current_app.response_class(mimetype=mimetype)
+        if mode == 'x-accel':
+            response.headers['X-Accel-Redirect'] = current_app.config['AUDIO_ACCEL_PREFIX'] + relative
+        else:
+            response.headers['X-Sendfile'] = path
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['AUDIO_MAX_AGE']
+        return response
+
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = '%x-%x-%x' % (stat.st_ino, stat.st_mtime_ns, size)
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+
+    response = current_app.response_class(mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.accept_ranges = 'bytes'
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['AUDIO_MAX_AGE']
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    start, stop = 0, size
+    byte_range = request.range
+    if byte_range is not None and _if_range_matches(etag, last_modified):
+        # Multi-range requests are rare for media and may be answered in full
+        span = byte_range.range_for_length(size)
+        if span is None and len(byte_range.ranges) == 1:
+            response.status_code = 416
+            response.headers['Content-Range'] = 'bytes */%d' % size
+            return response
+        if span is not None:
+            start, stop = span
+            response.status_code = 206
+            response.content_range = ContentRange('bytes', start, stop, size)
+
+    f = open(path, 'rb')
+    f.seek(start)
+    length = stop - start
+    if stop == size or _sendfile_server(request.environ, start):
+        # gunicorn's sendfile stops at Content-Length; other servers'
+        # wrappers read to EOF, which is only right for ranges that end there
+        response.response = wrap_file(request.environ, f)
+    else:
+        response.response = _bounded(f, length)
+    response.direct_passthrough = True
+    response.content_length = length
+    response.call_on_close(f.close)
+    return response
+
+
+def _sendfile_server(environ, start):
+    # gunicorn before 21 always sendfile()s from offset 0, whatever the seek
+    software = environ.get('SERVER_SOFTWARE', '')
+    if not software.startswith('gunicorn/'):
+        return False
+    try:
+        major = int(software[len('gunicorn/'):].split('.')[0])
+    except ValueError:
+        return False
+    return major >= 21 or start == 0
+
+
+def _if_range_matches(etag, last_modified):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified <= if_range.date
+    return True
+
+
+@bp.route('/audio/<int:track_id>')
+def stream(track_id):
+    return deliver(*_audio_file(track_id, 'audio_url'))
+
+
+@bp.route('/audio/<int:track_id>/preview')
+def preview(track_id):
+    return deliver(*_audio_file(track_id, 'preview_url'))
+
+
+def ffmpeg_binary():
+    binary = current_app.config['FFMPEG_BINARY'] or shutil.which('ffmpeg')
+    if not binary and imageio_ffmpeg is not None:
+        binary = imageio_ffmpeg.get_ffmpeg_exe()
+    if not binary:
+        raise jobs.PermanentError('ffmpeg is not installed')
+    return binary
+
+
+def compute_peaks(path, count=PEAK_COUNT):
+    """Decode ``path`` once; returns (duration in seconds, list of 0-100 peak heights)."""
+    # stderr goes to a file: a pipe nobody reads until stdout ends would
+    # stall ffmpeg once it filled up with warnings
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        [ffmpeg_binary(), '-v', 'error', '-i', path, '-vn', '-ac', '1', '-ar', str(PEAK_RATE),
+         '-f', 's16le', '-'],
+        stdout=subprocess.PIPE, stderr=log)
+    blocks = array('l')
+    pending = b''
+    samples = 0
+    block_bytes = PEAK_BLOCK * 2
+    while True:
+        data = process.stdout.read(block_bytes * 1024)
+        if not data:
+            break
+        data = pending + data
+        usable = len(data) - len(data) % block_bytes
+        pending = data[usable:]
+        pcm = array('h', data[:usable])
+        samples += len(pcm)
+        for i in range(0, len(pcm), PEAK_BLOCK):
+            block = pcm[i:i + PEAK_BLOCK]
+            blocks.append(max(max(block), -min(block)))
+    process.stdout.close()
+    with log:
+        returncode = process.wait()
+        log.seek(max(0, log.seek(0, os.SEEK_END) - 4096))
+        stderr = log.read().decode(errors='replace')
+    if returncode != 0 or not samples:
+        raise jobs.PermanentError('ffmpeg could not decode the audio: %s' % stderr.strip()[-500:])
+
+    # Fold the 10 ms maxima into ``count`` bars, scaled to the loudest one
+    count = min(count, len(blocks))
+    bars = [max(blocks[i * len(blocks) // count:(i + 1) * len(blocks) // count]) for i in range(count)]
+    loudest = max(bars) or 1
+    return samples / PEAK_RATE, [round(100 * bar / loudest) for bar in bars]
+
+
+def transcode(source, destination, start=None, length=None):
+    """Encode ``source`` as AAC in an MP4 container, optionally trimmed and faded."""
+    command = [ffmpeg_binary(), '-v', 'error', '-y']
+    if start:
+        command += ['-ss', '%.3f' % start]
+    command += ['-i', source]
+    if length:
+        command += ['-t', '%.3f' % length,
+                    '-af', 'afade=t=in:d=1,afade=t=out:st=%.3f:d=2' % max(length - 2, 0)]
+    command += ['-vn', '-map_metadata', '-1', '-ac', '2', '-c:a', 'aac',
+                '-b:a', current_app.config['AUDIO_STREAM_BITRATE'],
+                # moov atom first, so playback starts before the download ends
+                '-movflags', '+faststart', '-f', 'mp4', destination + '.tmp']
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise jobs.PermanentError('ffmpeg failed: %s' % result.stderr.decode(errors='replace').strip()[-500:])
+    os.replace(destination + '.tmp', destination)
+
+
+def preview_window(duration):
+    """(start, length) of the preview clip: a third of the way in, where tracks usually get going."""
+    length = current_app.config['AUDIO_PREVIEW_SECONDS']
+    if duration <= length:
+        return 0, duration
+    return min(duration / 3, duration - length), length
+
+
+def static_path(path):
+    return os.path.relpath(path, current_app.static_folder).replace(os.sep, '/')
+
+
+# A big master can take a while to transcode
+@jobs.handler('audio.process', queue='audio', stale_after=timedelta(hours=2))
+def process_track(payload):
+    track = db.session.get(Track, payload['track_id'])
+    if track is None or not track.master_file:
+        return
+    master = os.path.join(master_dir(), track.master_file)
+    track.processing_status = 'processing'
+    db.session.commit()
+
+    output_dir = os.path.join(current_app.config['AUDIO_OUTPUT_DIR'], track.master_file.split('.')[0][:16])
+    os.makedirs(output_dir, exist_ok=True)
+    stream_path = os.path.join(output_dir, 'stream.m4a')
+    preview_path = os.path.join(output_dir, 'preview.m4a')
+    try:
+        duration, peaks = compute_peaks(master)
+        transcode(master, stream_path)
+        start, length = preview_window(duration)
+        transcode(master, preview_path, start, length)
+    except jobs.PermanentError:
+        db.session.rollback()
+        track = db.session.get(Track, payload['track_id'])
+        track.processing_status = 'failed'
+        db.session.commit()
+        raise
+
+    track.audio_url = static_path(stream_path)
+    track.preview_url = static_path(preview_path)
+    track.duration = round(duration, 3)
+    track.waveform_peaks = json.dumps(peaks, separators=(',', ':'))
+    track.processing_status = 'ready'
+    db.session.commit()
+
+
+def format_duration(seconds):
+    seconds = int(seconds or 0)
+    return '%d:%02d' % (seconds // 60, seconds % 60)
+
+
+@audio_cli.command('reprocess')
+@click.argument('track_ids', nargs=-1, type=int)
+@click.option('--failed', is_flag=True, help='Every track whose processing failed.')
+def reprocess_command(track_ids, failed):
+    """Queue uploaded tracks (all of them if no ids are given) to be processed again."""
+    query = Track.query.filter(Track.master_file.isnot(None))
+    if failed:
+        query = query.filter(Track.processing_status == 'failed')
+    elif track_ids:
+        query = query.filter(Track.id.in_(track_ids))
+    for track in query.all():
+        track.processing_status = 'pending'
+        db.session.commit()
+        # A fresh key, since the job for the original upload already exists
+        jobs.enqueue('audio.process', '%d@%s' % (track.id, os.urandom(4).hex()), {'track_id': track.id})
+        click.echo('Queued %s' % track.title)
+
+
+def init_app(app):
+    app.config.setdefault('AUDIO_MASTER_DIR', os.path.join(app.instance_path, 'audio-masters'))
+    app.config.setdefault('AUDIO_OUTPUT_DIR', os.path.join(app.static_folder, 'music'))
+    app.config.setdefault('AUDIO_MAX_UPLOAD', 500 * 1024 * 1024)
+    app.config.setdefault('AUDIO_STREAM_BITRATE', '96k')
+    app.config.setdefault('AUDIO_PREVIEW_SECONDS', 30)
+    app.config.setdefault('FFMPEG_BINARY', os.environ.get('FFMPEG_BINARY'))
+    # 'sendfile', or 'x-accel' (nginx) / 'x-sendfile' (Apache, lighttpd) to
+    # have the front proxy serve the bytes
+    app.config.setdefault('AUDIO_DELIVERY', os.environ.get('AUDIO_DELIVERY', 'sendfile'))
+    # nginx: location /_static/ { internal; alias /app/static/; }
+    app.config.setdefault('AUDIO_ACCEL_PREFIX', '/_static/')
+    app.config.setdefault('AUDIO_MAX_AGE', 3600)
+    app.register_blueprint(bp)
+    app.add_template_filter(format_duration, 'duration')
+    app.cli.add_command(audio_cli)
@@ -0,0 +1,137 @@
+"""Check that admission control leaves threads for the cheap pages.
+
+    python bench/admission_saturation.py [--seconds 10] [--hold-ms 1000] [--clients 48]
+
+Boots one gthread gunicorn worker (GUNICORN_THREADS, 8 by default, is the
+whole SERVER_CAPACITY) on a throwaway seeded database. The cart and
+checkout views are wrapped to take --hold-ms each, standing in for a slow
+database or Stripe. --clients threads then fire add-to-cart and
+create-checkout-session requests back to back, each from a fresh address
+so the rate limits never kick in, which keeps both groups' concurrency
+slots full for --seconds. Meanwhile a prober fetches the policy pages and
+the API every 100 ms.
+
+Passes when both groups were saturated (some requests got 503) and every
+probe was answered, each well within --hold-ms: a probe that had to wait
+for a held thread to come free would take about that long.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from functools import wraps
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import bench_app, percentile, start_gunicorn, stop
+
+PROBES = ('/shipping', '/returns', '/api/products')
+HELD = ('add_to_cart', 'remove_from_cart', 'create_checkout_session')
+
+
+def slow_app():
+    """gunicorn factory: bench_app() with the admitted views held for HOLD_MS."""
+    app = bench_app()
+    hold = float(os.environ['HOLD_MS']) / 1000
+
+    def held(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            time.sleep(hold)
+            return view(*args, **kwargs)
+        return wrapper
+
+    for endpoint in HELD:
+        app.view_functions[endpoint] = held(app.view_functions[endpoint])
+    return app
+
+
+def new_address():
+    return '10.%d.%d.%d' % tuple(random.randrange(1, 255) for _ in range(3))
+
+
+def flood(base, deadline, counts, lock):
+    session = requests.Session()
+    while time.time() < deadline:
+        # No cart carried over, so checkouts stop at the empty cart before Stripe
+        session.cookies.clear()
+        path = '/add-to-cart/1' if random.random() < 0.6 else '/create-checkout-session'
+        try:
+            status = session.post(base + path, headers={'X-Forwarded-For': new_address()},
+                                  timeout=30).status_code
+        except requests.RequestException:
+            status = 'error'
+        with lock:
+            key = (path.split('/')[1], status)
+            counts[key] = counts.get(key, 0) + 1
+
+
+def probe(base, deadline, timings, failures):
+    session = requests.Session()
+    while time.time() < deadline:
+        for path in PROBES:
+            began = time.perf_counter()
+            try:
+                ok = session.get(base + path, timeout=30).status_code == 200
+            except requests.RequestException:
+                ok = False
+            timings.append(time.perf_counter() - began)
+            if not ok:
+                failures.append(path)
+        time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--hold-ms', type=float, default=1000)
+    parser.add_argument('--clients', type=int, default=48)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='delus-admission-')
+    server = None
+    try:
+        server, base = start_gunicorn(workdir, env={
+            'GUNICORN_PROFILE': 'gthread', 'WEB_CONCURRENCY': '1', 'HOLD_MS': str(args.hold_ms),
+            'ADMISSION_PROXIES': '1', 'WARM_UP': '0'}, target='admission_saturation:slow_app()')
+        deadline = time.time() + args.seconds
+        counts, lock = {}, threading.Lock()
+        timings, failures = [], []
+        threads = [threading.Thread(target=flood, args=(base, deadline, counts, lock))
+                   for _ in range(args.clients)]
+        # Let the flood fill the slots before probing
+        for thread in threads:
+            thread.start()
+        time.sleep(min(1.0, args.seconds / 4))
+        probe(base, deadline, timings, failures)
+        for thread in threads:
+            thread.join()
+    finally:
+        if server is not None:
+            stop(server)
+        shutil.rmtree(workdir)
+
+    for (route, status), count in sorted(counts.items(), key=str):
+        print('%-24s %5s %6d' % (route, status, count))
+    timings.sort()
+    print('%d probes, %d failed, p50 %.0f ms, p99 %.0f ms, max %.0f ms'
+          % (len(timings), len(failures), percentile(timings, 0.5), percentile(timings, 0.99),
+             timings[-1] * 1000 if timings else float('nan')))
+
+    saturated = all(counts.get((route, 503)) for route in ('add-to-cart', 'create-checkout-session'))
+    slowest = timings[-1] * 1000 if timings else float('inf')
+    if not saturated:
+        raise SystemExit('FAILED: the groups never filled up; raise --clients or --hold-ms')
+    if failures or slowest >= args.hold_ms / 2:
+        raise SystemExit('FAILED: cheap pages waited for a thread while cart and checkout were full')
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Throughput of N concurrent range readers against a real gunicorn.
+
+    python bench/audio_range.py [--readers 16] [--seconds 10] [--size-mb 64]
+        [--chunk-kb 512] [--workers 2]
+
+Starts gunicorn on a throwaway database holding one local track, then has
+--readers threads issue random ``Range: bytes=a-b`` requests (what a player
+does while seeking and buffering) and verifies every 206 body. It runs
+three rounds against the same file:
+
+- static: the generic /static/ handler
+- audio: /audio/<id>, bytes sent with sendfile(2)
+- audio, no sendfile: /audio/<id> with gunicorn's --no-sendfile
+"""
+import argparse
+import http.client
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bench_app():
+    """gunicorn factory: the real app on the database and files in BENCH_DIR."""
+    sys.path.insert(0, ROOT)
+    from app import app
+    from models import db, Track
+
+    workdir = os.environ['BENCH_DIR']
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+    with app.app_context():
+        db.create_all()
+        if Track.query.first() is None:
+            db.session.add(Track(title='Bench Mix', artist='Bench', source_type='local',
+                                 audio_url=os.environ['BENCH_AUDIO_URL'], processing_status='ready'))
+            db.session.commit()
+        db.get_engine(app).dispose()
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, audio_url, workers, sendfile):
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', '--chdir', ROOT, '--pythonpath', os.path.join(ROOT, 'bench'),
+               '-w', str(workers), '-b', '127.0.0.1:%d' % port, '--log-level', 'warning',
+               'audio_range:bench_app()']
+    if not sendfile:
+        command.insert(-1, '--no-sendfile')
+    env = dict(os.environ, BENCH_DIR=workdir, BENCH_AUDIO_URL=audio_url, WARM_UP='0')
+    server = subprocess.Popen(command, env=env)
+    for _ in range(200):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return server, port
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise SystemExit('gunicorn did not start')
+
+
+def reader(port, path, size, chunk, deadline, data, stats):
+    rng = random.Random()
+    latencies, received, errors = [], 0, 0
+    while time.time() < deadline:
+        start = rng.randrange(0, size - chunk)
+        end = start + chunk - 1
+        began = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', path, headers={'Range': 'bytes=%d-%d' % (start, end)})
+            response = conn.getresponse()
+            body = response.read()
+            conn.close()
+            if response.status != 206 or body != data[start:end + 1]:
+                errors += 1
+                continue
+        except OSError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - began)
+        received += len(body)
+    stats.append((latencies, received, errors))
+
+
+def run_round(label, port, path, args, data):
+    stats = []
+    deadline = time.time() + args.seconds
+    threads = [threading.Thread(target=reader, args=(port, path, len(data), args.chunk_kb * 1024,
+                                                     deadline, data, stats))
+               for _ in range(args.readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies = sorted(l for s in stats for l in s[0])
+    received = sum(s[1] for s in stats)
+    errors = sum(s[2] for s in stats)
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else float('nan')
+    print('%-20s %7.0f req/s %8.1f MB/s  p50 %7.1fms  p95 %7.1fms  errors %d'
+          % (label, len(latencies) / args.seconds, received / args.seconds / 2 ** 20,
+             statistics.median(latencies) * 1000 if latencies else float('nan'), p95, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--chunk-kb', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='delus-audio-')
+    # The file has to live under static/ for the /static/ round
+    relative = 'music/bench-%d/stream.m4a' % os.getpid()
+    path = os.path.join(ROOT, 'static', relative)
+    os.makedirs(os.path.dirname(path))
+    data = os.urandom(args.size_mb * 2 ** 20)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    print('%d readers, %d KB ranges of a %d MB file, %d sync workers, %.0fs per round'
+          % (args.readers, args.chunk_kb, args.size_mb, args.workers, args.seconds))
+    try:
+        for label, url, sendfile in (('static', '/static/' + relative, True),
+                                     ('audio', '/audio/1', True),
+                                     ('audio, no sendfile', '/audio/1', False)):
+            server, port = start_server(workdir, relative, args.workers, sendfile)
+            try:
+                run_round(label, port, url, args, data)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        shutil.rmtree(os.path.dirname(path))
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
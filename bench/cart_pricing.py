@@ -0,0 +1,94 @@
+"""Micro-benchmark: per-item Product.query.get loop vs. pricing.price_cart.
+
+    python bench/cart_pricing.py [--lines 40] [--rounds 200]
+
+Runs against a throwaway SQLite database, so it never touches instance/.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import event
+
+from models import db, Product
+from cache import response_cache
+from pricing import catalog_snapshot, price_cart
+
+
+def legacy_price(cart_items):
+    # The loop cart() used before pricing.py existed
+    total = 0
+    cart_products = []
+    for cart_item in cart_items:
+        product = Product.query.get(cart_item['product_id'])
+        if product:
+            item_total = product.price * cart_item['quantity']
+            total += item_total
+            cart_products.append({
+                'id': product.id,
+                'name': product.name,
+                'price': product.price,
+                'quantity': cart_item['quantity'],
+                'image_url': product.image_url,
+                'item_total': item_total
+            })
+    return cart_products, total
+
+
+def run(label, fn, cart_items, rounds, counter):
+    db.session.expunge_all()
+    counter[0] = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        # Start each round with an empty identity map, like a new request
+        db.session.remove()
+        fn(cart_items)
+    elapsed = time.perf_counter() - start
+    print('%-22s %8.1f us/cart  %5.1f queries/cart'
+          % (label, elapsed / rounds * 1e6, counter[0] / rounds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=40)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='delus-bench-')
+    app = Flask(__name__, instance_path=workdir)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    response_cache.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        for i in range(args.lines):
+            db.session.add(Product(name='Bench Product %d' % i, price=59.99,
+                                   image_url='images/collection/item1.jpg', stock=100))
+        db.session.commit()
+        cart_items = [{'product_id': p.id, 'quantity': 2} for p in Product.query.all()]
+
+        counter = [0]
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_queries(*args):
+            counter[0] += 1
+
+        print('%d-line cart, %d rounds' % (len(cart_items), args.rounds))
+        run('Product.query.get loop', legacy_price, cart_items, args.rounds, counter)
+
+        def cold(items):
+            catalog_snapshot._version = None
+            price_cart(items)
+        run('price_cart (cold)', cold, cart_items, args.rounds, counter)
+        run('price_cart (warm)', price_cart, cart_items, args.rounds, counter)
+
+
+if __name__ == '__main__':
+    main()
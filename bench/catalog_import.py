@@ -0,0 +1,105 @@
+"""Bulk catalog import and export speed.
+
+    python bench/catalog_import.py [--tracks 100000] [--products 5000]
+
+Writes a CSV of --tracks tracks and a JSON Lines file of --products
+products, then runs `flask catalog import` on a throwaway SQLite database
+three times: into an empty catalog (all inserts), again (every row
+unchanged, so only the lookups run), and once for the products, which also
+go through the search index triggers. It finishes with `flask catalog
+export tracks` and checks the export has every row. Prints rows per
+second and peak memory for each run; the memory should stay flat as the
+file grows.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import ROOT
+
+WORDS = ('ritual desert canyon mesa dusk neon static echo wave sonoran mirage ember drift haze '
+         'pulse orbit velvet signal').split()
+
+
+def write_tracks(path, count):
+    rng = random.Random(1)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['artist', 'title', 'audio_url', 'source_type', 'featured', 'is_release', 'created_at'])
+        for n in range(count):
+            writer.writerow(['Artist %d' % (n % 2000), '%s %s %d' % (rng.choice(WORDS).title(),
+                                                                       rng.choice(WORDS).title(), n),
+                             'https://api.soundcloud.com/tracks/%d' % (10 ** 8 + n), 'soundcloud',
+                             'false', 'true' if n % 50 == 0 else 'false', '2024-01-01T00:00:00'])
+
+
+def write_products(path, count):
+    rng = random.Random(2)
+    with open(path, 'w') as f:
+        for n in range(count):
+            f.write(json.dumps({'name': '%s Tee %d' % (rng.choice(WORDS).title(), n),
+                                'description': ' '.join(rng.choice(WORDS) for _ in range(12)),
+                                'price': round(rng.uniform(10, 200), 2), 'category': 'Clothing',
+                                'stock': rng.randint(0, 100)}) + '\n')
+
+
+def run(runner, args):
+    began = time.perf_counter()
+    result = runner.invoke(args=args)
+    elapsed = time.perf_counter() - began
+    if result.exit_code != 0:
+        raise SystemExit('%s failed: %s%s' % (' '.join(args), result.output, result.exception or ''))
+    return elapsed, result.output.strip().splitlines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=100000)
+    parser.add_argument('--products', type=int, default=5000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='delus-catalog-')
+    try:
+        tracks_csv = os.path.join(workdir, 'tracks.csv')
+        products_jsonl = os.path.join(workdir, 'products.jsonl')
+        write_tracks(tracks_csv, args.tracks)
+        write_products(products_jsonl, args.products)
+
+        sys.path.insert(0, ROOT)
+        import app as site
+        from models import db
+        app = site.app
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'catalog.db')
+        with app.app_context():
+            db.create_all()
+        runner = app.test_cli_runner()
+
+        print('%-22s %8s %9s %10s  result' % ('run', 'seconds', 'rows/s', 'peak MB'))
+        for name, command, rows in [
+                ('tracks, insert', ['catalog', 'import', 'tracks', tracks_csv], args.tracks),
+                ('tracks, re-import', ['catalog', 'import', 'tracks', tracks_csv], args.tracks),
+                ('products, insert', ['catalog', 'import', 'products', products_jsonl], args.products),
+                ('tracks, export', ['catalog', 'export', 'tracks', os.path.join(workdir, 'out.jsonl')],
+                 args.tracks)]:
+            elapsed, output = run(runner, command)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print('%-22s %8.2f %9.0f %10.0f  %s' % (name, elapsed, rows / elapsed, peak,
+                                                    output[-1] if output else ''))
+        with open(os.path.join(workdir, 'out.jsonl')) as f:
+            exported = sum(1 for _ in f)
+        assert exported == args.tracks, 'exported %d of %d tracks' % (exported, args.tracks)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
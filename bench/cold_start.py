@@ -0,0 +1,68 @@
+"""Cold-start time of the app, measured in fresh interpreters.
+
+    python bench/cold_start.py [--runs 10] [--repo PATH] [--no-warm]
+
+Each run starts a new Python process and times:
+
+- import: ``import app``, which is what the gunicorn master pays at boot
+- ready: ``create_app()`` returning (includes the warm-up unless --no-warm)
+- first /: the first request to the home page
+
+--repo points at another checkout (e.g. a ``git worktree`` of an older
+commit) to compare before/after; trees without ``create_app`` use
+``app.app``. The database is created and seeded once before timing.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SETUP = '''
+import app as m
+with m.app.app_context():
+    m.db.create_all()
+    m.create_sample_data()
+'''
+
+PROBE = '''
+import json, time
+t0 = time.perf_counter()
+import app as m
+t1 = time.perf_counter()
+application = m.create_app(warm=%(warm)r) if hasattr(m, 'create_app') else m.app
+t2 = time.perf_counter()
+status = application.test_client().get('/').status_code
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'ready': t2 - t0, 'first /': t3 - t2, 'status': status}))
+'''
+
+
+def run(repo, code):
+    out = subprocess.run([sys.executable, '-c', code], cwd=repo, check=True,
+                         stdout=subprocess.PIPE).stdout
+    return out.decode().strip().splitlines()[-1] if out.strip() else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--repo', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument('--no-warm', dest='warm', action='store_false')
+    args = parser.parse_args()
+
+    run(args.repo, SETUP)
+    samples = [json.loads(run(args.repo, PROBE % {'warm': args.warm})) for _ in range(args.runs)]
+    print('%s (%d runs, warm-up %s)' % (args.repo, args.runs, 'on' if args.warm else 'off'))
+    for key in ('import', 'ready', 'first /'):
+        values = [s[key] * 1000 for s in samples]
+        print('  %-8s median %7.1fms  min %7.1fms  max %7.1fms'
+              % (key, statistics.median(values), min(values), max(values)))
+    statuses = {s['status'] for s in samples}
+    if statuses != {200}:
+        print('  unexpected status codes: %s' % sorted(statuses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""A local stand-in for the parts of the Stripe API this app uses.
+
+    python bench/fake_stripe.py [--port 12111] [--latency 80]
+        [--webhook-url http://127.0.0.1:8080/webhook --webhook-secret whsec_test]
+
+Point the app at it with STRIPE_API_BASE=http://127.0.0.1:12111 and any
+STRIPE_SECRET_KEY. It implements checkout.Session create/retrieve/
+list_line_items and Product/Price create/modify, honours Idempotency-Key,
+and can add a fixed latency to every call to mimic the real round trip.
+
+POST /_test/checkout/sessions/<id>/complete (or /expire) finishes a session
+and delivers a signed checkout.session.completed (or .expired) event to
+--webhook-url, the way Stripe would.
+"""
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+_ids = itertools.count(1)
+
+
+def new_id(prefix):
+    return '%s_test_%06d%s' % (prefix, next(_ids), hashlib.sha1(str(time.time()).encode()).hexdigest()[:8])
+
+
+def parse_form(body):
+    """Decode Stripe's nested form encoding (a[b][0][c]=v) into dicts and lists."""
+    root = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+|\[\]', key)
+        node = root
+        for part, following in zip(parts, parts[1:] + [None]):
+            if following is None:
+                if part == '[]':
+                    node.append(value)
+                elif isinstance(node, list):
+                    node.append(value)
+                else:
+                    node[part] = value
+                break
+            child_type = list if following == '[]' or following.isdigit() else dict
+            if isinstance(node, list):
+                index = int(part)
+                while len(node) <= index:
+                    node.append(child_type())
+                node = node[index]
+            else:
+                node = node.setdefault(part, child_type())
+    return root
+
+
+def sign_payload(payload, secret, timestamp=None):
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), ('%d.%s' % (timestamp, payload)).encode(),
+                         hashlib.sha256).hexdigest()
+    return 't=%d,v1=%s' % (timestamp, signature)
+
+
+def send_webhook(url, secret, event_type, obj):
+    """POST a signed Stripe event to the app; returns the HTTP status."""
+    payload = json.dumps({'id': new_id('evt'), 'object': 'event', 'type': event_type,
+                          'created': int(time.time()), 'data': {'object': obj}})
+    request = urllib.request.Request(url, data=payload.encode(), method='POST', headers={
+        'Content-Type': 'application/json',
+        'Stripe-Signature': sign_payload(payload, secret),
+    })
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
+
+
+class FakeStripe:
+    def __init__(self, latency=0.0, webhook_url=None, webhook_secret=None):
+        self.latency = latency
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.sessions = {}
+        self.products = {}
+        self.prices = {}
+        self.idempotent = {}
+        self.calls = {}
+        self.lock = threading.RLock()
+
+    def record(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def create_product(self, params):
+        product = {'id': new_id('prod'), 'object': 'product', 'active': True,
+                   'name': params.get('name'), 'images': params.get('images', []),
+                   'metadata': params.get('metadata', {})}
+        self.products[product['id']] = product
+        return product
+
+    def create_price(self, params):
+        price = {'id': new_id('price'), 'object': 'price', 'active': True,
+                 'product': params['product'], 'currency': params.get('currency', 'usd'),
+                 'unit_amount': int(params['unit_amount']), 'metadata': params.get('metadata', {})}
+        self.prices[price['id']] = price
+        return price
+
+    def create_session(self, params):
+        items = []
+        for line in params.get('line_items', []):
+            if 'price' in line:
+                price = self.prices[line['price']]
+            else:
+                data = line['price_data']
+                product = self.create_product(data['product_data'])
+                price = self.create_price({'product': product['id'], 'currency': data['currency'],
+                                           'unit_amount': data['unit_amount']})
+            quantity = int(line['quantity'])
+            items.append({'id': new_id('li'), 'object': 'item', 'quantity': quantity,
+                          'description': self.products[price['product']]['name'],
+                          'amount_subtotal': price['unit_amount'] * quantity,
+                          'amount_total': price['unit_amount'] * quantity,
+                          'currency': price['currency'], 'price': price})
+        session_id = new_id('cs')
+        session = {'id': session_id, 'object': 'checkout.session', 'mode': params.get('mode'),
+                   'status': 'open', 'payment_status': 'unpaid',
+                   'url': 'https://checkout.stripe.test/pay/' + session_id,
+                   'amount_total': sum(item['amount_total'] for item in items),
+                   'currency': 'usd', 'metadata': params.get('metadata', {}),
+                   'expires_at': int(params.get('expires_at') or time.time() + 86400),
+                   'success_url': params.get('success_url'), 'cancel_url': params.get('cancel_url'),
+                   'customer_details': {'email': 'shopper@example.com', 'name': 'Test Shopper'},
+                   '_line_items': items}
+        self.sessions[session_id] = session
+        return session
+
+    def line_items(self, session_id, expand):
+        items = []
+        for item in self.sessions[session_id]['_line_items']:
+            item = dict(item, price=dict(item['price']))
+            if 'data.price.product' in expand:
+                item['price']['product'] = self.products[item['price']['product']]
+            items.append(item)
+        return {'object': 'list', 'data': items, 'has_more': False,
+                'url': '/v1/checkout/sessions/%s/line_items' % session_id}
+
+    @staticmethod
+    def public(session):
+        return {k: v for k, v in session.items() if not k.startswith('_')}
+
+    def finish(self, session_id, outcome):
+        session = self.sessions[session_id]
+        if outcome == 'complete':
+            session.update(status='complete', payment_status='paid')
+            event_type = 'checkout.session.completed'
+        else:
+            session.update(status='expired')
+            event_type = 'checkout.session.expired'
+        status = None
+        if self.webhook_url:
+            status = send_webhook(self.webhook_url, self.webhook_secret, event_type, self.public(session))
+        return {'id': session_id, 'event': event_type, 'webhook_status': status}
+
+    def handle(self, method, path, params, idempotency_key):
+        if idempotency_key and idempotency_key in self.idempotent:
+            return self.idempotent[idempotency_key]
+        result = self.route(method, path, params)
+        if idempotency_key and result[0] == 200:
+            self.idempotent[idempotency_key] = result
+        return result
+
+    def route(self, method, path, params):
+        m = re.fullmatch(r'/v1/checkout/sessions(?:/([^/]+))?(/line_items)?', path)
+        if m:
+            session_id, line_items = m.groups()
+            if method == 'POST' and not session_id:
+                self.record('checkout.Session.create')
+                return 200, self.public(self.create_session(params))
+            if session_id not in self.sessions:
+                return self.missing('checkout.session', session_id)
+            if line_items:
+                self.record('checkout.Session.list_line_items')
+                return 200, self.line_items(session_id, params.get('expand', []))
+            self.record('checkout.Session.retrieve')
+            return 200, self.public(self.sessions[session_id])
+
+        m = re.fullmatch(r'/v1/(products|prices)(?:/([^/]+))?', path)
+        if m and method == 'POST':
+            kind, object_id = m.groups()
+            store = self.products if kind == 'products' else self.prices
+            self.record('%s.%s' % (kind[:-1].capitalize(), 'modify' if object_id else 'create'))
+            if object_id is None:
+                return 200, (self.create_product if kind == 'products' else self.create_price)(params)
+            if object_id not in store:
+                return self.missing(kind[:-1], object_id)
+            for key, value in params.items():
+                store[object_id][key] = value == 'true' if value in ('true', 'false') else value
+            return 200, store[object_id]
+
+        m = re.fullmatch(r'/_test/checkout/sessions/([^/]+)/(complete|expire)', path)
+        if m and method == 'POST':
+            if m.group(1) not in self.sessions:
+                return self.missing('checkout.session', m.group(1))
+            return 200, self.finish(*m.groups())
+
+        if path == '/_test/calls':
+            return 200, self.calls
+        return 404, {'error': {'type': 'invalid_request_error',
+                               'message': 'Unrecognized request URL (%s: %s)' % (method, path)}}
+
+    @staticmethod
+    def missing(kind, object_id):
+        return 404, {'error': {'type': 'invalid_request_error', 'code': 'resource_missing',
+                               'message': "No such %s: '%s'" % (kind, object_id)}}
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _dispatch(self, method):
+            url = urlsplit(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+            params = parse_form(body if method == 'POST' else url.query)
+            if fake.latency:
+                time.sleep(fake.latency)
+            if url.path.startswith('/_test/'):
+                # Not under the lock: delivering a webhook may call back in
+                status, result = fake.route(method, url.path, params)
+            else:
+                with fake.lock:
+                    status, result = fake.handle(method, url.path, params, self.headers.get('Idempotency-Key'))
+            data = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Request-Id', new_id('req'))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=0, latency=0.0, webhook_url=None, webhook_secret=None):
+    """Start the stub on a background thread; returns (server, FakeStripe)."""
+    fake = FakeStripe(latency, webhook_url, webhook_secret)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, fake
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to every call')
+    parser.add_argument('--webhook-url')
+    parser.add_argument('--webhook-secret', default='whsec_test')
+    args = parser.parse_args()
+
+    server, _ = serve(args.port, args.latency / 1000, args.webhook_url, args.webhook_secret)
+    print('Fake Stripe listening on http://127.0.0.1:%d' % server.server_address[1])
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
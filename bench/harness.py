@@ -0,0 +1,78 @@
+"""Shared pieces for the benchmarks that drive a real gunicorn.
+
+``bench_app()`` is the gunicorn factory: the site seeded into a throwaway
+SQLite database under BENCH_DIR, with enough stock that shoppers never sell
+out. ``start_gunicorn()`` boots it with the repo's gunicorn_config.py, so
+GUNICORN_PROFILE and friends apply, and waits for the home page to answer.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bench_app():
+    """gunicorn factory: the real app, seeded into BENCH_DIR, with deep stock."""
+    sys.path.insert(0, ROOT)
+    import app as site
+    from models import db, Product
+
+    app = site.app
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database_path(os.environ['BENCH_DIR'])
+    with app.app_context():
+        db.create_all()
+        site.create_sample_data()
+        Product.query.update({Product.stock: 10 ** 6})
+        db.session.commit()
+        db.get_engine(app).dispose()
+    return site.create_app()
+
+
+def database_path(workdir):
+    return os.path.join(workdir, 'bench.db')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workdir, env=None, target='harness:bench_app()'):
+    """Boot gunicorn on a free port; returns (process, base_url)."""
+    port = free_port()
+    env = dict(os.environ, BENCH_DIR=workdir, METRICS_DIR=os.path.join(workdir, 'metrics'),
+               ADMISSION_STATE_FILE=os.path.join(workdir, 'admission.state'), FLASK_SECRET_KEY='bench',
+               **(env or {}))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn_config.py'),
+         '--chdir', ROOT, '--pythonpath', os.path.join(ROOT, 'bench'),
+         '-b', '127.0.0.1:%d' % port, '--log-level', 'warning', target],
+        env=env)
+    base = 'http://127.0.0.1:%d' % port
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit('gunicorn exited with %d' % server.returncode)
+        try:
+            if requests.get(base + '/', timeout=5).status_code == 200:
+                return server, base
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit('gunicorn did not start')
+
+
+def stop(server):
+    server.terminate()
+    server.wait()
+
+
+def percentile(values, fraction):
+    """Milliseconds at ``fraction`` of sorted seconds ``values``."""
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float('nan')
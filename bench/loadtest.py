@@ -0,0 +1,316 @@
+"""End-to-end load test of the shop against a local Stripe stand-in.
+
+    python bench/loadtest.py [--users 16] [--seconds 30] [--stripe-ms 80]
+        [--browse-ratio 0.5] [--drop-users 0] [--burst 100] [--save results.json]
+        [--baseline results.json] [--tolerance 0.25]
+
+Boots gunicorn (with the repo's gunicorn_config.py, so GUNICORN_PROFILE
+applies) on a throwaway seeded SQLite database. Stripe calls go to
+bench/fake_stripe.py, which answers after --stripe-ms. Two phases:
+
+1. Shoppers. --users sessions loop for --seconds. A --browse-ratio share
+   of loops only browse (/, /cart, /api/products). The rest shop:
+   / -> add-to-cart -> /cart -> create-checkout-session -> /success.
+   Alongside them, --drop-users clients play a merch drop: add-to-cart and
+   create-checkout-session back to back, with no pause, under routes
+   prefixed "drop". Each drop client keeps one address (X-Forwarded-For),
+   so admission control rate-limits them one by one, while each shopper
+   loop is a new visitor from a new address.
+2. Webhook burst. The sessions created in phase 1 are completed in the
+   fake, and --burst signed checkout.session.completed events are posted
+   to /webhook 16 at a time. One in ten is a redelivery of an event that
+   was already sent, as Stripe does on retries. The run then waits for
+   the job queue to drain.
+
+It reports requests, errors, throughput and p50/p95/p99 per route, and
+the requests admission control turned away (429/503) as "shed" rather than
+errors. With a drop running, the shed column should absorb the overload
+while / and the shoppers' routes keep their latency. --save writes
+the results as JSON. --baseline compares this run with a saved one and
+exits with status 1 if any route's p95 or p99 got more than --tolerance
+slower, or its throughput more than --tolerance lower. Only compare runs
+made on the same machine with the same settings. A typical check before
+deploying:
+
+    git stash; python bench/loadtest.py --save /tmp/base.json; git stash pop
+    python bench/loadtest.py --baseline /tmp/base.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_stripe
+from harness import database_path, percentile, start_gunicorn, stop
+
+WEBHOOK_SECRET = 'whsec_bench'
+# Admission control's answers when over budget; they are load being shed, not failures
+SHED = (429, 503)
+BURST_CONCURRENCY = 16
+# Differences under this many milliseconds are noise, whatever the ratio
+NOISE_MS = 5.0
+
+
+class Recorder:
+    """Latencies per route, shared by every simulated shopper."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+        self.shed = {}
+        self.elapsed = {}
+
+    def add(self, route, seconds, ok, shed=False):
+        with self.lock:
+            self.timings.setdefault(route, []).append(seconds)
+            if shed:
+                self.shed[route] = self.shed.get(route, 0) + 1
+            elif not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self):
+        routes = {}
+        for route, values in sorted(self.timings.items()):
+            values = sorted(values)
+            elapsed = self.elapsed.get(route) or self.elapsed['shoppers']
+            routes[route] = {
+                'requests': len(values),
+                'errors': self.errors.get(route, 0),
+                'shed': self.shed.get(route, 0),
+                'rps': round(len(values) / elapsed, 2),
+                'p50': round(percentile(values, 0.50), 2),
+                'p95': round(percentile(values, 0.95), 2),
+                'p99': round(percentile(values, 0.99), 2),
+            }
+        return routes
+
+
+def route_of(path):
+    return re.sub(r'/\d+', '/<id>', path.split('?')[0])
+
+
+def new_address():
+    return '10.%d.%d.%d' % tuple(random.randrange(1, 255) for _ in range(3))
+
+
+def client(base, recorder, prefix=''):
+    """A function making requests as one visitor, from an address of its own."""
+    http = requests.Session()
+    http.headers['X-Forwarded-For'] = new_address()
+
+    def call(method, path, **kwargs):
+        route = prefix + route_of(path)
+        began = time.perf_counter()
+        try:
+            response = http.request(method, base + path, timeout=60, **kwargs)
+        except requests.RequestException:
+            recorder.add(route, time.perf_counter() - began, False)
+            return None
+        recorder.add(route, time.perf_counter() - began, response.ok, response.status_code in SHED)
+        return response
+    call.http = http
+    return call
+
+
+def shopper(base, product_ids, args, deadline, recorder, session_ids):
+    rng = random.Random()
+    call = client(base, recorder)
+    while time.time() < deadline:
+        call.http.headers['X-Forwarded-For'] = new_address()
+        if rng.random() < args.browse_ratio:
+            call('GET', rng.choice(('/', '/cart', '/api/products')))
+            continue
+        call('GET', '/')
+        for product_id in rng.sample(product_ids, rng.randint(1, 2)):
+            call('POST', '/add-to-cart/%d' % product_id, data={'quantity': rng.randint(1, 2)})
+        call('GET', '/cart')
+        response = call('POST', '/create-checkout-session')
+        session_id = response.json().get('id') if response is not None and response.ok else None
+        if session_id:
+            session_ids.append(session_id)
+            call('GET', '/success?session_id=' + session_id)
+
+
+def drop_shopper(base, product_ids, deadline, recorder):
+    """A shopper in a drop: add to cart and check out, again and again, without waiting."""
+    rng = random.Random()
+    call = client(base, recorder, prefix='drop ')
+    while time.time() < deadline:
+        response = call('POST', '/add-to-cart/%d' % rng.choice(product_ids), data={'quantity': 1})
+        if response is not None and response.ok:
+            call('POST', '/create-checkout-session')
+
+
+def completed_event(fake, session_id):
+    with fake.lock:
+        session = fake.sessions[session_id]
+        session.update(status='complete', payment_status='paid')
+        obj = fake.public(session)
+    return json.dumps({'id': fake_stripe.new_id('evt'), 'object': 'event',
+                       'type': 'checkout.session.completed', 'created': int(time.time()),
+                       'data': {'object': obj}})
+
+
+def post_webhook(base, payload, recorder):
+    began = time.perf_counter()
+    try:
+        response = requests.post(base + '/webhook', data=payload, timeout=60, headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': fake_stripe.sign_payload(payload, WEBHOOK_SECRET),
+        })
+        ok = response.ok
+    except requests.RequestException:
+        ok = False
+    recorder.add('/webhook', time.perf_counter() - began, ok)
+
+
+def wait_for_jobs(workdir, timeout=120):
+    """Seconds until the job queue is empty, or None if it never empties."""
+    began = time.time()
+    connection = sqlite3.connect(database_path(workdir), timeout=15)
+    try:
+        while time.time() - began < timeout:
+            pending, = connection.execute(
+                "SELECT count(*) FROM job WHERE status IN ('pending', 'running')").fetchone()
+            if not pending:
+                return time.time() - began
+            time.sleep(0.1)
+    finally:
+        connection.close()
+    return None
+
+
+def run(args):
+    stripe_server, fake = fake_stripe.serve(latency=args.stripe_ms / 1000)
+    workdir = tempfile.mkdtemp(prefix='delus-load-')
+    server, base = start_gunicorn(workdir, {
+        'STRIPE_API_BASE': 'http://127.0.0.1:%d' % stripe_server.server_address[1],
+        'STRIPE_SECRET_KEY': 'sk_test_bench',
+        'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+        # Trust the clients' X-Forwarded-For, as the router's would be
+        'ADMISSION_PROXIES': '1',
+    })
+    recorder = Recorder()
+    try:
+        product_ids = [p['id'] for p in requests.get(base + '/api/products?fields=id').json()]
+        session_ids = []
+        began = time.time()
+        threads = [threading.Thread(target=shopper, args=(base, product_ids, args, began + args.seconds,
+                                                          recorder, session_ids))
+                   for _ in range(args.users)]
+        threads += [threading.Thread(target=drop_shopper, args=(base, product_ids, began + args.seconds, recorder))
+                    for _ in range(args.drop_users)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        recorder.elapsed['shoppers'] = time.time() - began
+
+        payloads = [completed_event(fake, session_id) for session_id in session_ids[:args.burst]]
+        # Stripe redelivers events it isn't sure arrived
+        payloads += random.sample(payloads, len(payloads) // 10)
+        random.shuffle(payloads)
+        began = time.time()
+        with ThreadPoolExecutor(BURST_CONCURRENCY) as pool:
+            for payload in payloads:
+                pool.submit(post_webhook, base, payload, recorder)
+        recorder.elapsed['/webhook'] = time.time() - began
+        drained = wait_for_jobs(workdir)
+    finally:
+        stop(server)
+        stripe_server.shutdown()
+        shutil.rmtree(workdir)
+
+    return {
+        'settings': {'users': args.users, 'seconds': args.seconds, 'stripe_ms': args.stripe_ms,
+                     'browse_ratio': args.browse_ratio, 'drop_users': args.drop_users, 'burst': args.burst,
+                     'profile': os.environ.get('GUNICORN_PROFILE', 'gthread'), 'cpus': os.cpu_count()},
+        'routes': recorder.summary(),
+        'webhook_drain_seconds': round(drained, 2) if drained is not None else None,
+        'stripe_calls': dict(fake.calls),
+    }
+
+
+def print_results(results, baseline=None):
+    print('%-32s %8s %7s %7s %8s %9s %9s %9s' % ('route', 'requests', 'errors', 'shed', 'req/s', 'p50 ms',
+                                                 'p95 ms', 'p99 ms'))
+    for route, r in results['routes'].items():
+        line = '%-32s %8d %7d %7d %8.1f %9.1f %9.1f %9.1f' % (
+            route, r['requests'], r['errors'], r.get('shed', 0), r['rps'], r['p50'], r['p95'], r['p99'])
+        old = (baseline or {}).get('routes', {}).get(route)
+        if old:
+            line += '   (was p95 %.1f, p99 %.1f)' % (old['p95'], old['p99'])
+        print(line)
+    drained = results['webhook_drain_seconds']
+    print('webhook jobs drained in %s' % ('%.2fs' % drained if drained is not None else 'NEVER'))
+    print('stripe calls: %s' % ', '.join('%s=%d' % item for item in sorted(results['stripe_calls'].items())))
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for route, old in baseline['routes'].items():
+        new = results['routes'].get(route)
+        if new is None:
+            found.append('%s: no requests this run' % route)
+            continue
+        for metric in ('p95', 'p99'):
+            if new[metric] > old[metric] * (1 + tolerance) and new[metric] - old[metric] > NOISE_MS:
+                found.append('%s: %s %.1fms -> %.1fms' % (route, metric, old[metric], new[metric]))
+        if new['rps'] < old['rps'] * (1 - tolerance):
+            found.append('%s: throughput %.1f -> %.1f req/s' % (route, old['rps'], new['rps']))
+        if new['errors'] > old['errors']:
+            found.append('%s: errors %d -> %d' % (route, old['errors'], new['errors']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--stripe-ms', type=float, default=80)
+    parser.add_argument('--browse-ratio', type=float, default=0.5)
+    parser.add_argument('--drop-users', type=int, default=0)
+    parser.add_argument('--burst', type=int, default=100)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != dict(baseline['settings'], users=args.users, seconds=args.seconds,
+                                        stripe_ms=args.stripe_ms, browse_ratio=args.browse_ratio,
+                                        drop_users=args.drop_users, burst=args.burst):
+            print('warning: baseline was recorded with different settings: %s' % baseline['settings'])
+
+    results = run(args)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        found = regressions(results, baseline, args.tolerance)
+        for problem in found:
+            print('REGRESSION ' + problem)
+        if found:
+            sys.exit(1)
+        print('no regressions against %s (tolerance %d%%)' % (args.baseline, args.tolerance * 100))
+
+
+if __name__ == '__main__':
+    main()
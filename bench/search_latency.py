@@ -0,0 +1,139 @@
+"""Product search latency with a large catalog.
+
+    python bench/search_latency.py [--products 50000] [--runs 200]
+
+Builds a throwaway SQLite catalog of --products SKUs, made with
+db.create_all() so the FTS index and triggers come from search.py. It then
+times representative /api/products/search requests through the test
+client: free text, filters, each sort, and a page deep into the results
+reached with a cursor. It prints p50/p95 per request and the SQLite query
+plan behind it. A plan that SCANs product instead of searching an index
+means the request will slow down as the catalog grows.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import ROOT, percentile
+
+WORDS = ('ritual certified trucker snapback beanie bucket tee hoodie crewneck longsleeve wave desert '
+         'scottsdale sonoran canyon mesa dusk neon static ritual echo').split()
+COLOURS = 'black grey maroon rose white olive navy sand'.split()
+CATEGORIES = ('Clothing', 'Hats', 'Accessories', 'Vinyl', 'Prints')
+
+QUERIES = [
+    ('text', '/api/products/search?q=trucker'),
+    ('text prefix', '/api/products/search?q=scotts'),
+    ('text + filters', '/api/products/search?q=black%20hoodie&category=Clothing&max_price=80&in_stock=true'),
+    ('text by price', '/api/products/search?q=canyon&sort=price'),
+    ('category by price', '/api/products/search?category=Hats&sort=price'),
+    ('price range', '/api/products/search?min_price=40&max_price=45&sort=price'),
+    ('newest', '/api/products/search'),
+    ('name', '/api/products/search?sort=name&in_stock=true'),
+]
+
+
+def build_catalog(app, count):
+    from models import db, Product
+    rng = random.Random(1)
+    # Descriptions mostly use a wide vocabulary, so a theme word matches a
+    # realistic few percent of the catalog rather than half of it
+    filler = [''.join(rng.choice('abcdefghiklmnoprstuvy') for _ in range(rng.randint(4, 9))) for _ in range(3000)]
+    with app.app_context():
+        db.create_all()
+        db.session.bulk_insert_mappings(Product, [{
+            'name': '%s %s - %s' % (rng.choice(WORDS).title(), rng.choice(WORDS).title(),
+                                    rng.choice(COLOURS).title()),
+            'description': ' '.join(rng.choice(WORDS) if rng.random() < 0.05 else rng.choice(filler)
+                                    for _ in range(20)),
+            'price': round(rng.uniform(10, 200), 2),
+            'category': rng.choice(CATEGORIES),
+            'stock': rng.choice((0, 0, 5, 20, 100)),
+        } for _ in range(count)])
+        db.session.commit()
+
+
+def query_plan(app, client, path):
+    """SQLite's plan for the product query behind ``path``."""
+    from sqlalchemy import event
+    from models import db
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM product' in statement:
+            statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        client.get(path, headers={'Cache-Control': 'no-cache'})
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    if not statements:
+        return []
+    statement, parameters = statements[-1]
+    with engine.connect() as connection:
+        return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+
+def time_path(client, path, runs):
+    timings = []
+    for _ in range(runs):
+        began = time.perf_counter()
+        response = client.get(path)
+        timings.append(time.perf_counter() - began)
+        if response.status_code != 200:
+            raise SystemExit('%s answered %d: %s' % (path, response.status_code, response.data[:200]))
+    return sorted(timings), response
+
+
+def deep_page(client, path, pages):
+    """The URL of page ``pages`` of ``path``, found by following the cursors."""
+    for _ in range(pages):
+        link = client.get(path).headers.get('Link')
+        if not link:
+            break
+        url = urlsplit(link[1:link.index('>')])
+        path = url.path + '?' + url.query
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=50000)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='delus-search-')
+    try:
+        sys.path.insert(0, ROOT)
+        import app as site
+        app = site.app
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'search.db')
+        began = time.perf_counter()
+        build_catalog(app, args.products)
+        print('built %d products in %.1fs' % (args.products, time.perf_counter() - began))
+
+        client = app.test_client()
+        deep = deep_page(client, '/api/products/search?sort=price&limit=100', 100)
+        assert parse_qs(urlsplit(deep).query).get('cursor'), 'the catalog is too small for a deep page'
+        print('%-20s %9s %9s %8s  plan' % ('request', 'p50 ms', 'p95 ms', 'results'))
+        for name, path in QUERIES + [('page 100 by price', deep)]:
+            timings, response = time_path(client, path, args.runs)
+            plan = '; '.join(query_plan(app, client, path))
+            print('%-20s %9.2f %9.2f %8d  %s' % (name, percentile(timings, 0.5), percentile(timings, 0.95),
+                                                 len(response.get_json()), plan))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
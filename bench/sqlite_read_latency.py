@@ -0,0 +1,148 @@
+"""Read latency under concurrent webhook writes, default vs tuned SQLite.
+
+    python bench/sqlite_read_latency.py [--tracks 20000] [--products 2000]
+        [--readers 4] [--writers 2] [--seconds 5]
+
+For each profile it builds a throwaway database, then forks reader processes
+that run home()'s queries plus the webhook's product-name lookup in a loop,
+while writer processes push checkout.session.completed events through the
+real webhook job handler. Reports read latency percentiles, throughput and
+"database is locked" failures.
+
+- default: rollback journal, synchronous=FULL, 5s busy timeout and no
+  indexes on Track.featured/is_release or Product.name (the old setup)
+- tuned: database.DEFAULT_PRAGMAS, SQLITE_BUSY_TIMEOUT and the indexes
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from models import db, Product, Track
+import database
+import webhooks
+
+OLD_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+NEW_INDEXES = ['ix_track_featured', 'ix_track_is_release', 'ix_product_name']
+
+
+def setup(profile, workdir, args):
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, profile + '.db')
+    timeout = 5 if profile == 'default' else app.config['SQLITE_BUSY_TIMEOUT']
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': timeout}}
+    database._pragmas.clear()
+    database._pragmas.update(OLD_PRAGMAS if profile == 'default' else database.DEFAULT_PRAGMAS)
+
+    with app.app_context():
+        db.create_all()
+        if profile == 'default':
+            for name in NEW_INDEXES:
+                db.session.execute('DROP INDEX %s' % name)
+        db.session.execute(Product.__table__.insert(), [
+            {'name': 'Product %d' % i, 'price': 60.0, 'stock': 10 ** 9}
+            for i in range(args.products)])
+        db.session.execute(Track.__table__.insert(), [
+            {'title': 'Track %d' % i, 'artist': 'Delus', 'featured': i == 0, 'is_release': i % 400 == 0}
+            for i in range(args.tracks)])
+        db.session.commit()
+        db.get_engine(app).dispose()
+
+
+def reader(args, deadline, results):
+    db.get_engine(app).dispose()
+    rng = random.Random(os.getpid())
+    latencies, errors = [], 0
+    with app.app_context():
+        while time.time() < deadline:
+            names = ['Product %d' % rng.randrange(args.products) for _ in range(3)]
+            start = time.perf_counter()
+            try:
+                Product.query.limit(4).all()
+                Track.query.filter_by(featured=True).first()
+                Track.query.filter_by(is_release=True).all()
+                Product.query.filter(Product.name.in_(names)).all()
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+            db.session.rollback()
+    results.put(('read', latencies, errors))
+
+
+def writer(args, deadline, results):
+    db.get_engine(app).dispose()
+    rng = random.Random(os.getpid())
+    latencies, errors = [], 0
+    with app.app_context():
+        while time.time() < deadline:
+            cart = ','.join('%d:1' % rng.randint(1, args.products) for _ in range(3))
+            start = time.perf_counter()
+            try:
+                webhooks.process_stripe_event({
+                    'type': 'checkout.session.completed',
+                    'data': {'object': {'id': 'cs_bench_%d' % rng.getrandbits(48), 'metadata': {'cart': cart}}},
+                })
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+                db.session.rollback()
+    results.put(('write', latencies, errors))
+
+
+def percentile(values, pct):
+    return sorted(values)[min(len(values) - 1, int(len(values) * pct / 100))] * 1000 if values else float('nan')
+
+
+def run(profile, workdir, args):
+    setup(profile, workdir, args)
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    deadline = time.time() + args.seconds
+    procs = [ctx.Process(target=reader, args=(args, deadline, results)) for _ in range(args.readers)]
+    procs += [ctx.Process(target=writer, args=(args, deadline, results)) for _ in range(args.writers)]
+    for p in procs:
+        p.start()
+    outcomes = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+
+    reads = [t for kind, lat, _ in outcomes if kind == 'read' for t in lat]
+    writes = [t for kind, lat, _ in outcomes if kind == 'write' for t in lat]
+    read_errors = sum(e for kind, _, e in outcomes if kind == 'read')
+    write_errors = sum(e for kind, _, e in outcomes if kind == 'write')
+    print('%-8s reads %6d (%5.0f/s) p50 %6.2fms p95 %6.2fms p99 %7.2fms max %7.2fms errors %d'
+          % (profile, len(reads), len(reads) / args.seconds, percentile(reads, 50),
+             percentile(reads, 95), percentile(reads, 99), max(reads or [0]) * 1000, read_errors))
+    print('%-8s writes %5d (%5.0f/s) p50 %6.2fms p95 %6.2fms errors %d'
+          % ('', len(writes), len(writes) / args.seconds, percentile(writes, 50),
+             percentile(writes, 95), write_errors))
+    return statistics.median(reads) if reads else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=20000)
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='delus-sqlite-')
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+    app.logger.setLevel('ERROR')  # every bench order is "sold without a hold"
+
+    print('%d tracks, %d products, %d readers, %d writers, %.0fs per profile'
+          % (args.tracks, args.products, args.readers, args.writers, args.seconds))
+    for profile in ('default', 'tuned'):
+        run(profile, workdir, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Concurrency stress test for stock reservations.
+
+    python bench/stock_stress.py [--processes 8] [--shoppers 60] [--stock 40]
+
+Forks several processes, like gunicorn workers, that all hammer one product
+through the real views: /add-to-cart, /remove-from-cart and
+/create-checkout-session. Completed and expired checkouts go through the
+webhook job handler. Meanwhile another process sweeps lapsed holds and a
+monitor samples the stock level. At the end it checks that stock never went
+negative and that every unit is accounted for:
+
+    final stock + units sold == initial stock, with no holds left over
+
+Stripe is replaced in-process by a stub that hands out session ids and
+lists their line items from the cart metadata. Runs against a throwaway
+SQLite database.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stripe
+
+from app import app
+from models import db, Product, StockHold
+import inventory
+import webhooks
+
+
+PRICE = 60.0
+
+# Sessions this process created: id -> metadata
+_sessions = {}
+
+
+class FakeCheckoutSession(dict):
+    __getattr__ = dict.__getitem__
+
+
+class FakeList(list):
+    def auto_paging_iter(self):
+        return iter(self)
+
+
+def fake_create(**kwargs):
+    session = FakeCheckoutSession(id='cs_stress_' + uuid.uuid4().hex, metadata=kwargs['metadata'])
+    _sessions[session.id] = session.metadata
+    return session
+
+
+def fake_list_line_items(session_id, **kwargs):
+    items = FakeList()
+    for product_id, quantity in webhooks.decode_cart_metadata(_sessions[session_id]['cart']).items():
+        items.append({'description': 'Stress Trucker', 'quantity': quantity,
+                      'amount_subtotal': int(PRICE * 100) * quantity,
+                      'price': {'product': {'metadata': {'product_id': str(product_id)}}}})
+    return items
+
+
+def shopper_process(product_id, shoppers, seed, results):
+    random.seed(seed)
+    db.get_engine(app).dispose()
+    sold = errors = 0
+    client = app.test_client()
+    try:
+        for _ in range(shoppers):
+            client.cookie_jar.clear()
+            quantity = random.randint(1, 3)
+            r = client.post('/add-to-cart/%d' % product_id, data={'quantity': quantity})
+            if r.status_code != 200:
+                continue
+            action = random.random()
+            if action < 0.15:
+                client.post('/remove-from-cart/%d' % product_id)
+                continue
+            if action < 0.25:
+                # Abandon the cart; the sweeper gets the hold back
+                continue
+            r = client.post('/create-checkout-session')
+            if r.status_code != 200:
+                errors += r.status_code != 409
+                continue
+            session_id = r.get_json()['id']
+            event_type = 'checkout.session.completed' if random.random() < 0.7 else 'checkout.session.expired'
+            with app.app_context():
+                webhooks.process_stripe_event({
+                    'type': event_type,
+                    'data': {'object': {'id': session_id, 'metadata': {'cart': '%d:%d' % (product_id, quantity)}}},
+                })
+            if event_type == 'checkout.session.completed':
+                sold += quantity
+    except Exception:
+        traceback.print_exc()
+        errors += 1
+    results.put((sold, errors))
+
+
+def sweeper_process(stop):
+    db.get_engine(app).dispose()
+    with app.app_context():
+        while not stop.is_set():
+            inventory.release_expired()
+            time.sleep(0.005)
+
+
+def monitor_process(product_id, stop, results):
+    db.get_engine(app).dispose()
+    lowest = None
+    with app.app_context():
+        while not stop.is_set():
+            stock = db.session.query(Product.stock).filter_by(id=product_id).scalar()
+            db.session.rollback()
+            lowest = stock if lowest is None else min(lowest, stock)
+    results.put(lowest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--shoppers', type=int, default=60, help='shoppers per process')
+    parser.add_argument('--stock', type=int, default=40)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='delus-stress-')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'stress.db')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 60}}
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+    # Every shopper comes from one address and retries at full speed
+    app.config['ADMISSION_ENABLED'] = False
+    # Short cart holds so the sweeper races the shoppers for real
+    inventory.CART_HOLD_TTL = timedelta(milliseconds=50)
+    stripe.checkout.Session.create = fake_create
+    stripe.checkout.Session.list_line_items = fake_list_line_items
+
+    with app.app_context():
+        db.create_all()
+        product = Product(name='Stress Trucker', price=PRICE, stock=args.stock)
+        db.session.add(product)
+        db.session.commit()
+        product_id = product.id
+        db.get_engine(app).dispose()
+
+    ctx = multiprocessing.get_context('fork')
+    results, lowest_queue, stop = ctx.Queue(), ctx.Queue(), ctx.Event()
+    helpers = [ctx.Process(target=sweeper_process, args=(stop,)),
+               ctx.Process(target=monitor_process, args=(product_id, stop, lowest_queue))]
+    shoppers = [ctx.Process(target=shopper_process, args=(product_id, args.shoppers, seed, results))
+                for seed in range(args.processes)]
+
+    start = time.perf_counter()
+    for p in helpers + shoppers:
+        p.start()
+    outcomes = [results.get() for _ in shoppers]
+    for p in shoppers:
+        p.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    lowest = lowest_queue.get()
+    for p in helpers:
+        p.join()
+
+    with app.app_context():
+        time.sleep(0.1)
+        inventory.release_expired()
+        final_stock = db.session.query(Product.stock).filter_by(id=product_id).scalar()
+        leftover_holds = StockHold.query.count()
+
+    sold = sum(s for s, _ in outcomes)
+    errors = sum(e for _, e in outcomes)
+    print('%d processes x %d shoppers in %.2fs' % (args.processes, args.shoppers, elapsed))
+    print('initial stock %d, sold %d, final stock %d, lowest seen %s, leftover holds %d, errors %d'
+          % (args.stock, sold, final_stock, lowest, leftover_holds, errors))
+
+    ok = (lowest is None or lowest >= 0) and final_stock >= 0 \
+        and final_stock + sold == args.stock and leftover_holds == 0 and errors == 0
+    print('OK' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
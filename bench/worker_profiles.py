@@ -0,0 +1,117 @@
+"""Compare gunicorn worker profiles under mixed checkout and browsing load.
+
+    python bench/worker_profiles.py [--profiles sync,gthread,gevent]
+        [--users 24] [--seconds 20] [--checkout-ratio 0.2] [--stripe-ms 400]
+
+For each profile, starts gunicorn with the real gunicorn_config.py
+(GUNICORN_PROFILE=<profile>) on a throwaway database, with Stripe replaced
+by bench/fake_stripe.py answering after --stripe-ms. Then --users
+simulated shoppers loop until time runs out. Each loop either browses
+(/, /cart, /api/products) or, with probability --checkout-ratio, adds an
+item to the cart, creates a checkout session and opens /success, which
+makes two Stripe round trips. The report gives p50/p95/p99 separately
+for page views and for the Stripe-bound requests. The interesting number
+is page-view p99, which measures how much checkout waits block everyone else.
+
+Worker, thread and connection counts come from the config's defaults
+unless WEB_CONCURRENCY, GUNICORN_THREADS or GUNICORN_WORKER_CONNECTIONS
+are set in the environment.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_stripe
+from harness import percentile, start_gunicorn, stop
+
+BROWSE = ('/', '/cart', '/api/products')
+STRIPE_BOUND = ('/create-checkout-session', '/success')
+
+
+def shopper(base, product_ids, args, deadline, results):
+    rng = random.Random()
+    http = requests.Session()
+    timings = {path: [] for path in BROWSE + STRIPE_BOUND}
+    errors = 0
+
+    def timed(method, path, label=None, **kwargs):
+        began = time.perf_counter()
+        response = http.request(method, base + path, timeout=60, **kwargs)
+        timings[label or path].append(time.perf_counter() - began)
+        return response
+
+    while time.time() < deadline:
+        try:
+            if rng.random() < args.checkout_ratio:
+                http.post(base + '/add-to-cart/%d' % rng.choice(product_ids), data={'quantity': 1}, timeout=60)
+                response = timed('POST', '/create-checkout-session')
+                session_id = response.json().get('id') if response.ok else None
+                if session_id is None:
+                    errors += 1
+                    continue
+                if not timed('GET', '/success?session_id=' + session_id, label='/success').ok:
+                    errors += 1
+            elif not timed('GET', rng.choice(BROWSE)).ok:
+                errors += 1
+        except (requests.RequestException, ValueError):
+            errors += 1
+    results.append((timings, errors))
+
+
+def report(profile, results, seconds):
+    errors = sum(e for _, e in results)
+    for label, paths in (('pages', BROWSE), ('stripe', STRIPE_BOUND)):
+        latencies = sorted(l for timings, _ in results for path in paths for l in timings[path])
+        print('%-8s %-7s %6.1f req/s  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms'
+              % (profile, label, len(latencies) / seconds, percentile(latencies, 0.5),
+                 percentile(latencies, 0.95), percentile(latencies, 0.99)))
+    if errors:
+        print('%-8s %d errors' % (profile, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', default='sync,gthread,gevent')
+    parser.add_argument('--users', type=int, default=24)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--checkout-ratio', type=float, default=0.2)
+    parser.add_argument('--stripe-ms', type=float, default=400)
+    args = parser.parse_args()
+
+    stripe_server, _ = fake_stripe.serve(latency=args.stripe_ms / 1000)
+    stripe_base = 'http://127.0.0.1:%d' % stripe_server.server_address[1]
+    print('%d shoppers, %.0f%% checking out, Stripe answering in %.0fms, %d CPUs, %.0fs per profile'
+          % (args.users, args.checkout_ratio * 100, args.stripe_ms, os.cpu_count(), args.seconds))
+
+    for profile in args.profiles.split(','):
+        workdir = tempfile.mkdtemp(prefix='delus-profile-')
+        # Without admission control, so every checkout waits its turn
+        server, base = start_gunicorn(workdir, {'GUNICORN_PROFILE': profile, 'STRIPE_API_BASE': stripe_base,
+                                                'STRIPE_SECRET_KEY': 'sk_test_bench', 'ADMISSION_ENABLED': '0'})
+        try:
+            product_ids = [p['id'] for p in requests.get(base + '/api/products?fields=id').json()]
+            results = []
+            deadline = time.time() + args.seconds
+            threads = [threading.Thread(target=shopper, args=(base, product_ids, args, deadline, results))
+                       for _ in range(args.users)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            report(profile, results, args.seconds)
+        finally:
+            stop(server)
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
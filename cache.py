@@ -0,0 +1,245 @@
+"""Rendered-response cache for the catalog-driven views.
+
+Responses are kept in process memory and tagged with a catalog version. The
+version is a row in the database (``catalog_version``), so a catalog write
+in any process on any host, ``flask`` commands included, invalidates the
+cached pages of every worker. Processes re-read it at most every
+``CATALOG_VERSION_TTL`` seconds, so they see another's change that much
+later at worst. Product, ProductImage and Track changes bump the version in
+their own transaction through SQLAlchemy session events; anything that
+bypasses the ORM (``drop_all``, raw SQL) should call
+``response_cache.invalidate()`` itself, passing its connection to bump in
+the same transaction.
+Stock moves are the exception: carts move it all the time, and the pages
+only show whether a product is in stock, so inventory.py runs its updates
+with the ``stock_only`` execution option and marks the change itself when
+a product sells out or comes back (``mark_catalog_changed``).
+"""
+import itertools
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+import sqlalchemy as sa
+from flask import current_app, request
+from werkzeug.http import is_resource_modified
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, CatalogVersion, Product, ProductImage, Track
+import metrics
+
+CATALOG_MODELS = (Product, ProductImage, Track)
+CATALOG_TABLES = frozenset(model.__tablename__ for model in CATALOG_MODELS)
+
+# SQLite and PostgreSQL both take ON CONFLICT. A missing row starts from the
+# clock (microseconds) rather than 0, so a recreated table (reset-db) can't
+# repeat a version that some process still has pages cached under.
+BUMP_VERSION = sa.text(
+    'INSERT INTO catalog_version (id, version, changed_at) VALUES (1, :start, :now) '
+    'ON CONFLICT (id) DO UPDATE SET version = catalog_version.version + 1, changed_at = :now'
+).bindparams(sa.bindparam('now', type_=sa.DateTime))
+
+
+def _bump(connection):
+    connection.execute(BUMP_VERSION, {'start': time.time_ns() // 1000, 'now': datetime.utcnow()})
+
+
+class ResponseCache:
+    def __init__(self, app=None):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._state = None  # (version, changed_at, monotonic time read)
+        self.ttl = 1.0
+        self.max_entries = 256
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_ENABLED', True)
+        app.config.setdefault('RESPONSE_CACHE_MAX_ENTRIES', 256)
+        app.config.setdefault('CATALOG_VERSION_TTL', float(os.environ.get('CATALOG_VERSION_TTL', 1)))
+        self.ttl = app.config['CATALOG_VERSION_TTL']
+        self.max_entries = app.config['RESPONSE_CACHE_MAX_ENTRIES']
+        app.extensions['response_cache'] = self
+
+    def _current(self):
+        state = self._state
+        if state is None or time.monotonic() - state[2] >= self.ttl:
+            table = CatalogVersion.__table__
+            # Its own connection, always the primary, outside any session's transaction
+            with db.engine.connect() as connection:
+                row = connection.execute(sa.select(table.c.version, table.c.changed_at)
+                                         .where(table.c.id == 1)).first()
+            state = self._state = (row[0], row[1], time.monotonic()) if row else (0, None, time.monotonic())
+        return state
+
+    @property
+    def version(self):
+        """Current catalog version, shared by every process; at most ``ttl`` seconds old."""
+        return self._current()[0]
+
+    def validators(self):
+        """(etag, last_modified) for the current catalog."""
+        version, changed_at, _ = self._current()
+        if changed_at is None:
+            # No change recorded yet; make one so there is a date to give
+            self.invalidate()
+            version, changed_at, _ = self._current()
+        etag = 'catalog-%x' % version
+        return etag, changed_at.replace(microsecond=0, tzinfo=timezone.utc)
+
+    def invalidate(self, connection=None):
+        """Bump the shared version, in ``connection``'s transaction if given.
+
+        Without a connection the bump commits at once and this process's
+        cached responses go with it; otherwise call ``forget`` after the
+        commit (the session events do).
+        """
+        if connection is not None:
+            _bump(connection)
+            return
+        with db.engine.begin() as connection:
+            _bump(connection)
+        self.forget()
+
+    def forget(self):
+        """Drop this process's cached responses and re-read the version on next use."""
+        with self._lock:
+            self._entries.clear()
+            self._state = None
+            self.invalidations += 1
+
+    def get(self, key):
+        version = self.version
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                hit = True
+            else:
+                self.misses += 1
+                hit = False
+        metrics.inc('cache_requests_total', cache='response', result='hit' if hit else 'miss')
+        return entry[1] if hit else None
+
+    def set(self, key, value, version):
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                # Dicts keep insertion order, so this evicts the oldest entry
+                del self._entries[next(iter(self._entries))]
+            self._entries[key] = (version, value)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'entries': len(self._entries),
+            'version': self.version,
+        }
+
+    def cached(self, vary=None):
+        """Cache a view's rendered 200 response until the catalog changes.
+
+        ``vary`` is an optional callable returning extra key material for
+        per-visitor fragments of the page (e.g. the cart badge count).
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not current_app.config['RESPONSE_CACHE_ENABLED']:
+                    return view(*args, **kwargs)
+
+                # The scheme and host too: pages carry absolute URLs
+                key = (request.host_url, request.endpoint, request.full_path,
+                       vary() if vary is not None else None)
+                entry = self.get(key)
+                if entry is not None:
+                    body, mimetype, headers = entry
+                    response = current_app.response_class(body, mimetype=mimetype, headers=headers)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                # Read the version before rendering so a concurrent change
+                # can only make this entry look stale, never fresh
+                version = self.version
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    headers = [(name, value) for name, value in response.headers
+                               if name not in ('Content-Type', 'Content-Length')]
+                    self.set(key, (response.get_data(), response.mimetype, headers), version)
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
+
+    def conditional(self, view):
+        """ETag/Last-Modified from the catalog version, with 304s for clients that are current.
+
+        The check runs before the view, so a revalidation runs no catalog
+        queries: at most a primary-key read of the catalog_version row, once
+        per ``CATALOG_VERSION_TTL`` per process. Only responses derived
+        purely from the catalog (and the URL) should use this.
+        """
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = self.validators()
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+
+
+response_cache = ResponseCache()
+
+
+def _touches_catalog(session):
+    return any(isinstance(obj, CATALOG_MODELS)
+               for obj in itertools.chain(session.new, session.dirty, session.deleted))
+
+
+def mark_catalog_changed(session):
+    """Bump the catalog version in ``session``'s transaction, once per transaction."""
+    if not session.info.get('catalog_changed'):
+        session.info['catalog_changed'] = True
+        _bump(session.connection())
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_catalog_flush(session, flush_context):
+    if _touches_catalog(session):
+        mark_catalog_changed(session)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _mark_catalog_bulk_write(orm_execute_state):
+    # Query.update()/delete() and update()/delete() statements skip the flush
+    if ((orm_execute_state.is_update or orm_execute_state.is_delete)
+            and not orm_execute_state.execution_options.get('stock_only')):
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None and table.name in CATALOG_TABLES:
+            mark_catalog_changed(orm_execute_state.session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_on_commit(session):
+    if session.info.pop('catalog_changed', False):
+        response_cache.forget()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_on_rollback(session):
+    session.info.pop('catalog_changed', None)
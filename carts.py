@@ -0,0 +1,140 @@
+"""Server-side carts.
+
+The session cookie carries only an opaque ``cart_id``. The lines live in a
+cart store, by default the ``cart`` table. Visitors who never add anything
+have no cart and get no session cookie, and the cookie doesn't change as
+the cart does.
+
+``CART_STORE`` names the store class as an import string. A replacement
+needs ``load(cart_id)`` (the lines, or None), ``save(cart_id, lines)``,
+``delete(cart_id)`` and ``purge(before)``. Carts untouched for
+``CART_TTL_DAYS`` are purged by the job worker.
+
+Requests under ``SESSIONLESS_PATHS`` (static files, the API, webhooks,
+media, the token-authenticated admin endpoints, the health check) never
+open or save the session. Their responses carry no Set-Cookie and no
+``Vary: Cookie``.
+"""
+import json
+from datetime import datetime, timedelta
+
+from flask import current_app, g, request, session
+from flask.sessions import NullSession, SecureCookieSessionInterface
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import import_string
+
+from models import db, Cart
+import inventory
+import jobs
+
+
+class SQLCartStore:
+    """Carts as compact JSON rows in the app database."""
+
+    def load(self, cart_id):
+        row = db.session.get(Cart, cart_id)
+        if row is None:
+            return None
+        return [{'product_id': product_id, 'quantity': quantity}
+                for product_id, quantity in json.loads(row.items)]
+
+    def save(self, cart_id, lines):
+        values = {Cart.items: json.dumps([[line['product_id'], line['quantity']] for line in lines],
+                                         separators=(',', ':')),
+                  Cart.updated_at: datetime.utcnow()}
+        if not Cart.query.filter_by(id=cart_id).update(values, synchronize_session=False):
+            db.session.add(Cart(id=cart_id, **{column.key: value for column, value in values.items()}))
+            try:
+                db.session.commit()
+                return
+            except IntegrityError:
+                # Another request created it first
+                db.session.rollback()
+                Cart.query.filter_by(id=cart_id).update(values, synchronize_session=False)
+        db.session.commit()
+
+    def delete(self, cart_id):
+        Cart.query.filter_by(id=cart_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    def purge(self, before):
+        count = Cart.query.filter(Cart.updated_at < before).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+def _store():
+    return current_app.extensions['cart_store']
+
+
+def cart_id(create=False):
+    """The visitor's cart id, minted on first use if ``create``."""
+    if create and 'cart_id' not in session:
+        session['cart_id'] = inventory.new_cart_id()
+    return session.get('cart_id')
+
+
+def items():
+    """The visitor's lines as [{'product_id', 'quantity'}], loaded once per request."""
+    if 'cart_items' not in g:
+        current = cart_id()
+        lines = _store().load(current) if current else None
+        # Carts from before the server-side store rode in the cookie itself
+        legacy = session.pop('cart', None)
+        if legacy and lines is None and all('name' not in item for item in legacy):
+            lines = [{'product_id': item['product_id'], 'quantity': item['quantity']} for item in legacy]
+            _store().save(cart_id(create=True), lines)
+        g.cart_items = lines or []
+    return g.cart_items
+
+
+def save(lines):
+    _store().save(cart_id(create=True), lines)
+    g.cart_items = lines
+
+
+def clear():
+    """Empty the cart. The id stays, since stock holds are keyed on it."""
+    current = cart_id()
+    if current:
+        _store().delete(current)
+    g.cart_items = []
+
+
+def count():
+    return len(items())
+
+
+class SkippedSession(NullSession):
+    """The empty, read-only session seen on SESSIONLESS_PATHS."""
+
+    def _fail(self, *args, **kwargs):
+        raise RuntimeError('The session is not loaded for %s (see SESSIONLESS_PATHS)' % request.path)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = update = setdefault = _fail
+
+
+class CartSessionInterface(SecureCookieSessionInterface):
+    """The signed-cookie session, skipped entirely for SESSIONLESS_PATHS."""
+
+    def open_session(self, app, request):
+        if request.path.startswith(tuple(app.config['SESSIONLESS_PATHS'])):
+            return SkippedSession()
+        return super(CartSessionInterface, self).open_session(app, request)
+
+
+@jobs.every(3600)
+def purge_abandoned():
+    before = datetime.utcnow() - timedelta(days=current_app.config['CART_TTL_DAYS'])
+    _store().purge(before)
+
+
+def init_app(app):
+    app.config.setdefault('CART_STORE', 'carts:SQLCartStore')
+    app.config.setdefault('CART_TTL_DAYS', 30)
+    app.config.setdefault('SESSIONLESS_PATHS', (
+        app.static_url_path + '/', '/api/', '/webhook', '/metrics', '/admin/', '/img/', '/audio/',
+        '/favicon.ico', '/robots.txt', '/sitemap.xml', '/healthz'))
+    app.extensions['cart_store'] = import_string(app.config['CART_STORE'])()
+    app.session_interface = CartSessionInterface()
+    app.context_processor(lambda: {'cart_count': count})
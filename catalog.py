@@ -0,0 +1,383 @@
+"""Bulk catalog import and export.
+
+    flask catalog import tracks back-catalog.csv
+    flask catalog import products merch-drop.jsonl --dry-run
+    flask catalog export tracks tracks.jsonl
+    flask catalog export products - --format csv
+
+Files are CSV with a header row or JSON Lines, told apart by the extension
+(or ``--format`` for ``-``, stdin/stdout). Rows are read, validated and
+written a batch at a time, so a file of any size runs in constant memory.
+
+Records are matched on a natural key: products on ``name``, tracks on
+``(title, artist)``. A row whose key exists updates the columns it gives
+and leaves the rest alone (a row that changes nothing isn't written); any
+other row is inserted. Bad rows are reported by line number and skipped.
+Each batch is one lookup plus executemany INSERTs and UPDATEs in its own
+transaction, so the site's writes wait for a batch rather than the whole
+file, and an interrupted import can simply be run again. The statements
+bypass the ORM, so each batch that writes anything bumps the catalog version
+in its own transaction (see cache.py); the search index triggers still fire.
+Exports write the same columns, so an export imports back unchanged.
+
+A product's ``stock`` in a file is every unit on hand. ``Product.stock``
+leaves out the units held by carts and open checkouts (see inventory.py),
+so imports subtract the current holds (never going below zero) and exports
+add them back.
+"""
+import csv
+import json
+import math
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+
+from models import db, Product, StockHold, Track
+from cache import response_cache
+
+BATCH_SIZE = 1000
+SHOWN_ERRORS = 20
+
+Kind = namedtuple('Kind', 'model key fields')
+
+# What a file may carry, in export order. Ids, stock holds and the audio
+# pipeline's columns stay with the database.
+KINDS = {
+    'products': Kind(Product, ('name',),
+                     ('name', 'description', 'price', 'category', 'stock', 'image_url', 'created_at')),
+    'tracks': Kind(Track, ('title', 'artist'),
+                   ('artist', 'title', 'audio_url', 'source_type', 'cover_url', 'preview_url', 'duration',
+                    'featured', 'is_release', 'created_at')),
+}
+
+TRUE = {'1', 'true', 't', 'yes', 'y'}
+FALSE = {'0', 'false', 'f', 'no', 'n'}
+
+catalog_cli = AppGroup('catalog', help='Bulk catalog import and export.')
+
+
+class RowError(ValueError):
+    """A row that can't be imported; the message names the field."""
+
+
+def _converter(column):
+    """A function turning a non-empty file value into a value for ``column``."""
+    name = column.name
+    kind = column.type.python_type
+    length = getattr(column.type, 'length', None)
+
+    if kind is bool:
+        def convert(value):
+            if isinstance(value, bool):
+                return value
+            text = str(value).lower()
+            if text in TRUE:
+                return True
+            if text in FALSE:
+                return False
+            raise ValueError
+    elif kind is datetime:
+        def convert(value):
+            parsed = datetime.fromisoformat(value)
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            return parsed
+    elif kind in (int, float):
+        def convert(value):
+            if isinstance(value, bool):
+                raise ValueError
+            number = float(value)
+            if not math.isfinite(number) or (kind is int and not number.is_integer()):
+                raise ValueError
+            if number < 0:
+                raise RowError('%s must not be negative' % name)
+            return kind(number)
+    else:
+        def convert(value):
+            value = str(value)
+            if length and len(value) > length:
+                raise RowError('%s is longer than %d characters' % (name, length))
+            return value
+    return convert
+
+
+def _parser(column):
+    """A function turning a file value into a value for ``column``; strings come from CSV, anything from JSON."""
+    convert = _converter(column)
+
+    def parse(value):
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            if not column.nullable:
+                raise RowError('%s is required' % column.name)
+            return None
+        try:
+            return convert(value)
+        except (TypeError, ValueError) as error:
+            if isinstance(error, RowError):
+                raise
+            raise RowError('%s is not a valid %s: %r' % (column.name, column.type.python_type.__name__, value))
+    return parse
+
+
+_parsers = {}
+
+
+def validate(kind, raw):
+    """A row read from a file as column values; raises RowError."""
+    parsers = _parsers.get(kind)
+    if parsers is None:
+        parsers = _parsers[kind] = {field: _parser(kind.model.__table__.c[field]) for field in kind.fields}
+    try:
+        values = {field: parsers[field](value) for field, value in raw.items()}
+    except KeyError:
+        unknown = sorted(str(field) for field in raw if field not in parsers)
+        raise RowError('unknown field%s %s' % ('s' if len(unknown) > 1 else '', ', '.join(unknown)))
+    if len(values) < len(kind.fields):
+        for field in kind.fields:
+            if field not in values and not kind.model.__table__.c[field].nullable:
+                raise RowError('%s is required' % field)
+    return values
+
+
+def _format(file, given):
+    if given:
+        return given
+    name = getattr(file, 'name', '')
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    raise click.UsageError('Pass --format; the file name does not say whether it is CSV or JSON Lines.')
+
+
+def read_rows(file, fmt, kind):
+    """(line number, raw row) pairs from ``file``, one at a time."""
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        header = reader.fieldnames or []
+        unknown = [field for field in header if field not in kind.fields]
+        missing = [field for field in kind.fields
+                   if field not in header and not kind.model.__table__.c[field].nullable]
+        if unknown or missing:
+            raise click.UsageError('The CSV header must name the %s columns (%s)%s%s.' % (
+                kind.model.__tablename__, ', '.join(kind.fields),
+                '; unknown: ' + ', '.join(unknown) if unknown else '',
+                '; missing: ' + ', '.join(missing) if missing else ''))
+        for raw in reader:
+            # Short rows leave None in the missing cells, which reads as empty
+            yield reader.line_num, raw if None not in raw else RowError('more cells than the header')
+        return
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            raw = json.loads(line)
+        except ValueError as error:
+            yield line_number, RowError('not valid JSON: %s' % error)
+            continue
+        yield line_number, raw if isinstance(raw, dict) else RowError('not a JSON object')
+
+
+def _key(kind, values):
+    return tuple(values[field] for field in kind.key)
+
+
+def _existing(connection, kind, keys):
+    """The records with any of ``keys``: key -> [(id, {field: value})]."""
+    table = kind.model.__table__
+    # Only the first key column goes in the query: SQLite answers a row-value
+    # IN by scanning the whole index, and an IN per column by probing every
+    # combination. Same-titled tracks by other artists are never looked up.
+    condition = table.c[kind.key[0]].in_({key[0] for key in keys})
+    found = {}
+    query = sa.select(table.c.id, *[table.c[field] for field in kind.fields]).where(condition)
+    for row in connection.execute(query).all():
+        values = dict(zip(kind.fields, row[1:]))
+        found.setdefault(_key(kind, values), []).append((row[0], values))
+    return found
+
+
+def _held(connection, product_ids):
+    """{product id: units in stock holds} for those of ``product_ids`` with any."""
+    hold = StockHold.__table__
+    query = (sa.select(hold.c.product_id, sa.func.sum(hold.c.quantity))
+             .where(hold.c.product_id.in_(product_ids)).group_by(hold.c.product_id))
+    return dict(connection.execute(query).all())
+
+
+def _unheld(table, stock):
+    """SQL for ``stock`` less the product's held units, at least 0.
+
+    It runs inside the UPDATE, so a hold taken since the lookup still counts.
+    """
+    hold = StockHold.__table__
+    held = (sa.select(sa.func.coalesce(sa.func.sum(hold.c.quantity), 0))
+            .where(hold.c.product_id == table.c.id).scalar_subquery())
+    return sa.case((stock - held > 0, stock - held), else_=0)
+
+
+def write_batch(kind, rows):
+    """Upsert a batch of validated rows in one transaction; returns (inserted, updated, unchanged)."""
+    # A key seen twice in the batch keeps its last row
+    rows = {_key(kind, values): values for values in rows}
+    table = kind.model.__table__
+    inserts = {}
+    updates = {}
+    unchanged = 0
+    with db.engine.begin() as connection:
+        existing = _existing(connection, kind, list(rows))
+        held = None
+        if 'stock' in kind.fields and existing:
+            held = _held(connection, [record_id for records in existing.values() for record_id, _ in records])
+        for key, values in rows.items():
+            if key not in existing:
+                inserts.setdefault(tuple(values), []).append(values)
+                continue
+            # Older duplicates of a key are all updated; rows that change
+            # nothing are left alone, so re-running an import is cheap
+            changed = False
+            for record_id, current in existing[key]:
+                wanted = values
+                if held is not None and 'stock' in values:
+                    wanted = dict(values, stock=max(0, (values['stock'] or 0) - held.get(record_id, 0)))
+                # The parameters keep the file's stock; the UPDATE takes the holds off
+                params = {field: value for field, value in values.items()
+                          if field not in kind.key and current[field] != wanted[field]}
+                if params:
+                    changed = True
+                    params['record_id'] = record_id
+                    updates.setdefault(tuple(params), []).append(params)
+            unchanged += not changed
+
+        # executemany wants the same columns in every row, so group by them
+        for batch in inserts.values():
+            connection.execute(table.insert(), batch)
+        for fields, batch in updates.items():
+            columns = {field: sa.bindparam(field) for field in fields[:-1]}
+            if held is not None and 'stock' in columns:
+                columns['stock'] = _unheld(table, columns['stock'])
+            statement = table.update().where(table.c.id == sa.bindparam('record_id')).values(columns)
+            connection.execute(statement, batch)
+        if inserts or updates:
+            response_cache.invalidate(connection)
+    inserted = sum(map(len, inserts.values()))
+    return inserted, len(rows) - inserted - unchanged, unchanged
+
+
+def import_rows(kind, rows, batch_size=BATCH_SIZE, dry_run=False, on_error=None):
+    """Validate and upsert (line number, raw row) pairs; returns the counts.
+
+    Invalid rows go to ``on_error(line_number, message)`` and are skipped.
+    """
+    counts = {'valid': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0}
+    batch = []
+
+    def flush():
+        if batch and not dry_run:
+            inserted, updated, unchanged = write_batch(kind, batch)
+            counts['inserted'] += inserted
+            counts['updated'] += updated
+            counts['unchanged'] += unchanged
+        batch.clear()
+
+    for line_number, raw in rows:
+        try:
+            if isinstance(raw, RowError):
+                raise raw
+            batch.append(validate(kind, raw))
+        except RowError as error:
+            counts['skipped'] += 1
+            if on_error is not None:
+                on_error(line_number, str(error))
+            continue
+        counts['valid'] += 1
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return counts
+
+
+def export_rows(kind, batch_size=BATCH_SIZE):
+    """Every record of ``kind`` as a dict of its file fields, read a batch at a time by id.
+
+    Product stock includes the units held in carts and checkouts.
+    """
+    table = kind.model.__table__
+    columns = [table.c[field] for field in kind.fields]
+    last_id = 0
+    while True:
+        rows = db.session.execute(sa.select(table.c.id, *columns).where(table.c.id > last_id)
+                                  .order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            return
+        held = _held(db.session, [row.id for row in rows]) if 'stock' in kind.fields else {}
+        for row in rows:
+            values = dict(zip(kind.fields, row[1:]))
+            if row.id in held:
+                values['stock'] = (values['stock'] or 0) + held[row.id]
+            yield values
+        last_id = rows[-1].id
+        # Don't hold a read transaction open across the whole export
+        db.session.commit()
+
+
+def _csv_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return '' if value is None else value
+
+
+@catalog_cli.command('import')
+@click.argument('kind', type=click.Choice(sorted(KINDS)))
+@click.argument('file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, type=click.IntRange(1, 5000))
+@click.option('--dry-run', is_flag=True, help='Validate the file without writing anything.')
+def import_command(kind, file, fmt, batch_size, dry_run):
+    """Insert or update products or tracks from a CSV or JSON Lines file."""
+    kind = KINDS[kind]
+    errors = []
+
+    def report(line_number, message):
+        errors.append(line_number)
+        if len(errors) <= SHOWN_ERRORS:
+            click.echo('line %d: %s' % (line_number, message), err=True)
+
+    rows = read_rows(file, _format(file, fmt), kind)
+    counts = import_rows(kind, rows, batch_size, dry_run, report)
+    if len(errors) > SHOWN_ERRORS:
+        click.echo('... and %d more invalid rows' % (len(errors) - SHOWN_ERRORS), err=True)
+    if dry_run:
+        click.echo('Dry run: %d valid, %d invalid' % (counts['valid'], counts['skipped']))
+    else:
+        click.echo('%(inserted)d inserted, %(updated)d updated, %(unchanged)d unchanged, %(skipped)d skipped'
+                   % counts)
+
+
+@catalog_cli.command('export')
+@click.argument('kind', type=click.Choice(sorted(KINDS)))
+@click.argument('file', type=click.File('w', encoding='utf-8', lazy=True), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+def export_command(kind, file, fmt):
+    """Write every product or track to a CSV or JSON Lines file (stdout by default)."""
+    kind = KINDS[kind]
+    fmt = _format(file, fmt)
+    if fmt == 'csv':
+        writer = csv.DictWriter(file, kind.fields)
+        writer.writeheader()
+        for row in export_rows(kind):
+            writer.writerow({field: _csv_value(value) for field, value in row.items()})
+    else:
+        for row in export_rows(kind):
+            file.write(json.dumps(row, ensure_ascii=False, default=datetime.isoformat) + '\n')
+
+
+def init_app(app):
+    app.cli.add_command(catalog_cli)
@@ -0,0 +1,209 @@
+"""Database selection, connection pooling, read replica and SQLite tuning.
+
+``DATABASE_URL`` picks the database; without it the app uses a SQLite file
+in the instance folder. Heroku-style ``postgres://`` URLs are accepted.
+Server databases get a connection pool per process sized for a gunicorn
+worker's threads plus its job thread (``DATABASE_POOL_SIZE``,
+``DATABASE_MAX_OVERFLOW``, ``DATABASE_POOL_TIMEOUT``). Connections are
+pinged before use and recycled after ``DATABASE_POOL_RECYCLE`` seconds, so
+ones dropped by the server or a proxy are replaced instead of failing a
+request. A pooled connection is only ever used by the process that opened
+it: with preload_app a connection checked out in a forked worker that was
+inherited from the master is discarded, not shared.
+
+``DATABASE_REPLICA_URL`` adds a read replica. Views wrapped in
+``reads_from_replica`` send their SELECTs on the catalog tables
+(``DATABASE_REPLICA_TABLES``) to it. Everything else, carts and stock
+included, stays on the primary, and so does the catalog snapshot that
+prices carts (see ``primary``). Cached pages are filled from whichever
+database served the read and are kept until the catalog version moves, so
+for ``DATABASE_REPLICA_LAG`` seconds after a catalog change the reads stay
+on the primary. That keeps a lagging replica from pinning stale pages in
+the cache. The replica must be the same kind
+of database as the primary.
+
+Every new SQLite connection gets the pragmas in ``SQLITE_PRAGMAS``:
+
+- ``journal_mode=WAL`` lets readers carry on while a webhook or a cart
+  reservation is writing, instead of queueing behind the write lock.
+- ``synchronous=NORMAL`` is durable across application crashes in WAL mode
+  and skips an fsync on every commit.
+- ``mmap_size`` and ``cache_size`` keep the (small) database in memory.
+
+Writers from several gunicorn workers wait up to ``SQLITE_BUSY_TIMEOUT``
+seconds for the lock rather than failing with "database is locked".
+
+Schema changes ship as Flask-Migrate revisions in migrations/versions:
+``flask db upgrade`` brings any existing database up to date.
+"""
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, exc, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from sqlalchemy.sql import Select
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16000,  # negative means KiB, so 16 MB per connection
+    'temp_store': 'MEMORY',
+}
+
+# Engines are created lazily by Flask-SQLAlchemy, so the pragmas are applied
+# from a connect hook that only needs to know what to set
+_pragmas = dict(DEFAULT_PRAGMAS)
+
+
+@event.listens_for(Engine, 'connect')
+def _apply_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in _pragmas.items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def pragma_values(connection):
+    """Current values of the tuned pragmas on a SQLAlchemy connection."""
+    return {name: connection.exec_driver_sql('PRAGMA %s' % name).scalar() for name in _pragmas}
+
+
+def database_url(url, default=None):
+    """Normalise a ``DATABASE_URL``; SQLAlchemy 1.4 dropped the ``postgres://`` alias."""
+    if not url:
+        return default
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+@event.listens_for(Pool, 'connect')
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # A connection opened in the preloaded master shares its socket with
+    # every forked worker; drop it rather than talk over each other
+    if connection_record.info.get('pid', os.getpid()) != os.getpid():
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise exc.DisconnectionError('connection belongs to pid %s' % connection_record.info['pid'])
+
+
+def dispose_engines(app):
+    """Close every pooled connection, the replica's included."""
+    with app.app_context():
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+            app.extensions['sqlalchemy'].db.get_engine(app, bind=bind).dispose()
+
+
+class RoutingSession(SignallingSession):
+    """Sends catalog SELECTs to the replica inside ``reads_from_replica`` views."""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if (mapper is not None and isinstance(clause, Select) and not self._flushing
+                and g.get('read_replica')
+                and mapper.persist_selectable.name in self.app.config['DATABASE_REPLICA_TABLES']):
+            return get_state(self.app).db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_ready():
+    """Whether this request may read the catalog from the replica."""
+    if 'replica' not in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+        return False
+    cache = current_app.extensions.get('response_cache')
+    if cache is None:
+        return True
+    _, changed = cache.validators()
+    return time.time() - changed.timestamp() > current_app.config['DATABASE_REPLICA_LAG']
+
+
+def reads_from_replica(view):
+    """Route the view's catalog reads to the replica when there is one."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_replica = replica_ready()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def primary():
+    """Read from the primary, even inside a ``reads_from_replica`` view."""
+    previous = g.get('read_replica')
+    g.read_replica = False
+    try:
+        yield
+    finally:
+        g.read_replica = previous
+
+
+class _LazyMigrate:
+    """Stands in for Flask-Migrate's state in ``app.extensions['migrate']``.
+
+    Importing flask_migrate pulls in alembic, which is a good part of the
+    app's import time, and only ``flask db`` commands need it.
+    """
+
+    def __init__(self, app):
+        self._app = app
+        self._state = None
+
+    def __getattr__(self, name):
+        if self._state is None:
+            from flask_migrate import Migrate
+            from models import db
+            # Batch mode lets ALTER-style migrations run on SQLite
+            Migrate(self._app, db, render_as_batch=True)
+            self._state = self._app.extensions['migrate']
+        return getattr(self._state, name)
+
+
+def init_app(app):
+    app.config.setdefault('SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', 15)
+    _pragmas.clear()
+    _pragmas.update(app.config['SQLITE_PRAGMAS'])
+
+    # A gthread worker runs GUNICORN_THREADS (8) requests plus the job thread
+    app.config.setdefault('DATABASE_POOL_SIZE', int(os.environ.get('DATABASE_POOL_SIZE', 10)))
+    app.config.setdefault('DATABASE_MAX_OVERFLOW', int(os.environ.get('DATABASE_MAX_OVERFLOW', 5)))
+    app.config.setdefault('DATABASE_POOL_TIMEOUT', float(os.environ.get('DATABASE_POOL_TIMEOUT', 10)))
+    app.config.setdefault('DATABASE_POOL_RECYCLE', int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)))
+    app.config.setdefault('DATABASE_REPLICA_URL', database_url(os.environ.get('DATABASE_REPLICA_URL')))
+    app.config.setdefault('DATABASE_REPLICA_LAG', float(os.environ.get('DATABASE_REPLICA_LAG', 5)))
+    app.config.setdefault('DATABASE_REPLICA_TABLES',
+                          frozenset(['product', 'product_image', 'product_fts', 'track']))
+
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # pysqlite's timeout is SQLite's busy handler, in seconds
+        options.setdefault('connect_args', {}).setdefault('timeout', app.config['SQLITE_BUSY_TIMEOUT'])
+    else:
+        options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+        options.setdefault('max_overflow', app.config['DATABASE_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', app.config['DATABASE_POOL_TIMEOUT'])
+        options.setdefault('pool_recycle', app.config['DATABASE_POOL_RECYCLE'])
+        options.setdefault('pool_pre_ping', True)
+
+    if app.config['DATABASE_REPLICA_URL']:
+        app.config['SQLALCHEMY_BINDS'] = dict(app.config['SQLALCHEMY_BINDS'] or {},
+                                              replica=app.config['DATABASE_REPLICA_URL'])
+
+    app.extensions['migrate'] = _LazyMigrate(app)
@@ -1,9 +1,106 @@
+"""gunicorn settings, chosen from the environment.
+
+GUNICORN_PROFILE picks the worker model:
+
+- sync: one request per process. A checkout waiting on Stripe holds a whole
+  worker, so a few slow Stripe calls stall page views behind them.
+- gthread (default): each process runs GUNICORN_THREADS requests at once,
+  so Stripe waits only tie up a thread.
+- gevent: each process runs up to GUNICORN_WORKER_CONNECTIONS greenlets.
+  Needs ``pip install gevent``. The standard library is monkey-patched here,
+  before the preloaded app imports ssl and socket.
+
+Counts derive from the CPUs this process may actually use (its affinity
+mask and any cgroup quota, not the host's cores), and the default never
+goes past MAX_DEFAULT_WORKERS processes. WEB_CONCURRENCY (workers),
+GUNICORN_THREADS, GUNICORN_WORKER_CONNECTIONS and GUNICORN_TIMEOUT override
+them.
+bench/worker_profiles.py compares the profiles under mixed checkout and
+browsing load.
+"""
+import math
+import os
+
+MAX_DEFAULT_WORKERS = 8
+
+profile = os.environ.get('GUNICORN_PROFILE', 'gthread')
+if profile not in ('sync', 'gthread', 'gevent'):
+    raise RuntimeError('GUNICORN_PROFILE must be sync, gthread or gevent, not %r' % profile)
+
+if profile == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def available_cpus():
+    """CPUs this process may run on: its affinity mask, capped by a cgroup v2 quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not Linux
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+cpus = available_cpus()
+
+wsgi_app = "app:create_app()"
 bind = "0.0.0.0:8080"
-workers = 2
-worker_class = "sync"
-worker_connections = 1000
-timeout = 30
+worker_class = profile
+if profile == 'sync':
+    # Processes are the only concurrency, so lean on the usual 2n+1
+    default_workers = 2 * cpus + 1
+else:
+    # Threads and greenlets cover the I/O waits; a process per core covers the CPU
+    default_workers = max(2, cpus)
+workers = int(os.environ.get('WEB_CONCURRENCY', min(default_workers, MAX_DEFAULT_WORKERS)))
+# Keep threads at or under STRIPE_POOL_SIZE (10) so checkouts reuse pooled connections
+threads = int(os.environ.get('GUNICORN_THREADS', 8)) if profile == 'gthread' else 1
+# Bounded so a burst queues in the kernel rather than piling onto SQLite
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# Requests the server runs at once; admission.py caps the cart and checkout
+# routes at a share of it. Set here, before the preloaded app reads it.
+os.environ.setdefault('SERVER_CAPACITY', str(workers * (worker_connections if profile == 'gevent' else threads)))
 keepalive = 2
-max_requests = 1000
+# gthread workers drop the connections they have accepted but not yet served
+# when max_requests recycles them, so they only recycle if asked to
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0 if profile == 'gthread' else 1000))
 max_requests_jitter = 100
-preload_app = True 
\ No newline at end of file
+preload_app = True
+
+
+def on_starting(server):
+    # Runs in the master after the preload: drop the last run's metrics
+    # and anything the warm-up recorded
+    import metrics
+    metrics.registry.reset()
+
+
+def post_fork(server, worker):
+    # Threads don't survive the fork from the preloaded master, so each
+    # worker starts its own job thread here
+    from app import app
+    import database
+    import jobs
+    # Nor do connections opened in the master; start with fresh pools
+    # (create_app already emptied them, this covers a custom entry point)
+    database.dispose_engines(app)
+    jobs.start_worker(app)
+
+
+def worker_exit(server, worker):
+    import metrics
+    metrics.registry.flush()
+
+
+def child_exit(server, worker):
+    # Keep a recycled worker's counts so totals on /metrics never drop
+    import metrics
+    metrics.registry.retire(worker.pid)
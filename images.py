@@ -0,0 +1,305 @@
+"""Responsive image derivatives.
+
+``/img/<width>/<filename>`` serves a resized, recompressed copy of an image
+under ``static/`` in the best format the browser accepts (AVIF, WebP, then
+JPEG or PNG for images with transparency). Derivatives are written once to
+a content-addressed cache under the instance folder and shared by every
+worker; ``flask images build`` fills the cache ahead of a deploy.
+
+Templates use ``image_url(filename, width)`` and ``image_srcset(filename)``
+in place of ``url_for('static', filename=...)``. Product photos are
+``ProductImage`` rows that carry their source's size, version and widths.
+``product_image_url(image, width)`` and ``product_image_srcset(image)`` build
+the same URLs from those columns without touching the file. ``flask images
+build`` fills the columns in.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+from collections import namedtuple
+
+import click
+from flask import Blueprint, abort, current_app, request, send_file, url_for
+from flask.cli import AppGroup
+
+from models import db, ProductImage
+import metrics
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is optional; without it the helpers fall back to the originals
+    Image = None
+
+DEFAULT_WIDTHS = (160, 320, 640, 960, 1280, 1920)
+SOURCE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+FORMATS = {
+    # name: (Pillow format, mimetype, file extension, save options)
+    'avif': ('AVIF', 'image/avif', 'avif', {'quality': 55, 'speed': 6}),
+    'webp': ('WEBP', 'image/webp', 'webp', {'quality': 78, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg', {'quality': 80, 'optimize': True, 'progressive': True}),
+    'png': ('PNG', 'image/png', 'png', {'optimize': True}),
+}
+
+# A ProductImage's columns, detached from the session so it can be cached
+Picture = namedtuple('Picture', 'filename alt width height version widths')
+
+bp = Blueprint('images', __name__)
+images_cli = AppGroup('images', help='Responsive image derivatives.')
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+class SourceInfo:
+    __slots__ = ('path', 'stamp', 'width', 'height', 'has_alpha', '_digest')
+
+    def __init__(self, path, stamp, width, height, has_alpha):
+        self.path = path
+        self.stamp = stamp
+        self.width = width
+        self.height = height
+        self.has_alpha = has_alpha
+        self._digest = None
+
+    @property
+    def version(self):
+        # Cache-busting token for URLs, from the content like assets.py's
+        # names, so a redeploy that only touches mtimes re-hashes to the same
+        # token. The hash is only redone when the (mtime, size) stamp moves:
+        # an edit that keeps both goes unnoticed until a restart. ProductImage
+        # rows keep the token they stored until `flask images build`.
+        return self.digest[:12]
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            h = hashlib.sha256()
+            with open(self.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            self._digest = h.hexdigest()
+        return self._digest
+
+
+def available_formats():
+    if Image is None:
+        return ()
+    names = ['jpeg', 'png']
+    if features.check('webp'):
+        names.insert(0, 'webp')
+    if features.check('avif'):
+        names.insert(0, 'avif')
+    return tuple(names)
+
+
+def source_info(filename):
+    """Size and alpha of an image under static/, or None if it isn't one."""
+    if Image is None or os.path.splitext(filename)[1].lower() not in SOURCE_EXTENSIONS:
+        return None
+    static_folder = current_app.static_folder
+    path = os.path.realpath(os.path.join(static_folder, filename))
+    if not path.startswith(os.path.realpath(static_folder) + os.sep):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    info = _sources.get(path)
+    if info is None or info.stamp != stamp:
+        # Opening only parses the header, the pixels are not decoded here
+        try:
+            with Image.open(path) as im:
+                width, height = im.size[::-1] if _is_rotated(im) else im.size
+                has_alpha = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+        except OSError:
+            return None
+        info = SourceInfo(path, stamp, width, height, has_alpha)
+        with _sources_lock:
+            _sources[path] = info
+    return info
+
+
+def _is_rotated(im):
+    # EXIF orientations 5-8 swap width and height
+    try:
+        return im.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+    except Exception:
+        return False
+
+
+def widths_for(info):
+    """Standard widths worth offering for a source, smallest first."""
+    standard = sorted(current_app.config['IMAGE_WIDTHS'])
+    widths = [w for w in standard if w < info.width]
+    # One step at or above the source width serves it at full resolution
+    widths.extend([w for w in standard if w >= info.width][:1])
+    return widths
+
+
+def negotiate_format(info):
+    offered = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    for name in available_formats():
+        if name in ('avif', 'webp') and FORMATS[name][1] in offered:
+            return name
+    return 'png' if info.has_alpha else 'jpeg'
+
+
+def derivative_path(info, width, fmt):
+    key = hashlib.sha256(('%s:%d:%s:%r' % (info.digest, width, fmt, FORMATS[fmt][3])).encode()).hexdigest()
+    return os.path.join(current_app.config['IMAGE_CACHE_DIR'], key[:2], '%s.%s' % (key, FORMATS[fmt][2]))
+
+
+def build_derivative(info, width, fmt):
+    """Return the cache path for a derivative, rendering it if needed."""
+    path = derivative_path(info, width, fmt)
+    if os.path.exists(path):
+        metrics.inc('cache_requests_total', cache='image', result='hit')
+        return path
+    metrics.inc('cache_requests_total', cache='image', result='miss')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # One worker renders a given derivative; the others wait and reuse it
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            pil_format, _, _, options = FORMATS[fmt]
+            with Image.open(info.path) as im:
+                if im.format == 'JPEG':
+                    # Let libjpeg decode at a reduced scale; camera files are 24 MP
+                    im.draft('RGB', (1, width) if _is_rotated(im) else (width, 1))
+                im = ImageOps.exif_transpose(im)
+                im.thumbnail((width, im.height), Image.LANCZOS)
+                if fmt == 'jpeg' and im.mode != 'RGB':
+                    im = im.convert('RGB')
+                elif im.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                    im = im.convert('RGBA' if info.has_alpha else 'RGB')
+                tmp = '%s.%d.tmp' % (path, os.getpid())
+                im.save(tmp, pil_format, **options)
+                os.replace(tmp, path)
+    try:
+        os.remove(path + '.lock')
+    except OSError:
+        pass
+    return path
+
+
+@bp.route('/img/<int:width>/<path:filename>')
+def derivative(width, filename):
+    info = source_info(filename)
+    # Only standard widths, so the cache can't be filled with arbitrary sizes
+    if info is None or width not in current_app.config['IMAGE_WIDTHS']:
+        abort(404)
+    width = min(width, info.width)
+    fmt = negotiate_format(info)
+    path = build_derivative(info, width, fmt)
+
+    versioned = request.args.get('v') == info.version
+    response = send_file(path, mimetype=FORMATS[fmt][1], conditional=True,
+                         max_age=31536000 if versioned else 86400)
+    if versioned:
+        response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
+
+
+def image_url(filename, width=None):
+    """URL of the derivative of ``filename`` closest to ``width`` pixels."""
+    info = source_info(filename)
+    if info is None:
+        return url_for('static', filename=filename)
+    widths = widths_for(info)
+    if width is None:
+        width = widths[-1]
+    width = next((w for w in widths if w >= width), widths[-1])
+    return url_for('images.derivative', width=width, filename=filename, v=info.version)
+
+
+def image_srcset(filename):
+    """A ``srcset`` value listing every standard width of ``filename``."""
+    info = source_info(filename)
+    if info is None:
+        return ''
+    return ', '.join('%s %dw' % (url_for('images.derivative', width=w, filename=filename, v=info.version),
+                                 min(w, info.width))
+                     for w in widths_for(info))
+
+
+def describe(image):
+    """Fill in a ProductImage's size, version and widths from its file."""
+    info = source_info(image.filename)
+    if info is None:
+        image.width = image.height = image.version = image.widths = None
+        return False
+    image.width, image.height, image.version = info.width, info.height, info.version
+    image.widths = ','.join(str(w) for w in widths_for(info))
+    return True
+
+
+def picture(image):
+    if image is None:
+        return None
+    return Picture(image.filename, image.alt, image.width, image.height, image.version, image.widths)
+
+
+def product_image_url(image, width=None):
+    """image_url() for a ProductImage or Picture, from its stored metadata."""
+    if not image.widths:
+        return image_url(image.filename, width)
+    widths = [int(w) for w in image.widths.split(',')]
+    if width is None:
+        width = widths[-1]
+    width = next((w for w in widths if w >= width), widths[-1])
+    return url_for('images.derivative', width=width, filename=image.filename, v=image.version)
+
+
+def product_image_srcset(image):
+    """image_srcset() for a ProductImage or Picture, from its stored metadata."""
+    if not image.widths:
+        return image_srcset(image.filename)
+    return ', '.join('%s %dw' % (url_for('images.derivative', width=w, filename=image.filename, v=image.version),
+                                 min(w, image.width))
+                     for w in map(int, image.widths.split(',')))
+
+
+@images_cli.command('build')
+@click.option('--format', 'formats', multiple=True, help='Only build these formats.')
+def build_command(formats):
+    """Render every derivative of every image under static/images and
+    record the product images' sizes."""
+    formats = formats or available_formats()
+    static_folder = current_app.static_folder
+    built = 0
+    for root, _, files in os.walk(os.path.join(static_folder, 'images')):
+        for name in sorted(files):
+            filename = os.path.relpath(os.path.join(root, name), static_folder)
+            info = source_info(filename)
+            if info is None:
+                continue
+            for width in widths_for(info):
+                for fmt in formats:
+                    if fmt == 'png' and not info.has_alpha or fmt == 'jpeg' and info.has_alpha:
+                        continue
+                    build_derivative(info, width, fmt)
+                    built += 1
+            click.echo(filename)
+    click.echo('%d derivatives in %s' % (built, current_app.config['IMAGE_CACHE_DIR']))
+
+    described = 0
+    for image in ProductImage.query.all():
+        described += describe(image)
+    db.session.commit()
+    click.echo('%d product images described' % described)
+
+
+def init_app(app):
+    app.config.setdefault('IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'image-cache'))
+    app.config.setdefault('IMAGE_WIDTHS', DEFAULT_WIDTHS)
+    app.register_blueprint(bp)
+    app.jinja_env.globals.update(image_url=image_url, image_srcset=image_srcset,
+                                 product_image_url=product_image_url,
+                                 product_image_srcset=product_image_srcset)
+    app.cli.add_command(images_cli)
@@ -0,0 +1,162 @@
+"""Stock reservations.
+
+``Product.stock`` is the number of units nobody has claimed yet. Adding to
+the cart moves units from ``stock`` into a time-boxed ``StockHold`` with a
+single conditional ``UPDATE ... WHERE stock >= :qty``, so concurrent
+requests in any number of worker processes can never take stock below zero
+and need no application-level locks. At checkout the cart's holds are
+handed to the Stripe session; they are consumed when the session completes
+and put back when it expires or the hold lapses.
+
+Every release deletes the hold row first and only restores stock if that
+delete hit a row, so a hold is returned exactly once even when the sweeper,
+a webhook and the customer race to release it.
+
+Stock moves don't bump the catalog version (see cache.py) unless a product
+sells out or comes back, which is all the cached pages show of it.
+"""
+import secrets
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from models import db, Product, StockHold
+from cache import mark_catalog_changed
+import jobs
+
+CART_HOLD_TTL = timedelta(minutes=15)
+# Stripe requires expires_at at least 30 minutes out; holds outlive the
+# session a little so a late completion still finds them
+CHECKOUT_SESSION_TTL = timedelta(minutes=31)
+CHECKOUT_HOLD_TTL = CHECKOUT_SESSION_TTL + timedelta(minutes=10)
+
+
+def new_cart_id():
+    return secrets.token_urlsafe(16)
+
+
+def _move_stock(product_id, units, *criteria):
+    """Add ``units`` (negative to take) to a product's stock; returns whether it matched."""
+    moved = db.session.execute(
+        sa.update(Product).where(Product.id == product_id, *criteria).values(stock=Product.stock + units),
+        execution_options={'synchronize_session': False, 'stock_only': True}).rowcount
+    if moved:
+        # Read back inside the same transaction, so this sees its own write
+        stock = db.session.query(Product.stock).filter(Product.id == product_id).scalar()
+        # Sold out (none left after) or back in stock (none before)
+        if min(stock, stock - units) == 0:
+            mark_catalog_changed(db.session)
+    return moved
+
+
+def reserve(product_id, cart_id, quantity, ttl=None):
+    """Hold ``quantity`` units for a cart. Returns False if there isn't enough stock."""
+    if not _move_stock(product_id, -quantity, Product.stock >= quantity):
+        db.session.rollback()
+        return False
+    db.session.add(StockHold(product_id=product_id, cart_id=cart_id, quantity=quantity,
+                             expires_at=datetime.utcnow() + (ttl or CART_HOLD_TTL)))
+    db.session.commit()
+    return True
+
+
+def held_quantities(cart_id):
+    """{product_id: units} currently held for a cart that hasn't gone to checkout."""
+    held = defaultdict(int)
+    rows = (db.session.query(StockHold.product_id, StockHold.quantity)
+            .filter(StockHold.cart_id == cart_id, StockHold.checkout_session_id.is_(None))
+            .all())
+    for product_id, quantity in rows:
+        held[product_id] += quantity
+    return held
+
+
+def ensure_held(cart_id, cart_items):
+    """Secure a cart's holds for checkout. Returns the ids that couldn't be held.
+
+    Existing holds are first pushed out to the checkout TTL so the sweeper
+    can't take them while Stripe creates the session; lines whose holds
+    already lapsed are reserved again.
+    """
+    (StockHold.query
+     .filter(StockHold.cart_id == cart_id, StockHold.checkout_session_id.is_(None))
+     .update({StockHold.expires_at: datetime.utcnow() + CHECKOUT_HOLD_TTL},
+             synchronize_session=False))
+    db.session.commit()
+
+    held = held_quantities(cart_id)
+    short = []
+    for item in cart_items:
+        missing = item['quantity'] - held.get(item['product_id'], 0)
+        if missing > 0 and not reserve(item['product_id'], cart_id, missing, CHECKOUT_HOLD_TTL):
+            short.append(item['product_id'])
+    return short
+
+
+def attach_checkout(cart_id, checkout_session_id, ttl=None):
+    """Hand a cart's holds over to a Stripe checkout session."""
+    (StockHold.query
+     .filter(StockHold.cart_id == cart_id, StockHold.checkout_session_id.is_(None))
+     .update({StockHold.checkout_session_id: checkout_session_id,
+              StockHold.expires_at: datetime.utcnow() + (ttl or CHECKOUT_HOLD_TTL)},
+             synchronize_session=False))
+    db.session.commit()
+
+
+def _delete_hold(hold_id, product_id, quantity, criteria):
+    # The delete is the gate: only the caller that removes the row may move
+    # its stock. Matching on every column as well as the id keeps this exact
+    # when SQLite hands a deleted hold's id to a new one.
+    return (StockHold.query
+            .filter(StockHold.id == hold_id, StockHold.product_id == product_id,
+                    StockHold.quantity == quantity, *criteria)
+            .delete(synchronize_session=False))
+
+
+def _hold_rows(criteria):
+    return (db.session.query(StockHold.id, StockHold.product_id, StockHold.quantity)
+            .filter(*criteria).all())
+
+
+def _release(*criteria):
+    released = 0
+    for hold_id, product_id, quantity in _hold_rows(criteria):
+        if _delete_hold(hold_id, product_id, quantity, criteria):
+            _move_stock(product_id, quantity)
+            released += quantity
+    db.session.commit()
+    return released
+
+
+def release_cart(cart_id, product_id=None):
+    """Return a cart's holds (or just one product's) to stock."""
+    criteria = [StockHold.cart_id == cart_id, StockHold.checkout_session_id.is_(None)]
+    if product_id is not None:
+        criteria.append(StockHold.product_id == product_id)
+    return _release(*criteria)
+
+
+def release_checkout(checkout_session_id):
+    """Return the holds of an abandoned or expired checkout session to stock."""
+    return _release(StockHold.checkout_session_id == checkout_session_id)
+
+
+@jobs.every(30)
+def release_expired():
+    # Expiry is re-checked in the delete, so a hold extended meanwhile survives
+    return _release(StockHold.expires_at < datetime.utcnow())
+
+
+def consume_checkout(checkout_session_id):
+    """Turn a completed session's holds into a sale; returns {product_id: units}.
+
+    The stock was already taken when the holds were made, so this only
+    deletes them. The caller commits, together with its other order writes.
+    """
+    consumed = defaultdict(int)
+    criteria = (StockHold.checkout_session_id == checkout_session_id,)
+    for hold_id, product_id, quantity in _hold_rows(criteria):
+        if _delete_hold(hold_id, product_id, quantity, criteria):
+            consumed[product_id] += quantity
+    return consumed
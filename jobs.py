@@ -0,0 +1,221 @@
+"""Local durable job queue.
+
+Jobs are rows in the ``job`` table, so they survive restarts and are shared
+by every gunicorn worker. ``(kind, key)`` is unique, which makes enqueueing
+idempotent: Stripe retrying an event just hits the existing row. Each
+worker process runs a background thread per queue (started from gunicorn's
+``post_fork`` hook) that claims jobs with a conditional UPDATE, so two
+workers never run the same job. Slow kinds (audio transcodes) have a queue
+of their own so they don't hold up webhook events, and a longer
+``stale_after`` so a worker restart doesn't hand a job that is still
+running to a second worker. Done and failed jobs are deleted after
+``JOB_RETENTION_DAYS``; ``stripe.event`` payloads carry customer details.
+"""
+import json
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Job
+
+MAX_ATTEMPTS = 5
+STALE_AFTER = timedelta(minutes=10)
+DEFAULT_QUEUE = 'default'
+
+Handler = namedtuple('Handler', 'fn queue stale_after')
+
+_handlers = {}
+_periodic = []
+_wakeups = {}
+_workers = {}
+
+jobs_cli = AppGroup('jobs', help='Background job queue.')
+
+
+class PermanentError(Exception):
+    """Raised by a handler when retrying the job can't help (e.g. undecodable input)."""
+
+
+def handler(kind, queue=DEFAULT_QUEUE, stale_after=STALE_AFTER):
+    """Register a function to run jobs of ``kind``; it receives the decoded payload.
+
+    A job still 'running' ``stale_after`` after it was claimed is taken to
+    be abandoned by a killed worker and run again.
+    """
+    def decorator(fn):
+        _handlers[kind] = Handler(fn, queue, stale_after)
+        _wakeups.setdefault(queue, threading.Event())
+        return fn
+    return decorator
+
+
+def _kinds(queue):
+    return [kind for kind, registered in _handlers.items() if queue is None or registered.queue == queue]
+
+
+def every(seconds):
+    """Register a function the worker thread calls roughly every ``seconds``."""
+    def decorator(fn):
+        _periodic.append([fn, seconds, 0.0])
+        return fn
+    return decorator
+
+
+def run_periodic():
+    now = time.monotonic()
+    for task in _periodic:
+        fn, seconds, last_run = task
+        if now - last_run >= seconds:
+            task[2] = now
+            try:
+                fn()
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception('Periodic task %s failed', fn.__name__)
+
+
+def enqueue(kind, key, payload):
+    """Queue a job and wake the local worker. Returns False for a duplicate key."""
+    db.session.add(Job(kind=kind, key=key, payload=json.dumps(payload)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    registered = _handlers.get(kind)
+    _wakeups.setdefault(registered.queue if registered else DEFAULT_QUEUE, threading.Event()).set()
+    return True
+
+
+def _claim(queue=None):
+    now = datetime.utcnow()
+    candidates = (db.session.query(Job.id)
+                  .filter(Job.status == 'pending', Job.run_after <= now, Job.kind.in_(_kinds(queue)))
+                  .order_by(Job.id).limit(5).all())
+    for (job_id,) in candidates:
+        claimed = (Job.query
+                   .filter(Job.id == job_id, Job.status == 'pending')
+                   .update({Job.status: 'running', Job.claimed_at: now,
+                            Job.attempts: Job.attempts + 1},
+                           synchronize_session=False))
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+    return None
+
+
+def _requeue_stale():
+    # Jobs left 'running' by a worker that was killed mid-job
+    now = datetime.utcnow()
+    for kind, registered in _handlers.items():
+        (Job.query
+         .filter(Job.kind == kind, Job.status == 'running', Job.claimed_at < now - registered.stale_after)
+         .update({Job.status: 'pending'}, synchronize_session=False))
+    db.session.commit()
+
+
+def run_job(job):
+    try:
+        _handlers[job.kind].fn(json.loads(job.payload))
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception('Job %s (%s %s) failed', job.id, job.kind, job.key)
+        job = db.session.get(Job, job.id)
+        job.last_error = str(e)
+        if job.attempts >= MAX_ATTEMPTS or isinstance(e, PermanentError):
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        else:
+            job.status = 'pending'
+            job.run_after = datetime.utcnow() + timedelta(seconds=2 ** job.attempts)
+    else:
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def run_pending(limit=None, queue=None):
+    """Run claimable jobs (of ``queue``, or any) until none are left (or ``limit`` jobs ran)."""
+    ran = 0
+    while limit is None or ran < limit:
+        job = _claim(queue)
+        if job is None:
+            break
+        run_job(job)
+        ran += 1
+    return ran
+
+
+@every(3600)
+def purge_finished():
+    before = datetime.utcnow() - timedelta(days=current_app.config['JOB_RETENTION_DAYS'])
+    # Jobs that failed before finished_at was set for failures go by their age
+    (Job.query
+     .filter(Job.status.in_(('done', 'failed')), func.coalesce(Job.finished_at, Job.created_at) < before)
+     .delete(synchronize_session=False))
+    db.session.commit()
+
+
+def _work_forever(app, poll_interval, queue=DEFAULT_QUEUE):
+    wakeup = _wakeups.setdefault(queue, threading.Event())
+    if queue == DEFAULT_QUEUE:
+        with app.app_context():
+            _requeue_stale()
+            db.session.remove()
+    while True:
+        wakeup.wait(poll_interval)
+        wakeup.clear()
+        with app.app_context():
+            try:
+                run_pending(queue=queue)
+                # The periodic tasks are quick; they go with the default queue
+                if queue == DEFAULT_QUEUE:
+                    run_periodic()
+            except Exception:
+                app.logger.exception('Job worker loop failed')
+            finally:
+                db.session.remove()
+
+
+def start_worker(app, queues=None):
+    """Start this process's job threads, one per queue. Safe to call more than once."""
+    for queue in sorted(set(_wakeups) | {DEFAULT_QUEUE}) if queues is None else queues:
+        worker = _workers.get(queue)
+        if worker is None or not worker.is_alive():
+            name = 'job-worker' if queue == DEFAULT_QUEUE else 'job-worker-%s' % queue
+            worker = _workers[queue] = threading.Thread(
+                target=_work_forever, name=name, daemon=True,
+                args=(app, app.config.get('JOB_POLL_INTERVAL', 1.0), queue))
+            worker.start()
+    return _workers
+
+
+@jobs_cli.command('work')
+def work_command():
+    """Run the job worker in the foreground."""
+    app = current_app._get_current_object()
+    start_worker(app, [queue for queue in _wakeups if queue != DEFAULT_QUEUE])
+    _work_forever(app, app.config.get('JOB_POLL_INTERVAL', 1.0))
+
+
+@jobs_cli.command('run')
+def run_command():
+    """Run every pending job once and exit."""
+    _requeue_stale()
+    click.echo('%d jobs run' % run_pending())
+    run_periodic()
+
+
+def init_app(app):
+    app.config.setdefault('JOB_POLL_INTERVAL', 1.0)
+    # Longer than Stripe keeps retrying an event (3 days), so a late retry
+    # still finds its job and is dropped as a duplicate
+    app.config.setdefault('JOB_RETENTION_DAYS', 7)
+    app.cli.add_command(jobs_cli)
@@ -0,0 +1,303 @@
+"""Prometheus metrics that add up across gunicorn workers.
+
+Each worker keeps its counters and histograms in memory. A background
+thread writes them to ``METRICS_DIR/<pid>.json`` every
+``METRICS_FLUSH_INTERVAL`` seconds when anything changed, and again when the
+worker exits. GET /metrics sums every file, so a scrape gives
+the same totals whichever worker answers it. It can miss up to one flush
+interval of the other workers' traffic. When gunicorn reaps a worker (e.g.
+after max_requests), the worker's totals are folded into ``retired.json``,
+so counters never go backwards. /metrics takes the admin bearer token (see
+admin.py), which Prometheus sends with ``authorization: {credentials: ...}``.
+
+Recorded:
+
+- ``http_requests_total`` and ``http_request_duration_seconds`` per endpoint
+- ``db_queries_per_request`` and ``db_query_seconds_per_request``, which make
+  N+1 loops stand out
+- ``stripe_request_duration_seconds`` for every Stripe API call, including
+  the job worker's
+- ``cache_requests_total`` hits and misses for the response, catalog and
+  image caches
+- ``admission_rejected_total``, the 429s and 503s of admission.py
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+
+from flask import Blueprint, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import admin
+
+DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# name -> (type, help, buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests by endpoint, method and status.', None),
+    'http_request_duration_seconds': ('histogram', 'Time to handle a request, by endpoint.', DURATION_BUCKETS),
+    'db_queries_per_request': ('histogram', 'SQL statements run by one request, by endpoint.', QUERY_BUCKETS),
+    'db_query_seconds_per_request': ('histogram', 'Time one request spent in SQL, by endpoint.', DURATION_BUCKETS),
+    'stripe_request_duration_seconds': ('histogram', 'Stripe API calls by method, path and status.',
+                                        DURATION_BUCKETS),
+    'cache_requests_total': ('counter', 'Cache lookups by cache and result.', None),
+    'admission_rejected_total': ('counter', 'Requests turned away by admission control, by group and reason.', None),
+}
+
+bp = Blueprint('metrics', __name__)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._dirty = False
+        self._flusher = None
+        self.directory = None
+        self.flush_interval = 1.0
+
+    def _forget(self):
+        # A forked worker must not report what the master recorded while
+        # warming up, and neither its lock nor its flush thread survive the fork
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._dirty = False
+        self._flusher = None
+
+    def _changed(self):
+        self._dirty = True
+        if self._flusher is None and self.directory is not None:
+            self._flusher = threading.Thread(target=self._flush_forever, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._changed()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, _key(labels))
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                # One slot per bucket, one for +Inf, then sum and count
+                counts = self._histograms[key] = [0] * (len(buckets) + 3)
+            index = 0
+            while index < len(buckets) and value > buckets[index]:
+                index += 1
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+            self._changed()
+
+    def snapshot(self):
+        with self._lock:
+            self._dirty = False
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, labels, list(counts)] for (name, labels), counts in self._histograms.items()],
+            }
+
+    def flush(self):
+        """Write this process's totals where /metrics can find them."""
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def _locked(self, mode):
+        os.makedirs(self.directory, exist_ok=True)
+        lock = open(os.path.join(self.directory, '.lock'), 'w')
+        fcntl.flock(lock, mode)
+        return lock
+
+    def collect(self):
+        """Totals over every worker, live and retired: {(name, labels): value or counts}."""
+        self.flush()
+        totals = {}
+        with self._locked(fcntl.LOCK_SH):
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.json'):
+                    _merge(totals, _read(os.path.join(self.directory, filename)))
+        return totals
+
+    def retire(self, pid):
+        """Fold a dead worker's file into retired.json (run from the gunicorn master)."""
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, '%d.json' % pid)
+        retired_path = os.path.join(self.directory, 'retired.json')
+        with self._locked(fcntl.LOCK_EX):
+            if not os.path.exists(path):
+                return
+            totals = {}
+            _merge(totals, _read(retired_path))
+            _merge(totals, _read(path))
+            with open(retired_path + '.tmp', 'w') as f:
+                json.dump(_unmerge(totals), f)
+            os.replace(retired_path + '.tmp', retired_path)
+            os.remove(path)
+
+    def reset(self):
+        """Forget every process's totals, e.g. when the server starts."""
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self._dirty = False
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        with self._locked(fcntl.LOCK_EX):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(('.json', '.tmp')):
+                    os.remove(os.path.join(self.directory, filename))
+
+
+registry = Registry()
+os.register_at_fork(after_in_child=registry._forget)
+inc = registry.inc
+observe = registry.observe
+
+
+def _key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'counters': [], 'histograms': []}
+
+
+def _merge(totals, snapshot):
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        totals[key] = totals.get(key, 0) + value
+    for name, labels, counts in snapshot['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        if key in totals:
+            totals[key] = [a + b for a, b in zip(totals[key], counts)]
+        else:
+            totals[key] = list(counts)
+
+
+def _unmerge(totals):
+    snapshot = {'counters': [], 'histograms': []}
+    for (name, labels), value in totals.items():
+        snapshot['histograms' if isinstance(value, list) else 'counters'].append([name, labels, value])
+    return snapshot
+
+
+def _labels(pairs):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                    for k, v in pairs)
+
+
+def render(totals):
+    """Prometheus text exposition format for ``collect()``'s totals."""
+    lines = []
+    for name in sorted(METRICS):
+        kind, help_text, buckets = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (metric, labels), value in sorted(totals.items()):
+            if metric != name:
+                continue
+            if kind == 'counter':
+                lines.append('%s{%s} %s' % (name, _labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], value):
+                cumulative += count
+                lines.append('%s_bucket{%s} %d' % (name, _labels(labels + (('le', bound),)), cumulative))
+            lines.append('%s_sum{%s} %r' % (name, _labels(labels), value[-2]))
+            lines.append('%s_count{%s} %d' % (name, _labels(labels), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+@bp.route('/metrics')
+@admin.require_token
+def metrics():
+    return current_app.response_class(render(registry.collect()), content_type='text/plain; version=0.0.4')
+
+
+@bp.before_app_request
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_db = [0, 0.0]
+    g.metrics_stripe = [0, 0.0]
+
+
+def note_stripe_call(seconds):
+    """Add a Stripe call to the current request's totals (see profiler.py)."""
+    if has_request_context():
+        stats = g.get('metrics_stripe')
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += seconds
+
+
+@bp.after_app_request
+def _record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@bp.teardown_app_request
+def _record_request(exc):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    endpoint = request.endpoint or 'unmatched'
+    queries, query_seconds = g.pop('metrics_db')
+    g.pop('metrics_stripe', None)
+    inc('http_requests_total', endpoint=endpoint, method=request.method,
+        status=g.pop('metrics_status', 500))
+    observe('http_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+    observe('db_queries_per_request', queries, endpoint=endpoint)
+    observe('db_query_seconds_per_request', query_seconds, endpoint=endpoint)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_query_started', None)
+    if started is not None and has_request_context():
+        stats = g.get('metrics_db')
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += time.perf_counter() - started
+
+
+def init_app(app):
+    app.config.setdefault('METRICS_DIR', os.environ.get('METRICS_DIR')
+                          or os.path.join(app.instance_path, 'metrics'))
+    app.config.setdefault('METRICS_FLUSH_INTERVAL', 1.0)
+    registry.directory = app.config['METRICS_DIR']
+    registry.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+    app.register_blueprint(bp)
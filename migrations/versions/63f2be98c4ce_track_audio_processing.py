@@ -0,0 +1,39 @@
+"""track audio processing
+
+Revision ID: 63f2be98c4ce
+Revises: 7c53fb9e6fc6
+Create Date: 2026-10-17 19:31:47.226310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '63f2be98c4ce'
+down_revision = '7c53fb9e6fc6'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    sa.Column('master_file', sa.String(length=255), nullable=True),
+    sa.Column('preview_url', sa.String(length=500), nullable=True),
+    sa.Column('duration', sa.Float(), nullable=True),
+    sa.Column('waveform_peaks', sa.Text(), nullable=True),
+    sa.Column('processing_status', sa.String(length=20), nullable=True),
+]
+
+
+def upgrade():
+    # db.create_all() makes these on fresh databases
+    existing = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('track')}
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        for column in COLUMNS:
+            if column.name not in existing:
+                batch_op.add_column(column)
+
+
+def downgrade():
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        for column in reversed(COLUMNS):
+            batch_op.drop_column(column.name)
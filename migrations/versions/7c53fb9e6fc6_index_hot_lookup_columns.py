@@ -0,0 +1,40 @@
+"""index hot lookup columns
+
+Revision ID: 7c53fb9e6fc6
+Revises: 875bad612098
+Create Date: 2026-10-17 10:14:05.918243
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c53fb9e6fc6'
+down_revision = '875bad612098'
+branch_labels = None
+depends_on = None
+
+# home() filters tracks on featured/is_release; the webhook matches
+# products by name
+INDEXES = [
+    ('ix_track_featured', 'track', ['featured']),
+    ('ix_track_is_release', 'track', ['is_release']),
+    ('ix_product_name', 'product', ['name']),
+]
+
+
+def _existing(table):
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        # db.create_all() makes these on fresh databases
+        if name not in _existing(table):
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,108 @@
+"""baseline schema
+
+Revision ID: 875bad612098
+Revises: 
+Create Date: 2026-10-17 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '875bad612098'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _missing(table):
+    # Databases made by db.create_all() before migrations existed already
+    # have these tables; the baseline adopts them as they are
+    return not sa.inspect(op.get_bind()).has_table(table)
+
+
+def upgrade():
+    if _missing('product'):
+        op.create_table('product',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('image_url', sa.String(length=200), nullable=True),
+        sa.Column('category', sa.String(length=50), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('stock', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if _missing('track'):
+        op.create_table('track',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(length=100), nullable=False),
+        sa.Column('artist', sa.String(length=100), nullable=False),
+        sa.Column('cover_url', sa.String(length=200), nullable=True),
+        sa.Column('audio_url', sa.String(length=500), nullable=True),
+        sa.Column('source_type', sa.String(length=50), nullable=True),
+        sa.Column('featured', sa.Boolean(), nullable=True),
+        sa.Column('is_release', sa.Boolean(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if _missing('job'):
+        op.create_table('job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=50), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('run_after', sa.DateTime(), nullable=False),
+        sa.Column('claimed_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('kind', 'key')
+        )
+        op.create_index(op.f('ix_job_status'), 'job', ['status'], unique=False)
+    if _missing('stock_hold'):
+        op.create_table('stock_hold',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('cart_id', sa.String(length=64), nullable=True),
+        sa.Column('checkout_session_id', sa.String(length=255), nullable=True),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['product_id'], ['product.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_stock_hold_cart_id'), 'stock_hold', ['cart_id'], unique=False)
+        op.create_index(op.f('ix_stock_hold_checkout_session_id'), 'stock_hold', ['checkout_session_id'], unique=False)
+        op.create_index(op.f('ix_stock_hold_expires_at'), 'stock_hold', ['expires_at'], unique=False)
+        op.create_index(op.f('ix_stock_hold_product_id'), 'stock_hold', ['product_id'], unique=False)
+    if _missing('stripe_price'):
+        op.create_table('stripe_price',
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('stripe_product_id', sa.String(length=255), nullable=False),
+        sa.Column('stripe_price_id', sa.String(length=255), nullable=False),
+        sa.Column('unit_amount', sa.Integer(), nullable=False),
+        sa.Column('currency', sa.String(length=3), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['product_id'], ['product.id'], ),
+        sa.PrimaryKeyConstraint('product_id')
+        )
+
+
+def downgrade():
+    op.drop_table('stripe_price')
+    op.drop_index(op.f('ix_stock_hold_product_id'), table_name='stock_hold')
+    op.drop_index(op.f('ix_stock_hold_expires_at'), table_name='stock_hold')
+    op.drop_index(op.f('ix_stock_hold_checkout_session_id'), table_name='stock_hold')
+    op.drop_index(op.f('ix_stock_hold_cart_id'), table_name='stock_hold')
+    op.drop_table('stock_hold')
+    op.drop_index(op.f('ix_job_status'), table_name='job')
+    op.drop_table('job')
+    op.drop_table('track')
+    op.drop_table('product')
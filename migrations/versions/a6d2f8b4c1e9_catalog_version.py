@@ -0,0 +1,39 @@
+"""catalog version
+
+Revision ID: a6d2f8b4c1e9
+Revises: f4a8c3e7b2d1
+Create Date: 2026-10-18 14:12:09.318240
+
+"""
+import time
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d2f8b4c1e9'
+down_revision = 'f4a8c3e7b2d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The catalog version moves from a file in the instance folder to this
+    # row, so every host sees it (see cache.py). db.create_all() makes the
+    # table on fresh databases and the first bump adds the row.
+    if sa.inspect(op.get_bind()).has_table('catalog_version'):
+        return
+    table = op.create_table(
+        'catalog_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.bulk_insert(table, [{'id': 1, 'version': time.time_ns() // 1000, 'changed_at': datetime.utcnow()}])
+
+
+def downgrade():
+    op.drop_table('catalog_version')
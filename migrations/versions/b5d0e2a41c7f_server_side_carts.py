@@ -0,0 +1,34 @@
+"""server-side carts
+
+Revision ID: b5d0e2a41c7f
+Revises: 63f2be98c4ce
+Create Date: 2026-10-17 20:05:12.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d0e2a41c7f'
+down_revision = '63f2be98c4ce'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() makes this on fresh databases
+    if sa.inspect(op.get_bind()).has_table('cart'):
+        return
+    op.create_table('cart',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('items', sa.Text(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_cart_updated_at'), 'cart', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_cart_updated_at'), table_name='cart')
+    op.drop_table('cart')
@@ -0,0 +1,65 @@
+"""product search
+
+Revision ID: c3a9f1e27d54
+Revises: b5d0e2a41c7f
+Create Date: 2026-10-17 21:12:40.518334
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a9f1e27d54'
+down_revision = 'b5d0e2a41c7f'
+branch_labels = None
+depends_on = None
+
+# The filters and sorts of search.py
+INDEXES = [
+    ('ix_product_category_price', 'product', ['category', 'price']),
+    ('ix_product_price', 'product', ['price']),
+    ('ix_product_created_at', 'product', ['created_at']),
+]
+
+# A copy of search.FTS_DDL as of this revision
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(
+        name, description, content='product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE OF name, description ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    existing = {index['name'] for index in sa.inspect(bind).get_indexes('product')}
+    for name, table, columns in INDEXES:
+        # db.create_all() makes these on fresh databases
+        if name not in existing:
+            op.create_index(name, table, columns, unique=False)
+    if bind.dialect.name == 'sqlite':
+        for statement in FTS_DDL:
+            op.execute(statement)
+        # Index the products that are already there
+        op.execute("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for trigger in ('product_fts_update', 'product_fts_delete', 'product_fts_insert'):
+            op.execute('DROP TRIGGER IF EXISTS %s' % trigger)
+        op.execute('DROP TABLE IF EXISTS product_fts')
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,57 @@
+"""orders
+
+Revision ID: d7e4b8a1f302
+Revises: c3a9f1e27d54
+Create Date: 2026-10-17 21:48:03.771925
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7e4b8a1f302'
+down_revision = 'c3a9f1e27d54'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() makes these on fresh databases
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('order'):
+        op.create_table('order',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('checkout_session_id', sa.String(length=255), nullable=False),
+        sa.Column('email', sa.String(length=255), nullable=True),
+        sa.Column('customer_name', sa.String(length=255), nullable=True),
+        sa.Column('amount_total', sa.Integer(), nullable=True),
+        sa.Column('currency', sa.String(length=3), nullable=False),
+        sa.Column('shipping', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('checkout_session_id')
+        )
+        op.create_index(op.f('ix_order_email'), 'order', ['email'], unique=False)
+        op.create_index(op.f('ix_order_created_at'), 'order', ['created_at'], unique=False)
+    if not inspector.has_table('order_item'):
+        op.create_table('order_item',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=True),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('unit_amount', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['order_id'], ['order.id'], ),
+        sa.ForeignKeyConstraint(['product_id'], ['product.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_order_item_order_id'), 'order_item', ['order_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_order_item_order_id'), table_name='order_item')
+    op.drop_table('order_item')
+    op.drop_index(op.f('ix_order_created_at'), table_name='order')
+    op.drop_index(op.f('ix_order_email'), table_name='order')
+    op.drop_table('order')
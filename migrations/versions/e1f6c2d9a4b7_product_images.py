@@ -0,0 +1,84 @@
+"""product images
+
+Revision ID: e1f6c2d9a4b7
+Revises: d7e4b8a1f302
+Create Date: 2026-10-17 22:26:51.093318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1f6c2d9a4b7'
+down_revision = 'd7e4b8a1f302'
+branch_labels = None
+depends_on = None
+
+# The carousels that used to be hard-coded in index.html, by product id.
+# Sizes are filled in by `flask images build`.
+CAROUSELS = {
+    1: [('images/hats/DSC09089.jpg', 'Delus Trucker Hat - Front'),
+        ('images/hats/DSC09093.jpg', 'Delus Trucker Hat - Side'),
+        ('images/hats/DSC09098.jpg', 'Delus Trucker Hat - Back'),
+        ('images/hats/DSC09102.jpg', 'Delus Trucker Hat - Detail')],
+    2: [('images/hats/DSC09203.JPG', 'Delus Trucker II - Front'),
+        ('images/hats/DSC09205.JPG', 'Delus Trucker II - Side'),
+        ('images/hats/DSC09215.JPG', 'Delus Trucker II - Back'),
+        ('images/hats/DSC09221.JPG', 'Delus Trucker II - Detail')],
+    3: [('images/hats/DSC09114.JPG', 'Product 3'),
+        ('images/hats/DSC09118.JPG', 'Product 3 - View 2'),
+        ('images/hats/DSC09122.JPG', 'Product 3 - View 3'),
+        ('images/hats/DSC09128.JPG', 'Product 3 - View 4')],
+    4: [('images/hats/DSC09155.JPG', 'Product 4'),
+        ('images/hats/DSC09160.JPG', 'Product 4 - View 2'),
+        ('images/hats/DSC09165.JPG', 'Product 4 - View 3'),
+        ('images/hats/DSC09170.JPG', 'Product 4 - View 4')],
+    5: [('images/hats/DSC09180.JPG', 'Product 5'),
+        ('images/hats/DSC09183.JPG', 'Product 5 - View 2'),
+        ('images/hats/DSC09190.JPG', 'Product 5 - View 3'),
+        ('images/hats/DSC09195.JPG', 'Product 5 - View 4')],
+    6: [('images/hats/DSC09135.jpg', 'Product 6'),
+        ('images/hats/DSC09136.jpg', 'Product 6 - View 2'),
+        ('images/hats/DSC09139.JPG', 'Product 6 - View 3'),
+        ('images/hats/DSC09147.jpg', 'Product 6 - View 4')],
+}
+
+
+def upgrade():
+    bind = op.get_bind()
+    # db.create_all() makes this on fresh databases
+    if not sa.inspect(bind).has_table('product_image'):
+        op.create_table('product_image',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('filename', sa.String(length=255), nullable=False),
+        sa.Column('alt', sa.String(length=200), nullable=True),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('is_primary', sa.Boolean(), nullable=False),
+        sa.Column('width', sa.Integer(), nullable=True),
+        sa.Column('height', sa.Integer(), nullable=True),
+        sa.Column('version', sa.String(length=32), nullable=True),
+        sa.Column('widths', sa.String(length=100), nullable=True),
+        sa.ForeignKeyConstraint(['product_id'], ['product.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_product_image_product_position', 'product_image', ['product_id', 'position'],
+                        unique=False)
+
+    if bind.execute(sa.text('SELECT count(*) FROM product_image')).scalar():
+        return
+    existing = {product_id for (product_id,) in bind.execute(sa.text('SELECT id FROM product'))}
+    product_image = sa.table('product_image', sa.column('product_id'), sa.column('filename'),
+                             sa.column('alt'), sa.column('position'), sa.column('is_primary'))
+    rows = [{'product_id': product_id, 'filename': filename, 'alt': alt, 'position': position,
+             'is_primary': position == 0}
+            for product_id, photos in CAROUSELS.items() if product_id in existing
+            for position, (filename, alt) in enumerate(photos)]
+    if rows:
+        op.bulk_insert(product_image, rows)
+
+
+def downgrade():
+    op.drop_index('ix_product_image_product_position', table_name='product_image')
+    op.drop_table('product_image')
@@ -0,0 +1,35 @@
+"""track natural key
+
+Revision ID: f4a8c3e7b2d1
+Revises: e1f6c2d9a4b7
+Create Date: 2026-10-18 09:41:27.604519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a8c3e7b2d1'
+down_revision = 'e1f6c2d9a4b7'
+branch_labels = None
+depends_on = None
+
+# `flask catalog import tracks` looks tracks up by (title, artist). Not
+# unique: a release can repeat a track that is also in the playlist.
+INDEXES = [
+    ('ix_track_title_artist', 'track', ['title', 'artist']),
+]
+
+
+def upgrade():
+    existing = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('track')}
+    for name, table, columns in INDEXES:
+        # db.create_all() makes these on fresh databases
+        if name not in existing:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -1,25 +1,138 @@
-from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
-db = SQLAlchemy()
+from database import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 class Product(db.Model):
+    # The search filters and sorts (see search.py); product_fts, the
+    # full-text index, is created alongside this table
+    __table_args__ = (db.Index('ix_product_category_price', 'category', 'price'),)
+
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, index=True)
     description = db.Column(db.Text)
-    price = db.Column(db.Float, nullable=False)
+    price = db.Column(db.Float, nullable=False, index=True)
     image_url = db.Column(db.String(200))
     category = db.Column(db.String(50))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     stock = db.Column(db.Integer, default=0)
+    # Load with selectinload(Product.images) wherever more than one product is shown
+    images = db.relationship('ProductImage', backref='product', order_by='ProductImage.position',
+                             cascade='all, delete-orphan')
+
+    @property
+    def primary_image(self):
+        for image in self.images:
+            if image.is_primary:
+                return image
+        return self.images[0] if self.images else None
+
+class ProductImage(db.Model):
+    """A product photo under static/, in carousel order.
+
+    width, height, version and widths describe the source image. They are
+    filled in by images.describe() (see images.py), so pages can write
+    srcsets and <img> dimensions without reading the file.
+    """
+    __table_args__ = (db.Index('ix_product_image_product_position', 'product_id', 'position'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)  # path under static/
+    alt = db.Column(db.String(200))
+    position = db.Column(db.Integer, nullable=False, default=0)
+    is_primary = db.Column(db.Boolean, nullable=False, default=False)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    version = db.Column(db.String(32))  # cache-busting token for derivative URLs
+    widths = db.Column(db.String(100))  # derivative widths on offer, e.g. '160,320,640'
 
 class Track(db.Model):
+    # The natural key of `flask catalog import` (see catalog.py)
+    __table_args__ = (db.Index('ix_track_title_artist', 'title', 'artist'),)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     artist = db.Column(db.String(100), nullable=False)
     cover_url = db.Column(db.String(200))
     audio_url = db.Column(db.String(500))
     source_type = db.Column(db.String(50))
-    featured = db.Column(db.Boolean, default=False)
-    is_release = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow) 
\ No newline at end of file
+    featured = db.Column(db.Boolean, default=False, index=True)
+    is_release = db.Column(db.Boolean, default=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Uploaded tracks (see audio.py): the private master, the processed
+    # renditions under static/ and the waveform for the player
+    master_file = db.Column(db.String(255))
+    preview_url = db.Column(db.String(500))
+    duration = db.Column(db.Float)
+    waveform_peaks = db.Column(db.Text)  # JSON list of 0-100 peak heights
+    processing_status = db.Column(db.String(20))  # pending, processing, ready or failed
+
+class Job(db.Model):
+    """A unit of background work in the local, durable job queue (see jobs.py)."""
+    __table_args__ = (db.UniqueConstraint('kind', 'key'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    key = db.Column(db.String(255), nullable=False)  # dedupe key, e.g. the Stripe event id
+    payload = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+class StockHold(db.Model):
+    """Units taken out of Product.stock for a cart or an open checkout (see inventory.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    cart_id = db.Column(db.String(64), index=True)
+    checkout_session_id = db.Column(db.String(255), index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Cart(db.Model):
+    """A shopper's cart lines, keyed by the opaque id in their session (see carts.py)."""
+    id = db.Column(db.String(32), primary_key=True)
+    items = db.Column(db.Text, nullable=False, default='[]')  # JSON [[product_id, quantity], ...]
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class Order(db.Model):
+    """A paid checkout, recorded by the webhook worker (see orders.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    checkout_session_id = db.Column(db.String(255), nullable=False, unique=True)
+    email = db.Column(db.String(255), index=True)  # lowercased, for support lookups
+    customer_name = db.Column(db.String(255))
+    amount_total = db.Column(db.Integer)  # cents, as charged by Stripe
+    currency = db.Column(db.String(3), nullable=False, default='usd')
+    shipping = db.Column(db.Text)  # JSON name and address from Stripe
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    items = db.relationship('OrderItem', backref='order', lazy='selectin', order_by='OrderItem.id')
+
+class OrderItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
+    name = db.Column(db.String(100), nullable=False)
+    unit_amount = db.Column(db.Integer, nullable=False)  # cents
+    quantity = db.Column(db.Integer, nullable=False)
+
+class StripePrice(db.Model):
+    """Cached Stripe Product/Price ids for a Product (see stripe_catalog.py)."""
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    stripe_product_id = db.Column(db.String(255), nullable=False)
+    stripe_price_id = db.Column(db.String(255), nullable=False)
+    unit_amount = db.Column(db.Integer, nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default='usd')
+    name = db.Column(db.String(100), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class CatalogVersion(db.Model):
+    """The one row counting catalog changes, shared by every process (see cache.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,163 @@
+"""Orders, recorded locally from Stripe's checkout webhook.
+
+The job worker records an ``Order`` for each ``checkout.session.completed``
+event, in the same transaction as the stock changes (see webhooks.py).
+/success reads it from there. Stripe is asked only when a shopper reaches
+/success before the webhook has been processed. Those answers are kept
+for ``ORDER_FALLBACK_TTL`` seconds, so reloading the page doesn't call
+Stripe again.
+
+Support can look orders up by checkout session id or email. Both columns
+are indexed:
+
+    flask orders find someone@example.com
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" '.../admin/orders?email=someone@example.com'
+"""
+import json
+import threading
+import time
+from collections import namedtuple
+
+import click
+import stripe
+from flask import Blueprint, current_app, jsonify, request
+from flask.cli import AppGroup
+
+from models import db, Order, OrderItem
+from pricing import catalog_snapshot
+import admin
+
+# Most recent first, at most this many per lookup
+LOOKUP_LIMIT = 50
+MAX_FALLBACK_ENTRIES = 1024
+
+# What success.html shows. ``items`` is empty and ``pending`` set while the
+# webhook hasn't been processed yet.
+Receipt = namedtuple('Receipt', 'session_id email items amount_total currency pending')
+
+bp = Blueprint('orders', __name__, url_prefix='/admin/orders')
+orders_cli = AppGroup('orders', help='Orders recorded from Stripe checkouts.')
+
+_fallback = {}
+_fallback_lock = threading.Lock()
+
+
+def _get(obj, name):
+    # Webhook payloads are dicts; StripeObjects are dicts too, but may omit keys
+    return obj.get(name) if obj is not None else None
+
+
+def record(checkout_session, quantities, lines):
+    """Add the Order for a completed checkout to the db session; the caller commits.
+
+    Items take their names and prices from ``lines``, what Stripe charged
+    (see webhooks.charged_lines); the catalog only fills in products
+    missing from them.
+    """
+    customer = _get(checkout_session, 'customer_details') or {}
+    shipping = _get(checkout_session, 'shipping_details') or _get(checkout_session, 'shipping')
+    order = Order(checkout_session_id=checkout_session['id'],
+                  email=(_get(customer, 'email') or '').lower() or None,
+                  customer_name=_get(customer, 'name'),
+                  amount_total=_get(checkout_session, 'amount_total'),
+                  currency=_get(checkout_session, 'currency') or 'usd',
+                  shipping=json.dumps(shipping) if shipping else None)
+    missing = [product_id for product_id in quantities if product_id not in lines]
+    rows = catalog_snapshot.get_many(missing) if missing else {}
+    for product_id, quantity in sorted(quantities.items()):
+        line = lines.get(product_id) or rows.get(product_id)
+        order.items.append(OrderItem(product_id=product_id,
+                                     name=line.name if line else 'Product #%d' % product_id,
+                                     unit_amount=line.unit_amount if line else 0,
+                                     quantity=quantity))
+    db.session.add(order)
+    return order
+
+
+def is_recorded(checkout_session_id):
+    return db.session.query(Order.id).filter_by(checkout_session_id=checkout_session_id).first() is not None
+
+
+def receipt(session_id):
+    """The Receipt for /success, from the local order if there is one."""
+    order = Order.query.filter_by(checkout_session_id=session_id).first()
+    if order is not None:
+        return Receipt(session_id, order.email, order.items, order.amount_total, order.currency, False)
+
+    now = time.monotonic()
+    with _fallback_lock:
+        entry = _fallback.get(session_id)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    checkout_session = stripe.checkout.Session.retrieve(session_id)
+    customer = _get(checkout_session, 'customer_details')
+    result = Receipt(session_id, _get(customer, 'email'), (), _get(checkout_session, 'amount_total'),
+                     _get(checkout_session, 'currency') or 'usd', True)
+    with _fallback_lock:
+        if len(_fallback) >= MAX_FALLBACK_ENTRIES:
+            for key in [key for key, (expires, _) in _fallback.items() if expires <= now]:
+                del _fallback[key]
+            if len(_fallback) >= MAX_FALLBACK_ENTRIES:
+                del _fallback[next(iter(_fallback))]
+        _fallback[session_id] = (now + current_app.config['ORDER_FALLBACK_TTL'], result)
+    return result
+
+
+def find(email=None, session_id=None):
+    """Orders for a customer email or a checkout session id, most recent first."""
+    query = Order.query
+    if session_id:
+        query = query.filter(Order.checkout_session_id == session_id)
+    if email:
+        query = query.filter(Order.email == email.strip().lower())
+    return query.order_by(Order.created_at.desc(), Order.id.desc()).limit(LOOKUP_LIMIT).all()
+
+
+def to_dict(order):
+    return {
+        'id': order.id,
+        'checkout_session_id': order.checkout_session_id,
+        'email': order.email,
+        'customer_name': order.customer_name,
+        'amount_total': order.amount_total,
+        'currency': order.currency,
+        'shipping': json.loads(order.shipping) if order.shipping else None,
+        'created_at': order.created_at.isoformat() if order.created_at else None,
+        'items': [{'product_id': item.product_id, 'name': item.name, 'unit_amount': item.unit_amount,
+                   'quantity': item.quantity} for item in order.items],
+    }
+
+
+@bp.route('')
+@admin.require_token
+def lookup():
+    email = request.args.get('email')
+    session_id = request.args.get('session_id')
+    if not email and not session_id:
+        return jsonify({'error': 'pass email or session_id'}), 400
+    return jsonify([to_dict(order) for order in find(email, session_id)])
+
+
+@orders_cli.command('find')
+@click.argument('email_or_session_id')
+def find_command(email_or_session_id):
+    """Show the orders for an email address or a checkout session id."""
+    if '@' in email_or_session_id:
+        found = find(email=email_or_session_id)
+    else:
+        found = find(session_id=email_or_session_id)
+    if not found:
+        click.echo('No orders found')
+    for order in found:
+        click.echo('#%d  %s  %s  %s %.2f  %s' % (
+            order.id, order.created_at.strftime('%Y-%m-%d %H:%M'), order.email or '-',
+            order.currency.upper(), (order.amount_total or 0) / 100, order.checkout_session_id))
+        for item in order.items:
+            click.echo('      %d x %s @ %.2f' % (item.quantity, item.name, item.unit_amount / 100))
+
+
+def init_app(app):
+    app.config.setdefault('ORDER_FALLBACK_TTL', 30)
+    app.register_blueprint(bp)
+    app.cli.add_command(orders_cli)
@@ -0,0 +1,114 @@
+"""Compiled-template cache and pre-rendered policy pages.
+
+Jinja keeps compiled templates in ``JINJA_CACHE_DIR``, shared by every
+worker and kept across restarts. A fresh process loads bytecode instead of
+parsing index.html and the other large templates again. Entries are keyed
+on the template source, so an edited template is compiled afresh.
+
+The shipping, returns and contact pages depend on nothing but the cart
+badge. ``serve()`` renders each one once per badge count, minifies it and
+compresses it with gzip and brotli. It serves the stored bytes with a
+content ETag and answers revalidations with 304. The warm-up builds the
+empty-cart variants in the gunicorn master, so that happens once per deploy.
+"""
+import gzip
+import hashlib
+import os
+import re
+import threading
+from collections import namedtuple
+
+from flask import current_app, render_template, request
+from jinja2 import FileSystemBytecodeCache
+
+import carts
+import metrics
+
+try:
+    import brotli
+except ImportError:  # pages are offered gzipped only without the brotli package
+    brotli = None
+
+# Past this many badge counts, variants are rendered per request instead of kept
+MAX_VARIANTS = 64
+
+_PROTECTED = re.compile(r'<(script|style|pre|textarea)\b[^>]*>.*?</\1\s*>', re.S | re.I)
+_HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.S)
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_SPACE = re.compile(r'\s+')
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """FileSystemBytecodeCache that never lets a worker read a half-written file."""
+
+    def dump_bytecode(self, bucket):
+        path = self._get_cache_filename(bucket)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            bucket.write_bytecode(f)
+        os.replace(tmp, path)
+
+
+def minify_html(html):
+    """Drop comments and collapse whitespace, leaving script, pre and textarea alone."""
+    out = []
+    position = 0
+    for match in _PROTECTED.finditer(html):
+        out.append(_SPACE.sub(' ', _HTML_COMMENT.sub('', html[position:match.start()])))
+        block = match.group(0)
+        if match.group(1).lower() == 'style':
+            block = _SPACE.sub(' ', _CSS_COMMENT.sub('', block))
+        out.append(block)
+        position = match.end()
+    out.append(_SPACE.sub(' ', _HTML_COMMENT.sub('', html[position:])))
+    return ''.join(out).strip()
+
+
+class Page(namedtuple('Page', 'etag identity gzip br')):
+    def body_for(self, accept_encodings):
+        """(content-encoding or None, body) for the client's Accept-Encoding."""
+        if self.br is not None and accept_encodings['br']:
+            return 'br', self.br
+        if accept_encodings['gzip']:
+            return 'gzip', self.gzip
+        return None, self.identity
+
+
+def build_page(template):
+    body = minify_html(render_template(template)).encode('utf-8')
+    return Page(etag=hashlib.sha256(body).hexdigest()[:20],
+                identity=body,
+                gzip=gzip.compress(body, 9, mtime=0),
+                br=brotli.compress(body, quality=11) if brotli is not None else None)
+
+
+_pages = {}
+_lock = threading.Lock()
+
+
+def serve(template):
+    """Response for a pre-rendered page, with ETag/304 and a precompressed body."""
+    key = (template, carts.count())
+    page = _pages.get(key)
+    metrics.inc('cache_requests_total', cache='page', result='hit' if page else 'miss')
+    if page is None:
+        page = build_page(template)
+        with _lock:
+            if len(_pages) < MAX_VARIANTS:
+                _pages[key] = page
+
+    encoding, body = page.body_for(request.accept_encodings)
+    response = current_app.response_class(body, mimetype='text/html')
+    # Each encoding is a different representation, so it gets its own tag
+    response.set_etag(page.etag + ('-' + encoding if encoding else ''))
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def init_app(app):
+    app.config.setdefault('JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja-cache'))
+    os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+    app.jinja_env.bytecode_cache = AtomicBytecodeCache(app.config['JINJA_CACHE_DIR'])
@@ -0,0 +1,116 @@
+"""Cart pricing shared by the cart page and Stripe checkout.
+
+All amounts are integer cents. Products are resolved in a single
+``IN (...)`` query, with their images selectin-loaded by a second, and kept
+in a small in-process snapshot that is dropped whenever the catalog version
+moves (see cache.py), so a warm worker prices a cart without touching the
+database at all. The snapshot is always loaded from the primary database.
+"""
+import threading
+from collections import namedtuple
+
+from sqlalchemy.orm import selectinload
+
+from models import Product
+from cache import response_cache
+from database import primary
+from images import picture
+import metrics
+
+# ``image`` is the primary ProductImage as an images.Picture, or None;
+# ``image_url`` is its filename, or the product's own image_url without one
+ProductRow = namedtuple('ProductRow', 'id name unit_amount image_url image')
+
+
+def to_cents(price):
+    # Product.price is a Float column; round rather than truncate so that
+    # e.g. 59.99 does not become 5998
+    return int(round(price * 100))
+
+
+class CartLine(namedtuple('CartLine', 'id name unit_amount quantity image_url image')):
+    __slots__ = ()
+
+    @property
+    def line_total(self):
+        return self.unit_amount * self.quantity
+
+    # Dollar views for the templates
+    @property
+    def price(self):
+        return self.unit_amount / 100
+
+    @property
+    def item_total(self):
+        return self.line_total / 100
+
+
+class CartQuote(namedtuple('CartQuote', 'lines')):
+    __slots__ = ()
+
+    @property
+    def total_cents(self):
+        return sum(line.line_total for line in self.lines)
+
+    @property
+    def total(self):
+        return self.total_cents / 100
+
+
+class CatalogSnapshot:
+    def __init__(self):
+        self._rows = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get_many(self, product_ids):
+        """Return {id: ProductRow} for the ids that exist, loading any missing
+        ones and their images in two queries."""
+        version = response_cache.version
+        with self._lock:
+            if version != self._version:
+                self._rows = {}
+                self._version = version
+            rows = self._rows
+            missing = [pid for pid in product_ids if pid not in rows]
+        metrics.inc('cache_requests_total', len(product_ids) - len(missing), cache='catalog', result='hit')
+        metrics.inc('cache_requests_total', len(missing), cache='catalog', result='miss')
+
+        if missing:
+            loaded = {}
+            query = Product.query.options(selectinload(Product.images)).filter(Product.id.in_(missing))
+            # Carts are charged at these prices, so never take them from a replica
+            with primary():
+                products = query.all()
+            for product in products:
+                image = picture(product.primary_image)
+                loaded[product.id] = ProductRow(product.id, product.name,
+                                                to_cents(product.price),
+                                                image.filename if image else product.image_url,
+                                                image)
+            with self._lock:
+                # Only keep the rows if nothing changed while we were loading
+                if self._version == version:
+                    self._rows.update(loaded)
+            rows = dict(rows)
+            rows.update(loaded)
+
+        return {pid: rows[pid] for pid in product_ids if pid in rows}
+
+
+catalog_snapshot = CatalogSnapshot()
+
+
+def price_cart(cart_items):
+    """Price a session cart (a list of {'product_id', 'quantity'} dicts).
+
+    Lines whose product no longer exists are dropped, as the views did before.
+    """
+    rows = catalog_snapshot.get_many([item['product_id'] for item in cart_items])
+    lines = []
+    for item in cart_items:
+        row = rows.get(item['product_id'])
+        if row:
+            lines.append(CartLine(row.id, row.name, row.unit_amount, item['quantity'],
+                                  row.image_url, row.image))
+    return CartQuote(lines)
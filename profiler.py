@@ -0,0 +1,284 @@
+"""Opt-in sampling profiler for slow requests.
+
+A request is profiled when:
+
+- it carries ``X-Profile: <ADMIN_TOKEN>``,
+- it is picked by ``PROFILE_SAMPLE_RATE`` (profile 1 in N requests), or
+- it takes longer than ``PROFILE_SLOW_SECONDS``. Every request is sampled
+  while this is set, and the samples of the fast ones are thrown away.
+
+A sampler thread reads the stacks of the threads serving those requests
+every ``PROFILE_INTERVAL`` seconds. The result goes to ``PROFILE_DIR`` as a
+speedscope file (https://www.speedscope.app), tagged with the endpoint,
+the status and the request's SQL and Stripe time. Only the newest
+``PROFILE_KEEP`` are kept. The profiled response carries an
+``X-Profile-Id`` header naming its file:
+
+    curl -H "X-Profile: $ADMIN_TOKEN" -X POST https://delus.co/create-checkout-session -D -
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" https://delus.co/admin/profiles
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" https://delus.co/admin/profiles/<id>?format=collapsed
+
+``?format=collapsed`` gives folded stacks for flamegraph.pl. Without
+ADMIN_TOKEN, sampling or a threshold, no request hook is installed. The
+sampler reads OS threads, so it works under the sync and gthread workers
+but not gevent.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Blueprint, abort, current_app, g, jsonify, request, send_file
+
+import admin
+
+bp = Blueprint('profiler', __name__, url_prefix='/admin/profiles')
+
+
+class Sampler:
+    """One thread per process sampling the stacks of the registered threads."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._labels = {}
+        self._reset()
+
+    def _reset(self):
+        # Also run in a forked child, where the parent's thread is gone and
+        # the lock may have been held at the moment of the fork
+        self._stacks = {}  # thread ident -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Threads don't survive gunicorn's fork, so each worker starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, name='profiler', daemon=True).start()
+
+    def start(self, ident):
+        self._ensure_thread()
+        with self._lock:
+            self._stacks[ident] = Counter()
+        self._wake.set()
+
+    def stop(self, ident):
+        with self._lock:
+            return self._stacks.pop(ident, Counter())
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            for path in sorted(sys.path, key=len, reverse=True):
+                if path and filename.startswith(path + os.sep):
+                    filename = filename[len(path) + 1:]
+                    break
+            label = self._labels[code] = '%s (%s:%d)' % (code.co_name, filename, code.co_firstlineno)
+        return label
+
+    def _collapse(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idents = list(self._stacks)
+            if not idents:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            frames = sys._current_frames()
+            samples = [(ident, self._collapse(frames[ident])) for ident in idents if ident in frames]
+            del frames
+            with self._lock:
+                for ident, stack in samples:
+                    counts = self._stacks.get(ident)
+                    if counts is not None:
+                        counts[stack] += 1
+            time.sleep(self.interval)
+
+
+sampler = Sampler()
+os.register_at_fork(after_in_child=sampler._reset)
+
+
+def speedscope(stacks, interval, name, tags):
+    """A speedscope file for a Counter of collapsed stacks."""
+    frames = []
+    index = {}
+    samples = []
+    weights = []
+    for stack, count in stacks.most_common():
+        sample = []
+        for label in stack.split(';'):
+            if label not in index:
+                index[label] = len(frames)
+                frames.append({'name': label})
+            sample.append(index[label])
+        samples.append(sample)
+        weights.append(round(count * interval * 1000, 3))
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'delus profiler',
+        'shared': {'frames': frames},
+        'profiles': [{'type': 'sampled', 'name': name, 'unit': 'milliseconds',
+                      'startValue': 0, 'endValue': sum(weights), 'samples': samples, 'weights': weights}],
+        'tags': tags,
+    }
+
+
+def collapsed(profile):
+    """Folded stacks (``a;b;c <ms>`` lines) from a speedscope file."""
+    names = [frame['name'] for frame in profile['shared']['frames']]
+    data = profile['profiles'][0]
+    return ''.join('%s %s\n' % (';'.join(names[i] for i in sample), weight)
+                   for sample, weight in zip(data['samples'], data['weights']))
+
+
+def _trigger():
+    config = current_app.config
+    if 'X-Profile' in request.headers and admin.token_matches(request.headers['X-Profile']):
+        return 'header'
+    if config['PROFILE_SAMPLE_RATE'] and random.random() * config['PROFILE_SAMPLE_RATE'] < 1:
+        return 'sample'
+    if config['PROFILE_SLOW_SECONDS'] is not None:
+        return 'slow'
+    return None
+
+
+def _start_profile():
+    trigger = _trigger()
+    if trigger is None:
+        return
+    g.profile = (trigger, threading.get_ident(), time.perf_counter())
+    sampler.start(g.profile[1])
+
+
+def _finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    trigger, ident, started = profile
+    stacks = sampler.stop(ident)
+    duration = time.perf_counter() - started
+    if trigger == 'slow' and duration < current_app.config['PROFILE_SLOW_SECONDS']:
+        return response
+    if not stacks:
+        return response
+
+    queries, query_seconds = g.get('metrics_db', (0, 0.0))
+    stripe_calls, stripe_seconds = g.get('metrics_stripe', (0, 0.0))
+    endpoint = request.endpoint or 'unmatched'
+    tags = {
+        'endpoint': endpoint, 'method': request.method, 'path': request.path,
+        'status': response.status_code, 'trigger': trigger,
+        'duration_ms': round(duration * 1000, 1),
+        'sql_queries': queries, 'sql_ms': round(query_seconds * 1000, 1),
+        'stripe_calls': stripe_calls, 'stripe_ms': round(stripe_seconds * 1000, 1),
+        'samples': sum(stacks.values()), 'pid': os.getpid(), 'created': time.time(),
+    }
+    # Ids start with the time in ms; the ring buffer drops the lowest
+    profile_id = '%d-%d-%s' % (time.time() * 1000, os.getpid(), endpoint.replace('.', '-'))
+    name = '%s %s %.0fms' % (request.method, request.path, duration * 1000)
+    save(profile_id, speedscope(stacks, sampler.interval, name, tags))
+    response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def _abandon_profile(exc):
+    # after_request didn't run, e.g. it raised; stop sampling the thread
+    profile = g.pop('profile', None)
+    if profile is not None:
+        sampler.stop(profile[1])
+
+
+def _directory():
+    return current_app.config['PROFILE_DIR']
+
+
+def save(profile_id, profile):
+    directory = _directory()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, profile_id + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(profile, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+    # Other workers may be trimming too; whoever gets there first wins
+    for old in profile_ids()[:-current_app.config['PROFILE_KEEP']]:
+        try:
+            os.remove(os.path.join(directory, old + '.json'))
+        except FileNotFoundError:
+            pass
+
+
+def profile_ids():
+    """Stored profile ids, oldest first."""
+    try:
+        names = os.listdir(_directory())
+    except FileNotFoundError:
+        return []
+    return sorted((name[:-5] for name in names if name.endswith('.json')),
+                  key=lambda profile_id: int(profile_id.split('-', 1)[0]))
+
+
+def load(profile_id):
+    if profile_id not in profile_ids():
+        return None
+    try:
+        with open(os.path.join(_directory(), profile_id + '.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+@bp.route('')
+@admin.require_token
+def index():
+    listing = []
+    for profile_id in reversed(profile_ids()):
+        profile = load(profile_id)
+        if profile is not None:
+            listing.append(dict(profile['tags'], id=profile_id))
+    return jsonify(listing)
+
+
+@bp.route('/<profile_id>')
+@admin.require_token
+def show(profile_id):
+    profile = load(profile_id)
+    if profile is None:
+        abort(404)
+    if request.args.get('format') == 'collapsed':
+        return current_app.response_class(collapsed(profile), mimetype='text/plain')
+    return send_file(os.path.join(_directory(), profile_id + '.json'), mimetype='application/json',
+                     as_attachment=True, download_name=profile_id + '.speedscope.json')
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR')
+                          or os.path.join(app.instance_path, 'profiles'))
+    app.config.setdefault('PROFILE_KEEP', int(os.environ.get('PROFILE_KEEP', 50)))
+    app.config.setdefault('PROFILE_INTERVAL', float(os.environ.get('PROFILE_INTERVAL', 0.005)))
+    app.config.setdefault('PROFILE_SAMPLE_RATE', int(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+    slow = os.environ.get('PROFILE_SLOW_SECONDS')
+    app.config.setdefault('PROFILE_SLOW_SECONDS', float(slow) if slow else None)
+    sampler.interval = app.config['PROFILE_INTERVAL']
+    app.register_blueprint(bp)
+
+    if (app.config['ADMIN_TOKEN'] or app.config['PROFILE_SAMPLE_RATE']
+            or app.config['PROFILE_SLOW_SECONDS'] is not None):
+        app.before_request(_start_profile)
+        app.after_request(_finish_profile)
+        app.teardown_request(_abandon_profile)
@@ -0,0 +1,214 @@
+"""Product search: /api/products/search and the /products page.
+
+Text queries match against ``product_fts``, an SQLite FTS5 index over
+product names and descriptions. The index keeps no copy of the text; it
+reads it from the product table. Triggers on ``product`` keep it current
+whatever writes the row. Stock changes don't touch name or description, so
+they never reach the index. ``db.create_all()`` and the migrations both
+create it.
+
+The filters are ``category``, ``min_price``/``max_price`` and ``in_stock``.
+The sorts are relevance, newest, price and name. The product indexes
+back all of them. Pages are keyset-paged: each response carries an opaque
+``cursor`` holding the last row's sort key and id. The next page seeks
+straight to that key, so a deep page costs the same as the first:
+
+    /api/products/search?q=trucker&category=Clothing&max_price=80&sort=price&limit=24
+"""
+import base64
+import json
+import re
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask import Blueprint, abort, jsonify, render_template, request, url_for
+from sqlalchemy import event
+
+from models import db, Product
+from cache import response_cache
+from database import reads_from_replica
+from pricing import catalog_snapshot
+from api import (BadQuery, PRODUCT_FIELDS, PRODUCT_DEFAULT_FIELDS, bool_arg, field_arg, float_arg, int_arg,
+                 page_response)
+
+DEFAULT_LIMIT = 24
+MAX_LIMIT = 100
+
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(
+        name, description, content='product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE OF name, description ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+]
+
+_fts = sa.table('product_fts', sa.column('rowid'), sa.column('rank'), sa.column('product_fts'))
+
+# name -> (key column, descending)
+SORTS = {
+    'relevance': (_fts.c.rank, False),
+    'newest': (Product.created_at, True),
+    'price': (Product.price, False),
+    '-price': (Product.price, True),
+    'name': (Product.name, False),
+}
+
+bp = Blueprint('search', __name__)
+
+
+@event.listens_for(Product.__table__, 'after_create')
+def _create_fts(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for statement in FTS_DDL:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+
+
+@event.listens_for(Product.__table__, 'before_drop')
+def _drop_fts(target, connection, **kw):
+    # The triggers go with the product table; the index has to go by hand
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('DROP TABLE IF EXISTS product_fts')
+
+
+def match_query(text):
+    """FTS5 query for what a shopper typed: every word, the last one as a prefix."""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    # Quoting makes each word a plain string, never FTS5 syntax
+    return ' '.join('"%s"' % word for word in words) + '*'
+
+
+def encode_cursor(sort, key, row_id):
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    raw = json.dumps([sort, key, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key, row_id = json.loads(raw)
+        if sort == 'newest':
+            key = datetime.fromisoformat(key)
+    except (ValueError, TypeError):
+        raise BadQuery('invalid cursor')
+    if cursor_sort != sort or not isinstance(row_id, int):
+        raise BadQuery('the cursor belongs to a different sort')
+    return key, row_id
+
+
+def search(fields, default_limit=DEFAULT_LIMIT):
+    """One page of products matching the request's arguments, as dicts of
+    ``fields``, plus the cursor for the next page (or None)."""
+    limit = int_arg('limit', default_limit, minimum=1, maximum=MAX_LIMIT)
+    match = match_query(request.args.get('q', ''))
+    sort = request.args.get('sort') or ('relevance' if match else 'newest')
+    if sort not in SORTS:
+        raise BadQuery('sort must be one of %s' % ', '.join(SORTS))
+    if sort == 'relevance' and not match:
+        raise BadQuery('sort=relevance needs a search query (q)')
+    column, descending = SORTS[sort]
+    use_fts = match and db.engine.dialect.name == 'sqlite'
+    if sort == 'relevance' and not use_fts:
+        # Only FTS5 ranks matches
+        column, descending = Product.id, False
+
+    query = db.session.query(Product.id, column.label('sort_key'), *[PRODUCT_FIELDS[field] for field in fields])
+    if use_fts:
+        query = query.join(_fts, _fts.c.rowid == Product.id).filter(_fts.c.product_fts.op('MATCH')(match))
+    elif match:
+        # Off SQLite every word has to appear in the name or description
+        for word in re.findall(r'\w+', request.args['q']):
+            pattern = '%' + word + '%'
+            query = query.filter(sa.or_(Product.name.ilike(pattern), Product.description.ilike(pattern)))
+
+    if request.args.get('category'):
+        query = query.filter(Product.category == request.args['category'])
+    min_price = float_arg('min_price')
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    max_price = float_arg('max_price')
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
+    in_stock = bool_arg('in_stock')
+    if in_stock is not None:
+        query = query.filter(Product.stock > 0 if in_stock else Product.stock <= 0)
+
+    # (key, id) row values let SQLite seek the sort index to the cursor
+    if request.args.get('cursor'):
+        position = sa.tuple_(column, Product.id)
+        after = sa.tuple_(*decode_cursor(request.args['cursor'], sort))
+        query = query.filter(position < after if descending else position > after)
+    if descending:
+        query = query.order_by(column.desc(), Product.id.desc())
+    else:
+        query = query.order_by(column, Product.id)
+
+    rows = query.limit(limit + 1).all()
+    items = [dict(zip(fields, row[2:])) for row in rows[:limit]]
+    cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        cursor = encode_cursor(sort, last.sort_key, last.id)
+    return items, cursor
+
+
+def next_url(cursor, **kwargs):
+    if cursor is None:
+        return None
+    args = request.args.to_dict()
+    args['cursor'] = cursor
+    return url_for(request.endpoint, **args, **kwargs)
+
+
+@bp.errorhandler(BadQuery)
+def bad_query(error):
+    return jsonify({'error': str(error)}), 400
+
+
+@bp.route('/api/products/search')
+@response_cache.conditional
+@reads_from_replica
+def api_search():
+    # Not kept in the response cache: free-text URLs would crowd out the
+    # pages that are worth keeping. A revalidation still skips the search,
+    # costing at most the catalog_version row read.
+    items, cursor = search(field_arg(PRODUCT_FIELDS, PRODUCT_DEFAULT_FIELDS))
+    link = None
+    if cursor:
+        link = '<%s>; rel="next"' % next_url(cursor, _external=True)
+    return page_response(items, link)
+
+
+@bp.route('/products')
+@reads_from_replica
+def products():
+    try:
+        items, cursor = search(['id', 'name', 'price', 'in_stock'])
+    except BadQuery as error:
+        abort(400, str(error))
+    rows = catalog_snapshot.get_many([item['id'] for item in items])
+    for item in items:
+        item['image'] = rows[item['id']].image if item['id'] in rows else None
+    categories = [category for (category,) in
+                  db.session.query(Product.category).filter(Product.category.isnot(None))
+                  .distinct().order_by(Product.category)]
+    return render_template('product_listing.html', products=items, categories=categories,
+                           sorts=SORTS, next_url=next_url(cursor))
+
+
+def init_app(app):
+    app.register_blueprint(bp)
@@ -1,18 +1,18 @@
 document.addEventListener('DOMContentLoaded', function() {
     // Track player elements
     const playButtons = document.querySelectorAll('.play-button');
-    const progressBar = document.querySelector('.progress');
-    const timeDisplay = document.querySelector('.time');
-    let isPlaying = false;
+    const audio = new Audio();
+    audio.preload = 'none';
     let currentTrack = null;
 
     // Handle play button clicks
     playButtons.forEach(button => {
         button.addEventListener('click', function() {
             const trackCard = this.closest('.track-card') || this.closest('.track-player');
-            
+
             if (currentTrack && currentTrack !== trackCard) {
                 // Stop previous track
+                audio.pause();
                 resetTrackUI(currentTrack);
             }
 
@@ -24,21 +24,54 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
-    function playTrack(trackCard) {
+    // Waveforms come precomputed from the server, one bar per column
+    document.querySelectorAll('.track-card .waveform').forEach(canvas => {
+        const trackCard = canvas.closest('.track-card');
+        fetch(canvas.dataset.peaksUrl)
+            .then(response => response.ok ? response.json() : null)
+            .then(peaks => {
+                if (!peaks) return;
+                trackCard.peaks = peaks;
+                drawWaveform(trackCard, 0);
+            })
+            .catch(() => {});
+
+        // Click the waveform to seek
+        canvas.addEventListener('click', function(event) {
+            const fraction = event.offsetX / canvas.clientWidth;
+            if (currentTrack !== trackCard) {
+                if (currentTrack) {
+                    audio.pause();
+                    resetTrackUI(currentTrack);
+                }
+                playTrack(trackCard, fraction);
+            } else if (audio.duration) {
+                audio.currentTime = fraction * audio.duration;
+            }
+        });
+    });
+
+    function playTrack(trackCard, startFraction) {
+        if (currentTrack !== trackCard) {
+            audio.src = trackCard.dataset.audio;
+            if (startFraction) {
+                audio.addEventListener('loadedmetadata', function seek() {
+                    audio.currentTime = startFraction * audio.duration;
+                    audio.removeEventListener('loadedmetadata', seek);
+                });
+            }
+        }
         const playButton = trackCard.querySelector('.play-button i');
         playButton.classList.remove('fa-play');
         playButton.classList.add('fa-pause');
         trackCard.querySelector('.play-button').classList.add('playing');
         currentTrack = trackCard;
-        isPlaying = true;
-        
-        // Simulate progress updates
-        startProgressSimulation();
+        audio.play().catch(() => resetTrackUI(trackCard));
     }
 
     function pauseTrack(trackCard) {
+        audio.pause();
         resetTrackUI(trackCard);
-        isPlaying = false;
     }
 
     function resetTrackUI(trackCard) {
@@ -48,28 +81,54 @@ document.addEventListener('DOMContentLoaded', function() {
         trackCard.querySelector('.play-button').classList.remove('playing');
     }
 
-    function startProgressSimulation() {
-        // This is a placeholder for actual audio progress
-        // In a real implementation, this would sync with actual audio playback
-        let progress = 0;
-        const interval = setInterval(() => {
-            if (!isPlaying) {
-                clearInterval(interval);
-                return;
-            }
-            progress += 1;
-            if (progress > 100) {
-                progress = 0;
-                pauseTrack(currentTrack);
-            }
-            updateProgress(progress);
-        }, 1000);
+    // Progress follows the real playback position
+    audio.addEventListener('timeupdate', function() {
+        if (currentTrack) updateProgress(currentTrack, audio.currentTime, audio.duration);
+    });
+
+    audio.addEventListener('ended', function() {
+        if (!currentTrack) return;
+        resetTrackUI(currentTrack);
+        updateProgress(currentTrack, 0, audio.duration);
+    });
+
+    function updateProgress(trackCard, position, duration) {
+        duration = duration || parseFloat(trackCard.dataset.duration) || 0;
+        const fraction = duration ? Math.min(position / duration, 1) : 0;
+        const progressBar = trackCard.querySelector('.progress');
+        const timeDisplay = trackCard.querySelector('.time');
+        if (progressBar) progressBar.style.width = `${fraction * 100}%`;
+        if (timeDisplay) timeDisplay.textContent = `${formatTime(position)} / ${formatTime(duration)}`;
+        drawWaveform(trackCard, fraction);
     }
 
-    function updateProgress(value) {
-        progressBar.style.width = `${value}%`;
-        const minutes = Math.floor(value * 3.45 / 100);
-        const seconds = Math.floor((value * 3.45 / 100 - minutes) * 60);
-        timeDisplay.textContent = `${minutes}:${seconds.toString().padStart(2, '0')} / 3:45`;
+    function formatTime(seconds) {
+        seconds = Math.floor(seconds || 0);
+        return `${Math.floor(seconds / 60)}:${(seconds % 60).toString().padStart(2, '0')}`;
+    }
+
+    function drawWaveform(trackCard, fraction) {
+        const canvas = trackCard.querySelector('.waveform');
+        const peaks = trackCard.peaks;
+        if (!canvas || !peaks) return;
+
+        const ratio = window.devicePixelRatio || 1;
+        const width = canvas.clientWidth * ratio;
+        const height = canvas.clientHeight * ratio;
+        if (canvas.width !== width || canvas.height !== height) {
+            canvas.width = width;
+            canvas.height = height;
+        }
+        const context = canvas.getContext('2d');
+        context.clearRect(0, 0, width, height);
+
+        const bars = Math.max(1, Math.floor(width / (3 * ratio)));
+        const barWidth = width / bars;
+        for (let i = 0; i < bars; i++) {
+            const peak = peaks[Math.floor(i * peaks.length / bars)] / 100;
+            const barHeight = Math.max(ratio, peak * height);
+            context.fillStyle = i / bars < fraction ? '#ff5500' : 'rgba(255, 255, 255, 0.35)';
+            context.fillRect(i * barWidth, (height - barHeight) / 2, Math.max(1, barWidth - ratio), barHeight);
+        }
     }
-}); 
\ No newline at end of file
+});
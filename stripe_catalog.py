@@ -0,0 +1,140 @@
+"""Pre-created Stripe Products and Prices.
+
+Each Product is mapped to a Stripe Product/Price pair once, and checkout
+sends ``{'price': id}`` lines instead of inline ``price_data``, so Stripe
+doesn't create a throwaway product for every line of every checkout. A line
+whose mapping is missing or out of date (price or name changed) falls back
+to inline ``price_data`` and queues a sync job, so the next checkout uses a
+fresh id. ``flask stripe sync-prices`` does the whole catalog ahead of time.
+
+Stripe replays a request's idempotency key for 24 hours, so the keys carry
+a token minted once per sync job (kept in its payload) or CLI run: a retry
+reuses what a crashed attempt created, while a later sync, say a price
+changed back or a product id reused after reset-db, gets new objects.
+"""
+import os
+import secrets
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+import stripe
+
+from models import db, Product, StripePrice
+from pricing import to_cents
+from cache import response_cache
+import jobs
+
+CURRENCY = 'usd'
+
+stripe_cli = AppGroup('stripe', help='Stripe catalog sync.')
+
+
+def _image_urls(image, site_url):
+    """Stripe wants absolute URLs of the full images; ``image`` is a ProductImage or Picture."""
+    return [site_url.rstrip('/') + '/static/' + image.filename] if image and site_url else []
+
+
+def checkout_line_items(lines, host_url):
+    """Stripe ``line_items`` for a priced cart (see pricing.price_cart)."""
+    prices = {price.product_id: price for price in
+              StripePrice.query.filter(StripePrice.product_id.in_([line.id for line in lines])).all()}
+    line_items = []
+    stale = []
+    for line in lines:
+        price = prices.get(line.id)
+        if price is not None and price.unit_amount == line.unit_amount and price.name == line.name:
+            line_items.append({'price': price.stripe_price_id, 'quantity': line.quantity})
+            continue
+        stale.append(line.id)
+        line_items.append({
+            'price_data': {
+                'currency': CURRENCY,
+                'product_data': {
+                    'name': line.name,
+                    'images': _image_urls(line.image, host_url),
+                    'metadata': {'product_id': line.id},
+                },
+                'unit_amount': line.unit_amount,  # Stripe expects amounts in cents
+            },
+            'quantity': line.quantity,
+        })
+
+    # One job per product, keyed on the catalog version, so concurrent
+    # checkouts of overlapping carts share jobs instead of racing each other
+    for product_id in stale:
+        key = '%d@%d' % (product_id, response_cache.version)
+        jobs.enqueue('stripe.sync_prices', key, {'product_ids': [product_id], 'site_url': host_url,
+                                                 'attempt': secrets.token_hex(8)})
+    return line_items
+
+
+def sync_product(product, site_url=None, attempt=None):
+    """Create or refresh the Stripe Product/Price for one Product.
+
+    ``attempt`` goes into the idempotency keys; pass the same one when
+    retrying a sync, and a new one otherwise.
+    """
+    attempt = attempt or secrets.token_hex(8)
+    amount = to_cents(product.price)
+    record = db.session.get(StripePrice, product.id)
+    if record is None:
+        stripe_product = stripe.Product.create(
+            name=product.name, images=_image_urls(product.primary_image, site_url),
+            metadata={'product_id': product.id},
+            idempotency_key='delus-product-%d-%s' % (product.id, attempt))
+        price = stripe.Price.create(
+            product=stripe_product.id, unit_amount=amount, currency=CURRENCY,
+            metadata={'product_id': product.id},
+            idempotency_key='delus-price-%d-%d-%s' % (product.id, amount, attempt))
+        record = StripePrice(product_id=product.id, stripe_product_id=stripe_product.id,
+                             stripe_price_id=price.id, unit_amount=amount,
+                             currency=CURRENCY, name=product.name)
+        db.session.add(record)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # The CLI or another worker got there first; its row wins and
+            # what this attempt created is left unused
+            db.session.rollback()
+            return db.session.get(StripePrice, product.id)
+    else:
+        if record.name != product.name:
+            stripe.Product.modify(record.stripe_product_id, name=product.name)
+            record.name = product.name
+        if record.unit_amount != amount:
+            price = stripe.Price.create(
+                product=record.stripe_product_id, unit_amount=amount, currency=CURRENCY,
+                metadata={'product_id': product.id},
+                idempotency_key='delus-price-%d-%d-%s' % (product.id, amount, attempt))
+            stripe.Price.modify(record.stripe_price_id, active=False)
+            record.stripe_price_id = price.id
+            record.unit_amount = amount
+    db.session.commit()
+    return record
+
+
+@jobs.handler('stripe.sync_prices')
+def sync_prices_job(payload):
+    # Jobs queued before the payload had an attempt token get a fresh one per run
+    attempt = payload.get('attempt')
+    for product in Product.query.filter(Product.id.in_(payload['product_ids'])).all():
+        sync_product(product, payload.get('site_url'), attempt)
+
+
+@stripe_cli.command('sync-prices')
+@click.option('--site-url', default=lambda: current_app.config.get('SITE_URL'),
+              help='Public base URL used for product images.')
+def sync_prices_command(site_url):
+    """Create or refresh Stripe Prices for every product."""
+    attempt = secrets.token_hex(8)
+    for product in Product.query.order_by(Product.id).all():
+        record = sync_product(product, site_url, attempt)
+        click.echo('%s -> %s' % (product.name, record.stripe_price_id))
+
+
+def init_app(app):
+    # Public base URL, e.g. https://delus.co; also where app.warm_up renders the home page
+    app.config.setdefault('SITE_URL', os.environ.get('SITE_URL'))
+    app.cli.add_command(stripe_cli)
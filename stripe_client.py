@@ -0,0 +1,89 @@
+"""One pooled, keep-alive HTTP client for every Stripe API call.
+
+The stripe library normally gives each thread its own ``requests.Session``
+with default pool sizes and an 80 second timeout. Here every call in the
+process (checkout, ``Session.retrieve`` in success(), the webhook worker's
+``list_line_items``, price sync) shares one connection pool with tight
+timeouts, so a warm worker reuses its TLS connection to Stripe instead of
+handshaking per checkout.
+
+Every attempt is timed into ``stripe_request_duration_seconds`` (see
+metrics.py), labelled with the API path with object ids collapsed.
+
+``STRIPE_API_BASE`` points the library at another server, e.g. the stub in
+bench/fake_stripe.py.
+"""
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+import stripe
+from stripe.http_client import RequestsClient
+
+import metrics
+
+# cs_test_a1b2..., price_1Nx..., evt_...: one label value per endpoint, not per object
+_OBJECT_ID = re.compile(r'/[a-z]+_(?:test_|live_)?[A-Za-z0-9]{8,}(?=/|$)')
+
+
+class PooledStripeClient(RequestsClient):
+    name = 'requests-pooled'
+
+    def __init__(self, timeout=(3.05, 20), pool_size=10, **kwargs):
+        super(PooledStripeClient, self).__init__(timeout=timeout, **kwargs)
+        self._pool_size = pool_size
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _shared_session(self):
+        # Sockets opened before gunicorn forks must not be shared between
+        # workers, so each process builds its own pool on first use
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size,
+                                          pool_block=False)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._thread_local = threading.local()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _request_internal(self, method, url, headers, post_data, is_streaming):
+        # RequestsClient uses self._session for every thread when it is set
+        self._thread_local.session = self._shared_session()
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            content, status, response_headers = super(PooledStripeClient, self)._request_internal(
+                method, url, headers, post_data, is_streaming)
+            return content, status, response_headers
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe('stripe_request_duration_seconds', elapsed,
+                            method=method.upper(), path=_OBJECT_ID.sub('/:id', urlsplit(url).path),
+                            status=status)
+            metrics.note_stripe_call(elapsed)
+
+
+def init_app(app):
+    app.config.setdefault('STRIPE_API_BASE', os.environ.get('STRIPE_API_BASE'))
+    app.config.setdefault('STRIPE_CONNECT_TIMEOUT', float(os.environ.get('STRIPE_CONNECT_TIMEOUT', 3.05)))
+    app.config.setdefault('STRIPE_READ_TIMEOUT', float(os.environ.get('STRIPE_READ_TIMEOUT', 20)))
+    app.config.setdefault('STRIPE_POOL_SIZE', int(os.environ.get('STRIPE_POOL_SIZE', 10)))
+    app.config.setdefault('STRIPE_MAX_RETRIES', int(os.environ.get('STRIPE_MAX_RETRIES', 1)))
+
+    if app.config['STRIPE_API_BASE']:
+        stripe.api_base = app.config['STRIPE_API_BASE']
+    stripe.max_network_retries = app.config['STRIPE_MAX_RETRIES']
+    stripe.default_http_client = PooledStripeClient(
+        timeout=(app.config['STRIPE_CONNECT_TIMEOUT'], app.config['STRIPE_READ_TIMEOUT']),
+        pool_size=app.config['STRIPE_POOL_SIZE'],
+        # The stub server speaks plain HTTP with no certificate to check
+        verify_ssl_certs=not (app.config['STRIPE_API_BASE'] or '').startswith('http://'))
@@ -0,0 +1,136 @@
+"""Stripe webhook processing.
+
+The /webhook view only verifies the signature and queues the event (see
+jobs.py); everything that talks to Stripe, writes stock or records the
+order happens here, on the job worker thread.
+"""
+from flask import current_app
+from sqlalchemy import case
+import stripe
+
+from models import db, Product
+import inventory
+import jobs
+import orders
+
+# Event types worth queueing; everything else is acknowledged and dropped
+HANDLED_EVENTS = {'checkout.session.completed', 'checkout.session.expired'}
+
+# Stripe caps metadata values at 500 characters
+MAX_METADATA_LENGTH = 500
+
+
+def encode_cart_metadata(lines):
+    """Compact 'id:qty,id:qty' form of a priced cart for checkout metadata."""
+    value = ','.join('%d:%d' % (line.id, line.quantity) for line in lines)
+    return value if len(value) <= MAX_METADATA_LENGTH else None
+
+
+def decode_cart_metadata(value):
+    quantities = {}
+    for pair in value.split(','):
+        product_id, quantity = pair.split(':')
+        quantities[int(product_id)] = quantities.get(int(product_id), 0) + int(quantity)
+    return quantities
+
+
+class ChargedLine:
+    """One product's share of a checkout, as Stripe charged it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.quantity = 0
+        self.amount_subtotal = 0  # cents, before discounts and tax
+
+    @property
+    def unit_amount(self):
+        return round(self.amount_subtotal / self.quantity) if self.quantity else 0
+
+
+def charged_lines(checkout_session):
+    """{product_id: ChargedLine} from the session's line items."""
+    line_items = stripe.checkout.Session.list_line_items(
+        checkout_session['id'], limit=100, expand=['data.price.product'])
+    lines = {}
+    unmatched = []
+    for item in line_items.auto_paging_iter():
+        product = item['price']['product']
+        product_id = (product.get('metadata') or {}).get('product_id') if isinstance(product, dict) else None
+        if product_id:
+            _add_line(lines, int(product_id), item)
+        else:
+            unmatched.append(item)
+
+    if unmatched:
+        # Sessions created before product ids were recorded can only match by name
+        names = {item['description'] for item in unmatched}
+        ids = dict(db.session.query(Product.name, Product.id).filter(Product.name.in_(names)).all())
+        for item in unmatched:
+            if item['description'] in ids:
+                _add_line(lines, ids[item['description']], item)
+            else:
+                current_app.logger.warning('Checkout %s: no product named %r',
+                                           checkout_session['id'], item['description'])
+    return lines
+
+
+def _add_line(lines, product_id, item):
+    line = lines.setdefault(product_id, ChargedLine(item['description']))
+    line.quantity += item['quantity']
+    line.amount_subtotal += item['amount_subtotal']
+
+
+def purchased_quantities(checkout_session, lines):
+    """{product_id: quantity} for a completed checkout session; ``lines`` from charged_lines."""
+    metadata = checkout_session.get('metadata') or {}
+    if metadata.get('cart'):
+        return decode_cart_metadata(metadata['cart'])
+    # Carts too large for session metadata carry the id on each line's product
+    return {product_id: line.quantity for product_id, line in lines.items()}
+
+
+def decrement_stock(quantities):
+    """Take sold units that were not covered by a hold straight out of stock."""
+    for product_id, quantity in sorted(quantities.items()):
+        (Product.query
+         .filter(Product.id == product_id)
+         .update({Product.stock: case((Product.stock > quantity, Product.stock - quantity), else_=0)},
+                 synchronize_session=False))
+
+
+def fulfil_checkout(checkout_session):
+    """Record the order and apply its stock changes in a single transaction."""
+    if orders.is_recorded(checkout_session['id']):
+        # Already fulfilled, e.g. through a second event for the same session
+        return None
+    lines = charged_lines(checkout_session)
+    quantities = purchased_quantities(checkout_session, lines)
+    held = inventory.consume_checkout(checkout_session['id'])
+    unheld = {product_id: quantity - held.get(product_id, 0)
+              for product_id, quantity in quantities.items()
+              if quantity > held.get(product_id, 0)}
+    if unheld:
+        # Sessions from before reservations, or whose holds already lapsed
+        current_app.logger.warning('Checkout %s: %s sold without a hold', checkout_session['id'], unheld)
+        decrement_stock(unheld)
+    for product_id, quantity in held.items():
+        surplus = quantity - quantities.get(product_id, 0)
+        if surplus > 0:
+            (Product.query
+             .filter(Product.id == product_id)
+             .update({Product.stock: Product.stock + surplus}, synchronize_session=False))
+    orders.record(checkout_session, quantities, lines)
+    db.session.commit()
+    return quantities
+
+
+@jobs.handler('stripe.event')
+def process_stripe_event(event):
+    checkout_session = event['data']['object']
+    if event['type'] == 'checkout.session.completed':
+        quantities = fulfil_checkout(checkout_session)
+        if quantities is not None:
+            current_app.logger.info('Order completed for session %s: %s',
+                                    checkout_session['id'], quantities)
+    elif event['type'] == 'checkout.session.expired':
+        inventory.release_checkout(checkout_session['id'])